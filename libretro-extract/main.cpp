@@ -4,11 +4,11 @@
 #include "LibretroEnvironment.h"
 #include "xbmc_game_types.h"
 
-#include <dirent.h>
 #include <iostream>
 #include <stdio.h>
 #include <stdlib.h>
 #include <sys/types.h>
+#include <unistd.h>
 
 using namespace LIBRETRO;
 using namespace std;
@@ -40,64 +40,34 @@ int main(int argc, const char* argv[])
 {
   if (argc == 1)
   {
-    cout << "Must call with libretro core as first argument" << endl;
+    cout << "Usage: " << argv[0] << " <libretro core> [<libretro core> ...]" << endl;
     return 0;
   }
 
-  string libraryDir = GetDirectory2(argv[1]);
-
-  DIR* dp;
-  struct dirent* ep;
-  dp = opendir(libraryDir.c_str());
-
-  if (dp == NULL)
+  // Cores may write to their system and save directories. Use the working
+  // directory, so that the caller decides where (see extract_driver.py)
+  char cwd[4096] = { };
+  if (getcwd(cwd, sizeof(cwd)) == NULL)
   {
-    printf("Could not open directory %s", libraryDir.c_str());
+    cout << "Could not get working directory" << endl;
     return 1;
   }
+  string workDir = cwd;
+  RemoveSlashAtEnd2(workDir);
 
-  while ((ep = readdir(dp)) != NULL)
+  for (int i = 1; i < argc; i++)
   {
-    string name = ep->d_name;
-    if (name == "." || name == "..")
-      continue;
-
-    if (name == "genesis_plus_gx_libretro.dylib" || name == "genesis_plus_gx_libretro.so")
-      continue; // Thread 1: EXC_BAD_ACCESS (code=2, address=0x100207240)
-
-    if (name == "mame078_libretro.dylib" || name == "mame078_libretro.so")
-      continue; // Thread 1: EXC_BAD_ACCESS (code=1, address=0x0)
-
-    if (name == "nxengine_libretro.dylib" || name == "nxengine_libretro.so")
-      continue; // code=2
-
-    if (name == "pcsx_rearmed_libretro.dylib" || name == "pcsx_rearmed_libretro.so")
-      continue; // "Error allocating memory!"
-
-    if (name == "prboom_libretro.dylib" || name == "prboom_libretro.so")
-      continue; // code=2
-
-    if (name == "snes9x_next_libretro.dylib" || name == "snes9x_next_libretro.so")
-      continue; // code=2
-
-    if (name == "vba_next_libretro.dylib" || name == "vba_next_libretro.so")
-      continue; // error: memory read failed for 0x0
-
-    if (name == "vbam_libretro.dylib" || name == "vbam_libretro.so")
-      continue; // error: memory read failed for 0x0
-
-    if (name == "mame_libretro.so" || name == "mame_libretro.dylib")
-      continue; // Segmentation fault on linux, Bus Error 10 on OSX
-
-    string libretroCore = libraryDir + "/" + name;
+    string libretroCore = argv[i];
+    size_t pos = libretroCore.find_last_of("/\\");
+    string name = (pos == string::npos ? libretroCore : libretroCore.substr(pos + 1));
 
     cout << "libretroCore: " << name << endl;
 
     game_client_properties gameClientProps = { };
     gameClientProps.library_path      = libretroCore.c_str();
-    gameClientProps.system_directory  = libraryDir.c_str();
-    gameClientProps.content_directory = libraryDir.c_str();
-    gameClientProps.save_directory    = libraryDir.c_str();
+    gameClientProps.system_directory  = workDir.c_str();
+    gameClientProps.content_directory = workDir.c_str();
+    gameClientProps.save_directory    = workDir.c_str();
 
     CLibretroDLL* CLIENT = new CLibretroDLL();
     if (!CLIENT || !CLIENT->Load(gameClientProps))
@@ -113,34 +83,28 @@ int main(int argc, const char* argv[])
       return 1;
     }
 
-
     // Environment must be initialized before calling retro_init()
     CClientBridge* CLIENT_BRIDGE = new CClientBridge;
     CLibretroEnvironment::Initialize(CLIENT, CLIENT_BRIDGE);
 
     CLIENT->retro_init();
 
+    // Output uses the syntax of info files. Flush it before tearing the core
+    // down, in case deinitializing crashes
     retro_system_info info = { };
     CLIENT->retro_get_system_info(&info);
-    cout << "Library name:    " << info.library_name << endl;
-    cout << "supported_extensions = \"" << info.valid_extensions << "\"" << endl;
-    cout << "version = \"" << info.library_version << "\"" << endl;
+    cout << "library_name = \"" << (info.library_name ? info.library_name : "") << "\"" << endl;
+    cout << "supported_extensions = \"" << (info.valid_extensions ? info.valid_extensions : "") << "\"" << endl;
+    cout << "version = \"" << (info.library_version ? info.library_version : "") << "\"" << endl;
     cout << "need_fullpath = \"" << (info.need_fullpath ? "true" : "false") << "\"" << endl;
     cout << "block_extract = \"" << (info.block_extract ? "true" : "false") << "\"" << endl;
-    cout << endl;
+    cout << endl << flush;
 
-    // Skip deinit if name contains "mednafen_" and ".dylib"
-    // Thread 1: EXC_BAD_ACCESS (code=2, address=0x7fff5bfef0)
-    if (!(name.find("mednafen_") != string::npos && (name.find(".dylib") != string::npos || name.find(".so") != string::npos)))
-      CLIENT->retro_deinit();
+    CLIENT->retro_deinit();
 
     delete CLIENT;
     delete CLIENT_BRIDGE;
   }
 
-  closedir(dp);
-
-
   return 0;
 }
-
@@ -20,52 +20,212 @@
 
 from release_creator.addon import Addon
 from release_creator.addons_xml import AddonsXml
+from release_creator.artifact_cache import ArtifactCache
+from release_creator.core_stripper import CoreStripper
+from release_creator.digest_cache import DigestCache
+from release_creator.extract_driver import ExtractDriver
 from release_creator.libretro_super import LibretroSuper
+from release_creator.release_archive import ReleaseArchive
+from release_creator.release_catalog import ReleaseCatalog
+from release_creator.release_manifest import ReleasedAddon
+from release_creator.release_manifest import ReleaseManifest
 from release_creator.repository_addon import RepositoryAddon
+from release_creator.zip_writer import CompressionPolicy
 
+import argparse
+import collections
+import multiprocessing
+import os
 import unittest
 
-def CreateRelease():
+def _CreateAddonRelease(item):
+    """
+    Create the release archive for a single libretro DLL, given a (dll,
+    CompressionPolicy, CoreStripper or None) tuple. This is a top-level
+    function so that it can be pickled and run by a worker process. Returns
+    (success, ID, ReleasedAddon, manifest entry, strip entry): only the small
+    index record and entries make it back to the parent process, the Addon is
+    dropped here. The strip entry is a (filename, entry) tuple for the parent's
+    CoreStripper. The digests of the add-on's files are saved before returning,
+    because worker processes exit without saving.
+    """
+    dll, policy, stripper = item
+    stripEntry = None
+    try:
+        # Package a stripped copy, the original is kept in /symbols
+        if stripper:
+            filename = os.path.basename(dll.GetPath())
+            stripper.StripDll(dll)
+            stripEntry = filename, stripper.GetEntry(filename)
+        
+        addon = Addon(dll, policy)
+        if not addon.CreateRelease():
+            return False, addon.GetID(), None, None, stripEntry
+        return True, addon.GetID(), ReleasedAddon.FromAddon(addon), ReleaseManifest.GetEntry(addon), stripEntry
+    finally:
+        DigestCache.GetInstance().Save()
+
+def _PackageAddons(items, policy, stripper=None, jobs=1):
+    """
+    Package a stream of items with jobs worker processes, yielding the result
+    of each item in order. An item is a LibretroDll to package, or a
+    ReleasedAddon whose archive is up to date and is passed through. DLLs are
+    stripped by the workers when stripper is given. At most
+    2 * jobs DLLs are in flight, so memory doesn't grow with the number of
+    cores.
+    """
+    if jobs <= 1:
+        for item in items:
+            if isinstance(item, ReleasedAddon):
+                yield True, item.GetID(), item, None, None
+            else:
+                yield _CreateAddonRelease((item, policy, stripper))
+        return
+    
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = collections.deque() # (AsyncResult, None) or (None, result), in order
+        inFlight = 0
+        for item in items:
+            if isinstance(item, ReleasedAddon):
+                pending.append((None, (True, item.GetID(), item, None, None)))
+            else:
+                pending.append((pool.apply_async(_CreateAddonRelease, [(item, policy, stripper)]), None))
+                inFlight += 1
+            item = None # Don't keep the last DLL alive
+            
+            while inFlight >= 2 * jobs:
+                asyncResult, result = pending.popleft()
+                if asyncResult:
+                    inFlight -= 1
+                    result = asyncResult.get()
+                yield result
+        
+        while pending:
+            asyncResult, result = pending.popleft()
+            yield asyncResult.get() if asyncResult else result
+    finally:
+        pool.close()
+        pool.join()
+
+def CreateRelease(jobs=1, buildJobs=1, makeJobs=None, incremental=False, artifactCacheSize=None,
+                  fetchJobs=1, depth=None, filterBlobs=False, referenceDir=None, extract=False, strip=False,
+                  compressLevels=None, deflateJobs=1, fetch=True, build=True):
     print('This can take a while. Grab a drink!')
     
     libretroSuper = LibretroSuper()
     
     print('Creating repository libretro-super')
-    libretroSuper.CloneIfNotValid()
+    libretroSuper.CloneIfNotValid(depth, filterBlobs)
     if not libretroSuper.IsValid():
         print('Repository libretro-super is not in a usable state')
         return
     
     print('Using branch %s of libretro-super' % libretroSuper.GetBranch())
     
-    print('Updating libretro-super projects')
-    #libretroSuper.Fetch()
+    if fetch:
+        print('Updating libretro-super projects')
+        libretroSuper.Fetch(fetchJobs, depth, filterBlobs, referenceDir)
     
-    print('Building libretro-super projects')
-    #libretroSuper.Build()
+    manifest = ReleaseManifest()
     
-    print('Analyzing build results for generated binaries')
-    dlls = libretroSuper.GetDlls()
+    # Opened before the workers start, so that a new catalog is only built once
+    catalog = ReleaseCatalog.GetInstance()
+    
+    # In incremental mode, only projects whose commit has no release are built
+    projects = None
+    if incremental:
+        projects = manifest.GetChangedProjects(libretroSuper.GetProjects())
+        
+        # A project the fetch moved back to a released commit still needs a new core
+        projects += [project for project in libretroSuper.GetMovedProjects() if project not in projects]
+        print('%d of %d projects changed since the last release' % (len(projects), len(libretroSuper.GetProjects())))
+    
+    if build:
+        # Cores built before from the same sources and toolchain are reused
+        artifactCache = ArtifactCache(maxSize=artifactCacheSize) if artifactCacheSize else ArtifactCache()
+        
+        print('Building libretro-super projects')
+        libretroSuper.Build(buildJobs, makeJobs, projects, artifactCache)
+    
+    # Large cores are deflated by deflateJobs threads within each job
+    policy = CompressionPolicy(compressLevels, deflateJobs)
+    stripper = CoreStripper() if strip else None
+    corePaths = [] # Only paths are kept of every core
+    strippedNames = []
+    
+    def DiscoverDlls():
+        """
+        Yield each core to package, or its ReleasedAddon if its archive is
+        up to date.
+        """
+        for dll in libretroSuper.IterDlls():
+            corePaths.append(dll.GetPath())
+            
+            # Add-ons that are up to date keep their archives untouched
+            if incremental:
+                releasedAddon = manifest.GetReleasedAddon(dll)
+                if releasedAddon:
+                    print('Archive for %s is up to date' % dll.GetID())
+                    yield releasedAddon
+                    continue
+            
+            yield dll
     
-    print('Found %d libretro binaries' % len(dlls))
+    print('Analyzing build results for generated binaries')
+    if jobs > 1:
+        print('Creating release archives using %d jobs' % jobs)
     
+    # Cores are discovered, packaged and hashed as a stream. Only a small
+    # record of each add-on is kept, in the order of a serial run, so that
+    # addons.xml doesn't change needlessly
     addons = []
-    for dll in dlls:
-        addon = Addon(dll)
-        if addon.CreateRelease():
-            addons.append(addon)
+    for success, id, releasedAddon, entry, stripEntry in _PackageAddons(DiscoverDlls(), policy, stripper, jobs):
+        if stripEntry:
+            strippedNames.append(stripEntry[0])
+            stripper.RecordEntry(*stripEntry)
+        if success:
+            addons.append(releasedAddon)
+            catalog.Record(id, releasedAddon.GetVersion(), releasedAddon.GetArchivePath(), entry['commit'] if entry else None)
+            if entry:
+                manifest.RecordEntry(id, entry)
         else:
-            print('Failed to create release archive for %s', addon.GetID())
+            print('Failed to create release archive for %s' % id)
+    manifest.Save()
+    
+    print('Found %d libretro binaries' % len(corePaths))
+    
+    if stripper:
+        stripper.Save()
+        stripper.PrintTotals(strippedNames)
+    
+    # Each core is loaded in its own process, a crashing core is only reported
+    if extract:
+        print('Extracting metadata from libretro binaries')
+        results = ExtractDriver(jobs=jobs).Extract(corePaths)
+        problems = ExtractDriver.Check(results, libretroSuper.GetInfoIndex())
+        if problems:
+            print('%d of %d cores crashed or disagree with their info files' % (len(problems), len(results)))
     
     # Don't forget about the repository add-on!
     repositoryAddon = RepositoryAddon()
     repositoryAddon.CreateRelease()
     addons.append(repositoryAddon)
     
+    repositoryPath = ReleaseArchive.GetArchivePath(repositoryAddon.GetID(), repositoryAddon.GetVersion())
+    if os.path.exists(repositoryPath):
+        catalog.Record(repositoryAddon.GetID(), repositoryAddon.GetVersion(), repositoryPath)
+    
+    # The catalog changes in one transaction, with the archives of this run
+    catalog.Commit()
+    
     print('Creating add-on index addons.xml')
     addonsXml = AddonsXml(addons)
     addonsXml.Save()
     
+    # Digests computed by this process, e.g. of addons.xml, are saved once
+    DigestCache.GetInstance().Save()
+    
     print('Finished!')
 
 class TestCreateRelease(unittest.TestCase):
@@ -73,4 +233,60 @@ class TestCreateRelease(unittest.TestCase):
         CreateRelease()
 
 if __name__ == '__main__':
-    unittest.main()
+    parser = argparse.ArgumentParser(description='Create libretro add-on release archives')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of add-ons to package in parallel (default: 1)')
+    parser.add_argument('--build-jobs', type=int, default=1,
+                        help='number of libretro-super projects to build in parallel (default: 1)')
+    parser.add_argument('--make-jobs', type=int, default=None,
+                        help='maximum number of make jobs across all builds (default: number of CPUs)')
+    parser.add_argument('--no-build', dest='build', action='store_false',
+                        help='package the cores in dist/<platform> without building libretro-super projects')
+    parser.add_argument('--no-fetch', dest='fetch', action='store_false',
+                        help='use the libretro-super projects as they are, without fetching new commits')
+    parser.add_argument('--fetch-jobs', type=int, default=1,
+                        help='number of libretro-super projects to fetch in parallel (default: 1)')
+    parser.add_argument('--depth', type=int, default=None,
+                        help='clone new projects with a history truncated to this many commits')
+    parser.add_argument('--blobless', action='store_true',
+                        help='clone new projects without file contents, fetching them when needed')
+    parser.add_argument('--reference', default=None, metavar='DIR',
+                        help='directory of bare repositories (libretro-<name>.git) to borrow objects from when cloning')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only build and package cores whose project commit or info file changed')
+    parser.add_argument('--artifact-cache-size', type=int, default=None, metavar='MIB',
+                        help='maximum size of the cache of built cores in MiB (default: 4096)')
+    parser.add_argument('--extract', action='store_true',
+                        help='load each core with libretro-extract to extract its metadata')
+    parser.add_argument('--strip', action='store_true',
+                        help='package cores without debug info, keeping the originals in /symbols')
+    parser.add_argument('--deflate-jobs', type=int, default=1,
+                        help='number of threads compressing each large core (default: 1)')
+    parser.add_argument('--compress-level', type=CompressionPolicy.ParseLevel, action='append', default=[], metavar='EXT=LEVEL',
+                        help='compression level 0-9 of files with extension EXT, 0 stores them (default: 6, png and jpg are stored)')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print statistics of the cache of built cores and exit')
+    parser.add_argument('--rebuild-catalog', action='store_true',
+                        help='rebuild the release catalog from the archives in /release and exit')
+    parser.add_argument('--list-releases', action='store_true',
+                        help='list the current version and source commit of every add-on in the release catalog and exit')
+    args = parser.parse_args()
+    
+    artifactCacheSize = args.artifact_cache_size * 1024 * 1024 if args.artifact_cache_size else None
+    
+    if args.cache_stats:
+        ArtifactCache().PrintStats()
+    elif args.rebuild_catalog:
+        catalog = ReleaseCatalog.GetInstance()
+        print('Found %d release archives' % catalog.Rebuild())
+        catalog.Commit()
+    elif args.list_releases:
+        catalog = ReleaseCatalog.GetInstance()
+        catalog.Refresh() # Folders changed by a pull are listed again
+        for row in catalog.GetCurrent():
+            print('%-40s %-10s %s' % (row['id'], row['version'], row['source_commit'] or ''))
+        catalog.Commit()
+    else:
+        CreateRelease(max(args.jobs, 1), max(args.build_jobs, 1), args.make_jobs, args.incremental, artifactCacheSize,
+                      max(args.fetch_jobs, 1), args.depth, args.blobless, args.reference, args.extract, args.strip,
+                      dict(args.compress_level), max(args.deflate_jobs, 1), args.fetch, args.build)
@@ -25,18 +25,28 @@ from release_archive import ReleaseArchive
 from settings_xml import SettingsXml
 from strings_po import StringsPo
 
+import hashlib
 import os
 import unittest
 
-class Addon:
-    def __init__(self, dll):
+class Addon(object):
+    """
+    An add-on built from a libretro DLL. Its parts (addon.xml, settings,
+    strings and release archive) are created on first use, so an add-on that
+    is never packaged costs little more than its DLL.
+    """
+    
+    __slots__ = ['_id', '_dll', '_policy', '_addonXml', '_changeLog', '_settingsXml', '_stringsPo', '_releaseArchive']
+    
+    def __init__(self, dll, policy=None):
         self._id             = dll.GetID()
         self._dll            = dll
-        self._addonXml       = AddonXml(dll)
-        self._changeLog      = ChangeLog() # TODO
-        self._settingsXml    = SettingsXml(self._id)
-        self._stringsPo      = StringsPo(self._addonXml)
-        self._releaseArchive = ReleaseArchive(self._id)
+        self._policy         = policy
+        self._addonXml       = None
+        self._changeLog      = None
+        self._settingsXml    = None
+        self._stringsPo      = None
+        self._releaseArchive = None
         """
         # Get the most recent release
         maxVersion = Addon._GetMaxVersion(self.addonXml.)
@@ -50,9 +60,9 @@ class Addon:
         """
     
     def IsValid(self):
-        return self._dll.IsValid()       and \
-               self._changeLog.IsValid() and \
-               self._addonXml.IsValid()
+        return self._dll.IsValid()            and \
+               self.GetChangeLog().IsValid()  and \
+               self.GetAddonXml().IsValid()
     
     def GetID(self):
         return self._id
@@ -61,20 +71,51 @@ class Addon:
         return self._dll
     
     def GetAddonXml(self):
+        if self._addonXml is None:
+            self._addonXml = AddonXml(self._dll)
         return self._addonXml
     
     def GetAddonXmlText(self):
-        return self._addonXml.GetAddonXml()
+        return self.GetAddonXml().GetAddonXml()
+    
+    def GetAddonXmlDigest(self):
+        """
+        Get the SHA-256 of the add-on's rendered addon.xml.
+        """
+        addonXmlText = self.GetAddonXmlText()
+        if not isinstance(addonXmlText, bytes):
+            addonXmlText = addonXmlText.encode('utf-8')
+        return hashlib.sha256(addonXmlText).hexdigest()
+    
+    def GetVersion(self):
+        return self.GetAddonXml().GetVersion()
     
     def GetChangeLog(self):
+        if self._changeLog is None:
+            self._changeLog = ChangeLog() # TODO
         return self._changeLog
     
+    def GetSettingsXml(self):
+        if self._settingsXml is None:
+            self._settingsXml = SettingsXml(self._id)
+        return self._settingsXml
+    
+    def GetStringsPo(self):
+        if self._stringsPo is None:
+            self._stringsPo = StringsPo(self.GetAddonXml())
+        return self._stringsPo
+    
+    def GetReleaseArchive(self):
+        if self._releaseArchive is None:
+            self._releaseArchive = ReleaseArchive(self._id, self._policy)
+        return self._releaseArchive
+    
     def Save(self):
         """
         Save the addon components (addon.xml, changelog.txt and libretro
         library) to /addons folder.
         """
-        return self._addonXml.Save() and self._changeLog.Save() and self._settingsXml.Save()
+        return self.GetAddonXml().Save() and self.GetChangeLog().Save() and self.GetSettingsXml().Save()
     
     def CreateRelease(self):
         """
@@ -84,7 +125,7 @@ class Addon:
         if not os.path.exists(Environment.GetReleaseDir(self._id)):
             os.makedirs(Environment.GetReleaseDir(self._id))
         
-        return self._releaseArchive.Update(self._addonXml, self._changeLog, self._dll, self._settingsXml, self._stringsPo)
+        return self.GetReleaseArchive().Update(self.GetAddonXml(), self.GetChangeLog(), self._dll, self.GetSettingsXml(), self.GetStringsPo())
 
 class TestAddonXml(unittest.TestCase):
     def setUp(self):
@@ -19,9 +19,9 @@
 
 from addon_version import AddonVersion
 from environment import Environment
+from template import Template
 
 import os
-import re
 import unittest
 
 ADDON_XML          = 'addon.xml'
@@ -30,7 +30,9 @@ ICON_PNG           = 'icon.png'
 FANART_JPG         = 'fanart.jpg'
 LIBRETRO_PROVIDER  = 'Libretro Team'
 
-class AddonXml:
+class AddonXml(object):
+    __slots__ = ['_id', '_info', '_libraryPath', '_project', '_addonVersion', '_path', '_template', '_artwork']
+    
     @staticmethod
     def GetFileName():
         return ADDON_XML
@@ -47,50 +49,55 @@ class AddonXml:
     def GetFanartFileName():
         return FANART_JPG
     
-    @staticmethod
-    def _LoadTemplate(path):
-        with open(path) as f:
-            return f.read().splitlines(False) # Don't keep line endings
-        return None
-    
     def __init__(self, dll):
         self._id           = dll.GetID()
         self._info         = dll.GetInfo()
         self._libraryPath  = dll.GetPath()
         self._project      = dll.GetProject()
         
-        addonDir = Environment.GetAddonDir(self._id)
-        
         self._addonVersion = None
-        self._path         = os.path.join(addonDir, ADDON_XML)
-        self._template     = AddonXml._LoadTemplate(os.path.join(Environment.GetSrcDir(), ADDON_TEMPLATE_XML))
-        self._iconPath     = None
-        self._fanartPath   = None
-        self._properties   = { } # Cache for resolved properties
-        
-        if self.IsValid() and os.path.exists(addonDir):
-            files = os.listdir(addonDir)
-            if ICON_PNG in files:
-                self._iconPath = os.path.join(addonDir, ICON_PNG)
-            if FANART_JPG in files:
-                self._fanartPath = os.path.join(addonDir, FANART_JPG)
+        self._path         = os.path.join(Environment.GetAddonDir(self._id), ADDON_XML)
+        self._template     = None # Loaded on first use, see _GetTemplate()
+        self._artwork      = None # (icon path, fanart path) on first use, see _GetArtwork()
+    
+    def _GetTemplate(self):
+        if self._template is None:
+            self._template = Template.Load(os.path.join(Environment.GetSrcDir(), ADDON_TEMPLATE_XML))
+        return self._template
+    
+    def _GetArtwork(self):
+        """
+        List the add-on directory once for the artwork it contains.
+        """
+        if self._artwork is None:
+            iconPath   = None
+            fanartPath = None
+            addonDir = Environment.GetAddonDir(self._id)
+            if self.IsValid() and os.path.exists(addonDir):
+                files = os.listdir(addonDir)
+                if ICON_PNG in files:
+                    iconPath = os.path.join(addonDir, ICON_PNG)
+                if FANART_JPG in files:
+                    fanartPath = os.path.join(addonDir, FANART_JPG)
+            self._artwork = (iconPath, fanartPath)
+        return self._artwork
     
     def IsValid(self):
-        if not self._template:
+        if not self._GetTemplate():
             return False
         if not self._info.IsValid():
             return False
         return True
     
     def GetIconPath(self):
-        return self._iconPath
+        return self._GetArtwork()[0]
     
     def GetFanartPath(self):
-        return self._fanartPath
+        return self._GetArtwork()[1]
     
     def GetAddonXml(self):
         if self.IsValid():
-            return '\n'.join([self.ReplaceTokens(line) for line in self._template])
+            return self._GetTemplate().Render(self.GetProperty)
         return ''
     
     def GetVersion(self):
@@ -127,48 +134,13 @@ class AddonXml:
         """
         Replace tokens (like @tokenname@) with the corresponding property.
         """
-        # Skip characters at the beginning of line (increases for every processed token)
-        skip = 0
-        
-        # Validate on XML identifiers (assuming ASCII characters)
-        validToken = re.compile('^[A-Za-z:_][A-Za-z0-9:_.-]*$')
-        
-        while line.count('@', skip) >= 2:
-            index1 = line.find('@') + 1
-            index2 = line.find('@', index1)
-            token = line[index1 : index2]
-            
-            # Make sure that discovered token is a valid XML identifier (no spaces, etc)
-            if validToken.match(token):
-                line = line[ : index1 - 1] + self.GetProperty(token) + line[index2 + 1 : ]
-                skip = index1 - 1 # Rewind 1 character so that tokens can be recursive
-            else:
-                skip = index1
-        
-        return line
+        return Template.ReplaceTokens(line, self.GetProperty)
     
     def GetProperty(self, prop):
-        if   prop == 'id':               value = self._id
-        elif prop == 'name':             value = self._info.GetDisplayName()
-        elif prop == 'version':          value = self.GetVersion().ToString()
-        elif prop == 'display_version':  value = self._info.GetDisplayVersion()
-        elif prop == 'core_name':        value = self._info.GetCoreName()
-        elif prop == 'authors':          value = self._info.GetAuthors() if self._info.GetAuthors() else LIBRETRO_PROVIDER
-        elif prop == 'description':      value = self._GetDescription()
-        elif prop == 'library_android':  value = self._GetLibraryPath(Environment.ANDROID)
-        elif prop == 'library_linux':    value = self._GetLibraryPath(Environment.LINUX64, Environment.LINUX32)
-        elif prop == 'library_osx':      value = self._GetLibraryPath(Environment.OSX64)
-        elif prop == 'library_win':      value = self._GetLibraryPath(Environment.WIN)
-        elif prop == 'platforms':        value = self._info.GetSystemName()
-        elif prop == 'extensions':       value = self._info.GetExtensions()
-        elif prop == 'supports_vfs':     value = self._info.SupportsVfs()
-        elif prop == 'supports_no_game': value = self._info.SupportsNoGame()
-        elif prop == 'platform':         value = '' # TODO
-        elif prop == 'nofanart':         value = 'true' if not self._fanartPath else 'false'
-        elif prop == 'noicon':           value = 'true' if not self._iconPath else 'false'
-        elif prop == 'broken':           value = '' # TODO
-        else:                            value = ''
-        return value
+        getter = PROPERTIES.get(prop)
+        if getter:
+            return getter(self)
+        return ''
     
     def _GetDescription(self):
         description = self._info.GetDescription()
@@ -198,6 +170,29 @@ class AddonXml:
             return os.path.split(self._libraryPath)[1]
         return ''
 
+# Property lookup table for GetProperty(), indexed by token name
+PROPERTIES = {
+    'id':               lambda self: self._id,
+    'name':             lambda self: self._info.GetDisplayName(),
+    'version':          lambda self: self.GetVersion().ToString(),
+    'display_version':  lambda self: self._info.GetDisplayVersion(),
+    'core_name':        lambda self: self._info.GetCoreName(),
+    'authors':          lambda self: self._info.GetAuthors() if self._info.GetAuthors() else LIBRETRO_PROVIDER,
+    'description':      lambda self: self._GetDescription(),
+    'library_android':  lambda self: self._GetLibraryPath(Environment.ANDROID),
+    'library_linux':    lambda self: self._GetLibraryPath(Environment.LINUX64, Environment.LINUX32),
+    'library_osx':      lambda self: self._GetLibraryPath(Environment.OSX64),
+    'library_win':      lambda self: self._GetLibraryPath(Environment.WIN),
+    'platforms':        lambda self: self._info.GetSystemName(),
+    'extensions':       lambda self: self._info.GetExtensions(),
+    'supports_vfs':     lambda self: self._info.SupportsVfs(),
+    'supports_no_game': lambda self: self._info.SupportsNoGame(),
+    'platform':         lambda self: '', # TODO
+    'nofanart':         lambda self: 'true' if not self.GetFanartPath() else 'false',
+    'noicon':           lambda self: 'true' if not self.GetIconPath() else 'false',
+    'broken':           lambda self: '', # TODO
+}
+
 class TestAddonXml(unittest.TestCase):
     def setUp(self):
         pass
@@ -17,50 +17,137 @@
 # *  http://www.gnu.org/copyleft/gpl.html
 # *
 
+from digest_cache import DigestCacheTestCase
 from environment import Environment
+from md5_file import DigestWriter
 from md5_file import MD5File
+from utils import loadJsonCache
+from utils import saveJsonCache
 
+import gzip
 import os
+import re
 import unittest
 
 ADDONS_XML       = 'addons.xml'
+GZIP_EXTENSION   = '.gz'
+FRAGMENT_CACHE   = 'addons-xml.json'
 XML_DECLARATION  = '<?xml version="1.0" encoding="UTF-8"?>'
 ADDONS_TAG_OPEN  = '<addons>'
 ADDONS_TAG_CLOSE = '</addons>'
 
 class AddonsXml:
+    """
+    The add-on index (addons.xml) lists the addon.xml of every add-on in the
+    repository. XBMC polls addons.xml.md5 and downloads the whole index when
+    it changes, so the index is only rewritten if an add-on was updated.
+    
+    The addon.xml fragment of each add-on is cached by ID, version and the
+    digest of the file it is read from, so an addon.xml that changes without
+    a version bump isn't served stale. A minified, gzipped copy of the index
+    (addons.xml.gz) is written alongside; the repository add-ons point
+    clients at it.
+    """
     @staticmethod
     def GetFileName():
         return os.path.join(Environment.GetReleaseDir(), ADDONS_XML)
     
+    @staticmethod
+    def GetCompressedFileName():
+        return AddonsXml.GetFileName() + GZIP_EXTENSION
+    
+    @staticmethod
+    def _GetCachePath():
+        return os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), FRAGMENT_CACHE)
+    
+    @staticmethod
+    def _GetFragmentKey(addon):
+        return '%s-%s-%s' % (addon.GetID(), addon.GetVersion().ToString(), addon.GetAddonXmlDigest())
+    
+    @staticmethod
+    def _GetFragment(addon):
+        addonXmlText = addon.GetAddonXmlText()
+        
+        # Remove leading <?xml> tag
+        if addonXmlText.startswith(XML_DECLARATION[ : 5]):
+            addonXmlText = addonXmlText.split('\n', 1)[1]
+        
+        return addonXmlText
+    
+    @staticmethod
+    def Minify(xml):
+        """
+        Remove whitespace between tags. Text inside elements is untouched.
+        """
+        return re.sub(r'>\s+<', '><', xml).strip()
+    
     def __init__(self, addons):
         self._addons = addons
     
+    def _LoadCache(self):
+        """
+        Returns the cached fragments (a dict of fragment key to addon.xml
+        text) and the list of fragment keys that make up the current index.
+        """
+        data = loadJsonCache(AddonsXml._GetCachePath())
+        fragments = data.get('fragments', { })
+        if bytes is str:
+            # Python 2 renders addon.xml as a byte string, keep fragments that way
+            fragments = dict((key, fragment.encode('utf-8')) for key, fragment in fragments.items())
+        return fragments, data.get('index', [])
+    
+    def _SaveCache(self, fragments, index):
+        saveJsonCache(AddonsXml._GetCachePath(), {'fragments': fragments, 'index': index})
+    
     def Save(self):
-        addonsXml = [XML_DECLARATION, ADDONS_TAG_OPEN]
+        cachedFragments, cachedIndex = self._LoadCache()
+        
+        # Only fragments in the index are kept, so the cache doesn't grow
+        fragments = { }
+        index     = []
         for addon in self._addons:
-            addonXmlText = addon.GetAddonXmlText()
-            
-            # Remove leading <?xml> tag
-            if addonXmlText.startswith(XML_DECLARATION[ : 5]):
-                addonXmlText = addonXmlText.split('\n', 1)[1]
-            
-            addonsXml.append(addonXmlText)
+            key = AddonsXml._GetFragmentKey(addon)
+            if key in cachedFragments:
+                fragments[key] = cachedFragments[key]
+            else:
+                fragments[key] = AddonsXml._GetFragment(addon)
+            index.append(key)
+        
+        outputs = [AddonsXml.GetFileName(), AddonsXml.GetFileName() + MD5File.GetExtension(), AddonsXml.GetCompressedFileName()]
+        if index == cachedIndex and all([os.path.exists(path) for path in outputs]):
+            print('Add-on index %s is up to date' % ADDONS_XML)
+            return True
+        
+        addonsXml = [XML_DECLARATION, ADDONS_TAG_OPEN]
+        addonsXml.extend([fragments[key] for key in index])
         addonsXml.append(ADDONS_TAG_CLOSE)
+        addonsXmlText = '\n\n'.join(addonsXml)
+        minifiedText  = AddonsXml.Minify(addonsXmlText)
         
-        with open(AddonsXml.GetFileName(), 'w') as f:
-            f.write('\n\n'.join(addonsXml))
+        # Both files are binary, write them as UTF-8
+        if not isinstance(addonsXmlText, bytes):
+            addonsXmlText = addonsXmlText.encode('utf-8')
+            minifiedText  = minifiedText.encode('utf-8')
         
-        md5File = MD5File(AddonsXml.GetFileName())
+        digestWriter = DigestWriter(open(AddonsXml.GetFileName(), 'wb'))
+        digestWriter.write(addonsXmlText)
+        digestWriter.close()
+        
+        # Fixed mtime and no filename in the gzip header, so identical
+        # indexes produce identical files
+        with open(AddonsXml.GetCompressedFileName(), 'wb') as f:
+            gz = gzip.GzipFile('', 'wb', 9, f, 0)
+            gz.write(minifiedText)
+            gz.close()
+        
+        md5File = MD5File(AddonsXml.GetFileName(), digestWriter)
         if md5File.Save():
+            self._SaveCache(fragments, index)
             return True
         
         return False
 
-class TestAddonsXml(unittest.TestCase):
-    def setUp(self):
-        pass
-    
+class TestAddonsXml(DigestCacheTestCase):
     def test_addons_xml(self):
         from addon import Addon
         from libretro_super import LibretroSuper
@@ -78,6 +165,26 @@ class TestAddonsXml(unittest.TestCase):
         
         addonsXml = AddonsXml(addons)
         self.assertTrue(addonsXml.Save())
+    
+    def test_fragment_key(self):
+        import zipfile
+        from addon_version import AddonVersion
+        from release_manifest import ReleasedAddon
+        
+        archivePath = os.path.join(self._dir, 'gameclient.test-1.0.0.zip')
+        keys = []
+        for addonXmlText in ['<addon id="gameclient.test"/>', '<addon id="gameclient.test" name="Test"/>']:
+            myzip = zipfile.ZipFile(archivePath, 'w')
+            myzip.writestr('gameclient.test/addon.xml', addonXmlText)
+            myzip.close()
+            keys.append(AddonsXml._GetFragmentKey(ReleasedAddon('gameclient.test', AddonVersion('1.0.0'), archivePath)))
+        
+        # Same version, but the addon.xml changed
+        self.assertNotEqual(keys[0], keys[1])
+    
+    def test_minify(self):
+        xml = '<addon id="a">\n\t<description>Line 1\n\nLine 2</description>\n\t<broken></broken>\n\t\n</addon>'
+        self.assertEqual(AddonsXml.Minify(xml), '<addon id="a"><description>Line 1\n\nLine 2</description><broken></broken></addon>')
 
 if __name__ == '__main__':
     unittest.main()
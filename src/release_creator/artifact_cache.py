@@ -0,0 +1,236 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from environment import Environment
+from utils import TempDirTestCase
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+ARTIFACT_DIR     = 'artifacts'
+ARTIFACT_INDEX   = 'index.json'
+MAX_CACHE_SIZE   = 4 * 1024 * 1024 * 1024 # 4 GiB
+BUILD_FLAG_VARS  = ['CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'platform']
+
+class ArtifactCache:
+    """
+    Cache of built libretro cores, addressed by everything that goes into a
+    build: the project and its commit, the platform, the compiler and the
+    build flags (including the build script itself). When the key of a
+    project is found, the cached cores are copied to dist/<platform> instead
+    of building the project again, e.g. after switching libretro-super
+    branches.
+    
+    The cache holds at most maxSize bytes; the least recently used cores are
+    evicted first. Hits and misses are counted for GetStats().
+    """
+    
+    @staticmethod
+    def GetDefaultDir():
+        return os.path.join(Environment.GetCacheDir(), ARTIFACT_DIR)
+    
+    @staticmethod
+    def _GetCompilerVersion(compiler):
+        try:
+            proc = subprocess.Popen([compiler, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+            return output.strip().split('\n')[0]
+        except OSError:
+            return None # Compiler isn't installed
+    
+    @staticmethod
+    def GetToolchainIdentity(scriptPath):
+        """
+        Identify everything besides the sources that affects a build: the
+        compilers' versions, the build flags in the environment and the
+        contents of the build script.
+        """
+        identity = {'platform': Environment.GetPlatform()}
+        
+        identity['compilers'] = [ArtifactCache._GetCompilerVersion(os.environ.get('CC', 'cc')),
+                                 ArtifactCache._GetCompilerVersion(os.environ.get('CXX', 'c++'))]
+        identity['flags'] = dict((var, os.environ.get(var)) for var in BUILD_FLAG_VARS)
+        
+        try:
+            with open(scriptPath, 'rb') as f:
+                identity['script'] = hashlib.sha256(f.read()).hexdigest()
+        except IOError:
+            identity['script'] = None
+        
+        return identity
+    
+    @staticmethod
+    def GetKey(projectName, commitHash, toolchainIdentity):
+        data = json.dumps([projectName, commitHash, toolchainIdentity], sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+    
+    def __init__(self, directory=None, maxSize=MAX_CACHE_SIZE):
+        self._dir     = directory or ArtifactCache.GetDefaultDir()
+        self._maxSize = maxSize
+        self._entries = { } # key -> {'files': [filename], 'size': bytes, 'used': time}
+        self._stats   = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        
+        data = loadJsonCache(os.path.join(self._dir, ARTIFACT_INDEX))
+        self._entries.update(data.get('entries', { }))
+        self._stats.update(data.get('stats', { }))
+    
+    def Save(self):
+        saveJsonCache(os.path.join(self._dir, ARTIFACT_INDEX), {'entries': self._entries, 'stats': self._stats})
+    
+    def _GetEntryDir(self, key):
+        return os.path.join(self._dir, key)
+    
+    def Restore(self, key, dllDir):
+        """
+        Copy the cores cached under key to dllDir. Returns the paths of the
+        restored cores, or None on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry:
+            entryDir = self._GetEntryDir(key)
+            if all([os.path.exists(os.path.join(entryDir, filename)) for filename in entry['files']]):
+                if not os.path.exists(dllDir):
+                    os.makedirs(dllDir)
+                
+                # Copy rather than link, a build writing to the core in place would change the cached core
+                paths = []
+                for filename in entry['files']:
+                    shutil.copy2(os.path.join(entryDir, filename), os.path.join(dllDir, filename))
+                    paths.append(os.path.join(dllDir, filename))
+                
+                entry['used'] = time.time()
+                self._stats['hits'] += 1
+                return paths
+            
+            self._Remove(key) # Files were deleted
+        
+        self._stats['misses'] += 1
+        return None
+    
+    def Store(self, key, paths):
+        """
+        Add the cores at paths to the cache under key.
+        """
+        entryDir = self._GetEntryDir(key)
+        if os.path.exists(entryDir):
+            shutil.rmtree(entryDir)
+        
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        
+        # Copy into a temporary directory first, so an entry is never incomplete
+        tempDir = tempfile.mkdtemp(dir=self._dir)
+        for path in paths:
+            shutil.copy2(path, os.path.join(tempDir, os.path.basename(path)))
+        os.rename(tempDir, entryDir)
+        
+        self._entries[key] = {
+            'files': [os.path.basename(path) for path in paths],
+            'size':  sum([os.path.getsize(path) for path in paths]),
+            'used':  time.time(),
+        }
+        self._stats['stores'] += 1
+        
+        self._Evict()
+    
+    def _Remove(self, key):
+        if os.path.exists(self._GetEntryDir(key)):
+            shutil.rmtree(self._GetEntryDir(key))
+        del self._entries[key]
+    
+    def _Evict(self):
+        """
+        Remove least recently used entries until the cache fits in maxSize.
+        """
+        size = self.GetSize()
+        for key in sorted(self._entries, key=lambda key: self._entries[key]['used']):
+            if size <= self._maxSize:
+                break
+            size -= self._entries[key]['size']
+            self._Remove(key)
+            self._stats['evictions'] += 1
+    
+    def GetSize(self):
+        return sum([entry['size'] for entry in self._entries.values()])
+    
+    def GetStats(self):
+        """
+        Get a dict of cache statistics: number of hits, misses, stores and
+        evictions, the hit rate, and the number and total size of entries.
+        """
+        stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['entries'] = len(self._entries)
+        stats['size'] = self.GetSize()
+        return stats
+    
+    def PrintStats(self):
+        stats = self.GetStats()
+        print('Artifact cache %s' % self._dir)
+        print('  Entries:   %d (%.1f MiB of %.1f MiB)' % (stats['entries'], stats['size'] / 1048576.0, self._maxSize / 1048576.0))
+        print('  Hits:      %d' % stats['hits'])
+        print('  Misses:    %d' % stats['misses'])
+        print('  Hit rate:  %.1f%%' % (stats['hit rate'] * 100))
+        print('  Stores:    %d' % stats['stores'])
+        print('  Evictions: %d' % stats['evictions'])
+
+class TestArtifactCache(TempDirTestCase):
+    def test_artifact_cache(self):
+        cacheDir = os.path.join(self._dir, ARTIFACT_DIR)
+        dllDir = os.path.join(self._dir, 'dist')
+        os.mkdir(dllDir)
+        
+        paths = []
+        for name in ['test1', 'test2', 'test3']:
+            paths.append(os.path.join(dllDir, name + '_libretro.so'))
+            with open(paths[-1], 'wb') as f:
+                f.write(os.urandom(1000))
+        
+        toolchain = {'platform': 'linux64', 'compilers': ['cc 4.8'], 'flags': { }, 'script': None}
+        keys = [ArtifactCache.GetKey(name, 'abcdef0', toolchain) for name in ['test1', 'test2', 'test3']]
+        self.assertNotEqual(keys[0], ArtifactCache.GetKey('test1', 'abcdef0', dict(toolchain, compilers=['cc 4.9'])))
+        
+        cache = ArtifactCache(cacheDir, 2500)
+        self.assertEqual(cache.Restore(keys[0], dllDir), None)
+        for key, path in zip(keys, paths):
+            cache.Store(key, [path])
+        cache.Save()
+        
+        # Least recently used core was evicted to stay under 2500 bytes
+        os.remove(paths[2])
+        cache = ArtifactCache(cacheDir, 2500)
+        self.assertEqual(cache.Restore(keys[0], dllDir), None)
+        self.assertEqual(cache.Restore(keys[2], dllDir), [paths[2]])
+        self.assertTrue(os.path.exists(paths[2]))
+        
+        stats = cache.GetStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['entries']), (1, 2, 1, 2))
+        self.assertEqual(stats['hit rate'], 1.0 / 3)
+
+if __name__ == '__main__':
+    unittest.main()
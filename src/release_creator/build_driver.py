@@ -0,0 +1,350 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from environment import Environment
+from libretro_dll import LIBRETRO_SUFFIX
+from utils import TempDirTestCase
+from utils import getSourcedScripts
+
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import subprocess
+import time
+import unittest
+
+BUILD_FUNCTION_PREFIX = 'build_libretro_'
+BUILD_LOG_DIR         = 'logs'
+BUILD_LOG_EXTENSION   = '.log'
+JOBSERVER_TOKEN       = b'+'
+
+# Build functions are defined as "build_libretro_name() {" or "build_libretro_name()\n{"
+BUILD_FUNCTION = re.compile(r'^\s*(?:function\s+)?' + BUILD_FUNCTION_PREFIX + r'(\w+)\s*\(\s*\)', re.MULTILINE)
+
+class BuildResult:
+    """
+    Outcome of building a single libretro-super project.
+    """
+    def __init__(self, projectName, success, duration, logPath, dlls):
+        self._projectName = projectName
+        self._success     = success
+        self._duration    = duration
+        self._logPath     = logPath
+        self._dlls        = dlls
+    
+    def GetProjectName(self):
+        return self._projectName
+    
+    def IsSuccess(self):
+        return self._success
+    
+    def GetDuration(self):
+        """
+        Wall-clock build time in seconds.
+        """
+        return self._duration
+    
+    def GetLogPath(self):
+        return self._logPath
+    
+    def GetDlls(self):
+        """
+        Paths of the libretro cores in dist/<platform> produced by the build.
+        """
+        return self._dlls
+
+class BuildDriver:
+    """
+    Builds libretro-super projects as separate jobs, several at a time. Each
+    job runs the build script with the project's build function as argument
+    (libretro-build.sh build_libretro_bsnes), so a failing core doesn't stop
+    the others and every core that builds lands in dist/<platform>.
+    
+    All jobs share a GNU make jobserver, which caps the number of compiler
+    processes across all jobs at makeJobs. Scripts that force make -jN opt
+    out of the jobserver, so JOBS is also set to each job's share of the cap.
+    """
+    
+    @staticmethod
+    def GetBuildFunctions(scriptPath):
+        """
+        Get the names of the projects that scriptPath has a build function for.
+        libretro-build.sh defines them in the scripts it sources, like
+        libretro-build-common.sh.
+        """
+        functions = set()
+        for path in getSourcedScripts(scriptPath):
+            with open(path) as f:
+                functions.update(BUILD_FUNCTION.findall(f.read()))
+        return functions
+    
+    @staticmethod
+    def GetFunctionName(projectName):
+        """
+        libretro-s9x-next is built by build_libretro_s9x_next.
+        """
+        return projectName.replace('-', '_')
+    
+    def __init__(self, libretroSuper, scriptName, buildJobs=1, makeJobs=None):
+        self._libretroSuper = libretroSuper
+        self._scriptPath    = os.path.join(libretroSuper.GetRepoDir(), scriptName)
+        self._buildJobs     = max(buildJobs, 1)
+        self._makeJobs      = max(makeJobs or multiprocessing.cpu_count(), self._buildJobs)
+        self._logDir        = os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), BUILD_LOG_DIR)
+        self._jobserver     = None
+    
+    def GetBuildableProjects(self, projects):
+        """
+        Split projects into those the build script can build individually and
+        those it can't.
+        """
+        functions = BuildDriver.GetBuildFunctions(self._scriptPath)
+        buildable = [p for p in projects if BuildDriver.GetFunctionName(p.GetName()) in functions]
+        unbuildable = [p for p in projects if BuildDriver.GetFunctionName(p.GetName()) not in functions]
+        return buildable, unbuildable
+    
+    def _OpenJobserver(self):
+        """
+        A jobserver is a pipe holding one token per extra job. Every make
+        joining it also has one implicit token, so the pipe holds makeJobs
+        minus the number of concurrent builds.
+        """
+        if Environment.GetPlatform() == Environment.WIN:
+            return # Jobserver fds can't be inherited on Windows
+        
+        self._jobserver = os.pipe()
+        for fd in self._jobserver:
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(fd, True) # Python 3
+        os.write(self._jobserver[1], JOBSERVER_TOKEN * (self._makeJobs - self._buildJobs))
+    
+    def _CloseJobserver(self):
+        if self._jobserver:
+            for fd in self._jobserver:
+                os.close(fd)
+            self._jobserver = None
+    
+    def _GetEnvironment(self):
+        env = dict(os.environ)
+        env['JOBS'] = str(max(self._makeJobs // self._buildJobs, 1))
+        if self._jobserver:
+            env['MAKEFLAGS'] = ' -j --jobserver-fds=%d,%d' % self._jobserver
+        return env
+    
+    def _GetCommand(self, projectName):
+        function = BUILD_FUNCTION_PREFIX + BuildDriver.GetFunctionName(projectName)
+        return Environment.GetScriptCommand(self._scriptPath) + [function]
+    
+    def _GetBuiltDlls(self, projectName, startTime):
+        """
+        Cores in dist/<platform> that were written since startTime and came
+        from projectName.
+        """
+        dllDir = self._libretroSuper.GetDllDir()
+        if not os.path.exists(dllDir):
+            return []
+        
+        dlls = []
+        for filename in sorted(os.listdir(dllDir)):
+            path = os.path.join(dllDir, filename)
+            if os.path.getmtime(path) < int(startTime):
+                continue
+            project = self._libretroSuper.GetProject(filename.split(LIBRETRO_SUFFIX)[0])
+            if project and project.GetName() == projectName:
+                dlls.append(path)
+        return dlls
+    
+    def _Build(self, projectName):
+        logPath = os.path.join(self._logDir, projectName + BUILD_LOG_EXTENSION)
+        startTime = time.time()
+        
+        with open(logPath, 'w') as log:
+            try:
+                proc = subprocess.Popen(self._GetCommand(projectName), cwd=os.path.dirname(self._scriptPath),
+                                        stdout=log, stderr=subprocess.STDOUT, env=self._GetEnvironment(), close_fds=False)
+                returnCode = proc.wait()
+            except OSError as e:
+                log.write('Failed to run %s: %s\n' % (self._scriptPath, e))
+                returnCode = -1
+        
+        duration = time.time() - startTime
+        dlls = self._GetBuiltDlls(projectName, startTime)
+        
+        # Build functions don't always fail when make fails, so also require a core
+        result = BuildResult(projectName, returnCode == 0 and len(dlls) > 0, duration, logPath, dlls)
+        if result.IsSuccess():
+            print('Built project %s in %.1fs: %s' % (projectName, duration, ', '.join([os.path.basename(dll) for dll in dlls])))
+        else:
+            print('Failed to build project %s after %.1fs, see %s' % (projectName, duration, logPath))
+        return result
+    
+    def Build(self, projects, history=None):
+        """
+        Build projects, at most buildJobs at a time. Returns a BuildResult for
+        each project, in the order they were started. If history (a
+        BuildHistory) is given, the projects that took longest to build last
+        time are started first, and the times of this build are saved to it.
+        """
+        if not os.path.exists(self._logDir):
+            os.makedirs(self._logDir)
+        
+        # Start the longest builds first so that one doesn't run alone at the end
+        if history:
+            projects = history.Sort(projects)
+        
+        projectNames = [project.GetName() for project in projects]
+        
+        # Workers match the cores they built to projects, don't let them race
+        # to create the resolver
+        self._libretroSuper.GetResolver()
+        
+        self._OpenJobserver()
+        try:
+            if self._buildJobs > 1:
+                pool = multiprocessing.pool.ThreadPool(self._buildJobs)
+                try:
+                    results = pool.map(self._Build, projectNames, 1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [self._Build(projectName) for projectName in projectNames]
+        finally:
+            self._CloseJobserver()
+        
+        succeeded = len([result for result in results if result.IsSuccess()])
+        print('Built %d of %d projects' % (succeeded, len(results)))
+        
+        # Failed builds often stop early, so only successful build times are recorded
+        if history:
+            for project, result in zip(projects, results):
+                if result.IsSuccess():
+                    history.Record(project.GetName(), project.GetVersionHash(), result.GetDuration())
+            history.Save()
+        
+        return results
+
+class TestBuildDriver(TempDirTestCase):
+    def test_get_build_functions(self):
+        scriptPath = os.path.join(self._dir, 'libretro-build.sh')
+        with open(scriptPath, 'w') as f:
+            f.write('build_libretro_bsnes() {\n' +
+                    '   echo bsnes\n' +
+                    '}\n' +
+                    'function build_libretro_s9x_next()\n' +
+                    '{\n' +
+                    '   build_libretro_generic_makefile s9x_next\n' +
+                    '}\n' +
+                    'build_libretro_generic_makefile s9x\n')
+        
+        self.assertEqual(BuildDriver.GetBuildFunctions(scriptPath), set(['bsnes', 's9x_next']))
+        self.assertEqual(BuildDriver.GetFunctionName('s9x-next'), 's9x_next')
+        
+        # Functions in sourced scripts are found too
+        with open(scriptPath, 'a') as f:
+            f.write('. "$BASE_DIR/libretro-build-common.sh"\n')
+        with open(os.path.join(self._dir, 'libretro-build-common.sh'), 'w') as f:
+            f.write('build_libretro_fceumm() {\n' +
+                    '   build_libretro_generic_makefile fceumm\n' +
+                    '}\n')
+        self.assertEqual(BuildDriver.GetBuildFunctions(scriptPath), set(['bsnes', 's9x_next', 'fceumm']))
+        self.assertEqual(BuildDriver.GetBuildFunctions(os.path.join(self._dir, 'missing.sh')), set())
+    
+    def test_build(self):
+        from build_history import BuildHistory
+        from build_history import BUILD_HISTORY
+        from libretro_project import LibretroProject
+        from project_resolver import ProjectResolver
+        
+        dllDir = os.path.join(self._dir, 'dist', 'unix')
+        os.makedirs(dllDir)
+        projects = []
+        for name in ['good', 'bad']:
+            projectDir = os.path.join(self._dir, LibretroProject.GetProjectNamePrefix() + name)
+            subprocess.check_call(['git', 'init', '-q', projectDir])
+            subprocess.check_call(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                                   'commit', '-q', '--allow-empty', '-m', name], cwd=projectDir)
+            projects.append(LibretroProject(projectDir))
+        
+        repoDir  = self._dir
+        resolver = ProjectResolver([project.GetName() for project in projects], { })
+        
+        # Stands in for LibretroSuper, with its repository in the test directory
+        class LibretroSuper:
+            def GetRepoDir(self):
+                return repoDir
+            
+            def GetDllDir(self):
+                return dllDir
+            
+            def GetResolver(self):
+                return resolver
+            
+            def GetProject(self, name):
+                for project in projects:
+                    if project.GetName() == resolver.Resolve(name):
+                        return project
+                return None
+        
+        # Like libretro-super, the build functions are in a sourced script
+        scriptPath = os.path.join(self._dir, 'libretro-build.sh')
+        with open(scriptPath, 'w') as f:
+            f.write('#!/bin/sh\n' +
+                    '. ./libretro-build-common.sh\n' +
+                    '"$1"\n')
+        os.chmod(scriptPath, 0o755)
+        with open(os.path.join(self._dir, 'libretro-build-common.sh'), 'w') as f:
+            f.write('build_libretro_good() {\n' +
+                    '   echo good > dist/unix/good_libretro.so\n' +
+                    '}\n' +
+                    'build_libretro_bad() {\n' +
+                    '   echo "bad: error" >&2\n' +
+                    '   return 1\n' +
+                    '}\n')
+        
+        # The slowest project last time is started first
+        historyPath = os.path.join(self._dir, BUILD_HISTORY)
+        history = BuildHistory(historyPath)
+        history.Record('good', projects[0].GetVersionHash(), 10.0)
+        history.Record('bad', projects[1].GetVersionHash(), 20.0)
+        
+        # One failing project doesn't stop the other
+        driver = BuildDriver(LibretroSuper(), 'libretro-build.sh', buildJobs=2)
+        driver._logDir = os.path.join(self._dir, BUILD_LOG_DIR)
+        self.assertEqual(driver.GetBuildableProjects(projects), (projects, []))
+        results = driver.Build(projects, history)
+        
+        self.assertEqual([result.GetProjectName() for result in results], ['bad', 'good'])
+        results.reverse()
+        self.assertTrue(results[0].IsSuccess())
+        self.assertEqual(results[0].GetDlls(), [os.path.join(dllDir, 'good_libretro.so')])
+        self.assertTrue(os.path.exists(os.path.join(dllDir, 'good_libretro.so')))
+        self.assertFalse(results[1].IsSuccess())
+        self.assertEqual(results[1].GetDlls(), [])
+        with open(results[1].GetLogPath()) as f:
+            self.assertEqual(f.read().strip(), 'bad: error')
+        
+        # Only the successful build's time is recorded
+        history = BuildHistory(historyPath)
+        self.assertEqual(history.GetEstimate('good', projects[0].GetVersionHash()), results[0].GetDuration())
+        self.assertEqual(history.GetEstimate('bad', projects[1].GetVersionHash()), 20.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from utils import TempDirTestCase
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import os
+import time
+import unittest
+
+BUILD_HISTORY       = 'build-history.json'
+MAX_BUILDS          = 5  # Builds remembered per project
+DEFAULT_BUILD_TIME  = 60 # Seconds, if no project has been built yet
+
+class BuildHistory:
+    """
+    Wall-clock build times of libretro-super projects, by project and commit
+    hash. Used to start the longest builds first: with a fixed number of
+    build jobs, a long build started last would leave the other jobs idle
+    while it finishes alone.
+    """
+    
+    def __init__(self, path):
+        self._path     = path
+        self._projects = { } # name -> {hash: [duration, time recorded]}
+        self._Load()
+    
+    def _Load(self):
+        self._projects.update(loadJsonCache(self._path).get('projects', { }))
+    
+    def Save(self):
+        saveJsonCache(self._path, {'projects': self._projects})
+    
+    def Record(self, name, versionHash, duration):
+        builds = self._projects.setdefault(name, { })
+        builds[versionHash] = [duration, time.time()]
+        
+        # Forget the oldest builds
+        if len(builds) > MAX_BUILDS:
+            for key in sorted(builds, key=lambda key: builds[key][1])[ : len(builds) - MAX_BUILDS]:
+                del builds[key]
+    
+    def _GetLatest(self, name):
+        builds = self._projects.get(name)
+        if not builds:
+            return None
+        return max(builds.values(), key=lambda build: build[1])[0]
+    
+    def GetEstimate(self, name, versionHash):
+        """
+        Estimate how long a project takes to build. The duration recorded for
+        the same commit is preferred, then the project's most recent build. A
+        project that was never built is assumed to take the median time of
+        the projects that were.
+        """
+        builds = self._projects.get(name, { })
+        if versionHash in builds:
+            return builds[versionHash][0]
+        
+        latest = self._GetLatest(name)
+        if latest is not None:
+            return latest
+        
+        durations = sorted([self._GetLatest(other) for other in self._projects if self._projects[other]])
+        if not durations:
+            return DEFAULT_BUILD_TIME
+        return durations[len(durations) // 2]
+    
+    def Sort(self, projects):
+        """
+        Order projects longest build first.
+        """
+        return sorted(projects, key=lambda project: self.GetEstimate(project.GetName(), project.GetVersionHash()), reverse=True)
+
+class TestBuildHistory(TempDirTestCase):
+    def test_build_history(self):
+        class Project:
+            def __init__(self, name, versionHash):
+                self._name = name
+                self._versionHash = versionHash
+            def GetName(self): return self._name
+            def GetVersionHash(self): return self._versionHash
+        
+        path = os.path.join(self._dir, BUILD_HISTORY)
+        history = BuildHistory(path)
+        self.assertEqual(history.GetEstimate('mame', 'abcdef0'), DEFAULT_BUILD_TIME)
+        
+        history.Record('mame', 'abcdef0', 3600.0)
+        history.Record('bnes', '1234567', 60.0)
+        history.Record('fceumm', '89abcde', 30.0)
+        history.Save()
+        
+        history = BuildHistory(path)
+        self.assertEqual(history.GetEstimate('mame', 'abcdef0'), 3600.0)
+        self.assertEqual(history.GetEstimate('mame', 'fedcba0'), 3600.0) # New commit
+        self.assertEqual(history.GetEstimate('gambatte', '7654321'), 60.0) # Median
+        
+        projects = [Project('fceumm', '89abcde'), Project('gambatte', '7654321'), Project('mame', 'fedcba0')]
+        self.assertEqual([project.GetName() for project in history.Sort(projects)], ['mame', 'gambatte', 'fceumm'])
+        
+        for i in range(MAX_BUILDS + 1):
+            history.Record('bnes', str(i), 60.0)
+        self.assertEqual(len(history._projects['bnes']), MAX_BUILDS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import SHA256
+from elf_file import ElfFile
+from environment import Environment
+from utils import getFileIdentity
+from utils import loadJsonCache
+from utils import saveJsonCache
+from zip_writer import CHUNK_SIZE
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+import zlib
+
+STRIP_DIR    = 'stripped'
+STRIP_INDEX  = 'index.json'
+STRIP_ARGS   = ['--strip-unneeded'] # Keeps the dynamic symbol table
+
+METHOD_STRIP  = 'strip'
+METHOD_PYTHON = 'python'
+
+class CoreStripper:
+    """
+    Strips copies of libretro cores before they are packaged, so the release
+    archives don't carry debug info and static symbol tables. The local
+    binutils strip ($STRIP, or strip) is used if it works, otherwise the
+    sections are dropped by ElfFile.WriteStripped().
+    
+    Stripped copies are kept in cache/<platform>/stripped, and a core is only
+    stripped again after it changed. The unstripped original is kept in
+    /symbols/<platform>/<build-id>/ for symbolicating crash reports. For each
+    core, the size and the time needed to deflate it are recorded before and
+    after stripping.
+    """
+    
+    @staticmethod
+    def _GetCompressionTime(path):
+        """
+        Time deflating the file like ZipWriter does.
+        """
+        startTime = time.time()
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                compressor.compress(data)
+        compressor.flush()
+        return time.time() - startTime
+    
+    def __init__(self, directory=None, symbolsDir=None, stripCommand=None):
+        self._dir          = directory or os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), STRIP_DIR)
+        self._symbolsDir   = symbolsDir or Environment.GetSymbolsDir()
+        self._stripCommand = stripCommand or os.environ.get('STRIP', 'strip')
+        self._entries      = { } # filename -> {'identity', 'method', 'symbols', 'sizes': [before, after], 'times': [before, after]}
+        
+        self._entries.update(loadJsonCache(os.path.join(self._dir, STRIP_INDEX)).get('cores', { }))
+    
+    def Save(self):
+        saveJsonCache(os.path.join(self._dir, STRIP_INDEX), {'cores': self._entries})
+    
+    def GetSymbolsPath(self, path):
+        """
+        Get the path the unstripped copy of the core at path is kept at.
+        """
+        buildId = ElfFile(path).GetBuildId() or DigestCache.GetInstance().GetDigest(path, SHA256)
+        return os.path.join(self._symbolsDir, buildId, os.path.basename(path))
+    
+    def _KeepSymbols(self, path):
+        """
+        Copy the unstripped core at path to /symbols, unless it's there
+        already. Returns the copy's path relative to the symbols directory.
+        """
+        symbolsPath = self.GetSymbolsPath(path)
+        if os.path.exists(symbolsPath):
+            return os.path.relpath(symbolsPath, self._symbolsDir)
+        
+        directory = os.path.dirname(symbolsPath)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        fd, tempPath = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        shutil.copy2(path, tempPath)
+        os.rename(tempPath, symbolsPath)
+        return os.path.relpath(symbolsPath, self._symbolsDir)
+    
+    def _RunStrip(self, path, outPath):
+        try:
+            proc = subprocess.Popen([self._stripCommand] + STRIP_ARGS + ['-o', outPath, path],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            proc.communicate()
+            return proc.returncode == 0
+        except OSError:
+            return False # binutils isn't installed
+    
+    def _PrintSavings(self, filename, entry):
+        before, after = entry['sizes']
+        print('Stripped %s with %s: %.2f MiB -> %.2f MiB (%d%% smaller), deflate %.2f s -> %.2f s' %
+              (filename, entry['method'], before / 1048576.0, after / 1048576.0,
+               100 * (before - after) // max(before, 1), entry['times'][0], entry['times'][1]))
+    
+    def Strip(self, path):
+        """
+        Get the path of a stripped copy of the core at path. Returns path
+        itself if the core isn't an ELF file, has nothing to strip or can't
+        be stripped.
+        """
+        filename = os.path.basename(path)
+        outPath = os.path.join(self._dir, filename)
+        identity = getFileIdentity(path)
+        
+        entry = self._entries.get(filename)
+        if entry and entry['identity'] == identity:
+            if not entry['method']:
+                return path
+            if os.path.exists(outPath):
+                # The symbols may have been cleaned up since
+                if not os.path.exists(os.path.join(self._symbolsDir, entry.get('symbols') or '')):
+                    entry['symbols'] = self._KeepSymbols(path)
+                self._PrintSavings(filename, entry)
+                return outPath
+        
+        elfFile = ElfFile(path)
+        if not elfFile.IsValid():
+            return path
+        
+        entry = {'identity': identity, 'method': None}
+        self._entries[filename] = entry
+        
+        if not elfFile.HasStrippableSections():
+            print('Core %s is already stripped' % filename)
+            return path
+        
+        entry['symbols'] = self._KeepSymbols(path)
+        
+        if not os.path.exists(self._dir):
+            os.makedirs(self._dir)
+        fd, tempPath = tempfile.mkstemp(dir=self._dir)
+        os.close(fd)
+        
+        if self._RunStrip(path, tempPath):
+            entry['method'] = METHOD_STRIP
+        elif elfFile.WriteStripped(tempPath):
+            entry['method'] = METHOD_PYTHON
+        else:
+            os.remove(tempPath)
+            print('Failed to strip %s, packaging it unstripped' % filename)
+            return path
+        
+        os.chmod(tempPath, os.stat(path).st_mode & 0o777)
+        os.rename(tempPath, outPath)
+        
+        entry['sizes'] = [os.path.getsize(path), os.path.getsize(outPath)]
+        entry['times'] = [CoreStripper._GetCompressionTime(path), CoreStripper._GetCompressionTime(outPath)]
+        self._PrintSavings(filename, entry)
+        
+        return outPath
+    
+    def StripDll(self, dll):
+        """
+        Strip the library of dll (a LibretroDll) and package the stripped copy
+        instead. Returns dll. Call Save() once all DLLs are stripped.
+        """
+        dll.SetPath(self.Strip(dll.GetPath()))
+        return dll
+    
+    def GetEntry(self, filename):
+        """
+        Get what is recorded about stripping the core called filename, so that
+        a worker process can hand it back to the parent's stripper.
+        """
+        return self._entries.get(filename)
+    
+    def RecordEntry(self, filename, entry):
+        if entry:
+            self._entries[filename] = entry
+    
+    def PrintTotals(self, filenames):
+        entries = [self._entries[filename] for filename in filenames if self._entries.get(filename, { }).get('method')]
+        if not entries:
+            return
+        before = sum([entry['sizes'][0] for entry in entries])
+        after = sum([entry['sizes'][1] for entry in entries])
+        savedTime = sum([entry['times'][0] - entry['times'][1] for entry in entries])
+        print('Stripping %d cores saved %.1f MiB (%d%%) and %.1f s of compression' %
+              (len(entries), (before - after) / 1048576.0, 100 * (before - after) // max(before, 1), savedTime))
+
+class TestCoreStripper(DigestCacheTestCase):
+    def _Compile(self, path):
+        """
+        Build a small shared library with debug info, if a compiler exists.
+        """
+        source = os.path.join(self._dir, 'core.c')
+        with open(source, 'w') as f:
+            f.write('int retro_api_version(void) { return 1; }\n')
+        try:
+            return subprocess.call(['cc', '-shared', '-fPIC', '-g', '-Wl,--build-id', '-o', path, source]) == 0
+        except OSError:
+            return False
+    
+    def test_core_stripper(self):
+        path = os.path.join(self._dir, 'test_libretro.so')
+        if not self._Compile(path):
+            return
+        
+        symbolsDir = os.path.join(self._dir, 'symbols')
+        buildId = ElfFile(path).GetBuildId()
+        
+        for method, stripCommand in [(METHOD_STRIP, None), (METHOD_PYTHON, os.path.join(self._dir, 'missing-strip'))]:
+            stripDir = os.path.join(self._dir, method)
+            stripper = CoreStripper(stripDir, symbolsDir, stripCommand)
+            strippedPath = stripper.Strip(path)
+            stripper.Save()
+            
+            if method == METHOD_STRIP and strippedPath == path:
+                continue # binutils isn't installed
+            
+            self.assertEqual(strippedPath, os.path.join(stripDir, 'test_libretro.so'))
+            self.assertEqual(stripper._entries['test_libretro.so']['method'], method)
+            self.assertTrue(os.path.getsize(strippedPath) < os.path.getsize(path))
+            
+            elfFile = ElfFile(strippedPath)
+            self.assertFalse(elfFile.HasStrippableSections())
+            self.assertEqual(elfFile.GetBuildId(), buildId)
+            self.assertTrue('retro_api_version' in elfFile.GetExportedSymbols())
+            
+            # Original is kept by build-id
+            symbolsPath = os.path.join(symbolsDir, buildId, 'test_libretro.so')
+            self.assertTrue(os.path.exists(symbolsPath))
+            
+            # Up to date copy is reused, and lost symbols are kept again
+            os.utime(strippedPath, (0, 0))
+            shutil.rmtree(symbolsDir)
+            self.assertEqual(CoreStripper(stripDir, symbolsDir, stripCommand).Strip(path), strippedPath)
+            self.assertEqual(os.stat(strippedPath).st_mtime, 0)
+            self.assertTrue(os.path.exists(symbolsPath))
+        
+        # Stripped cores are packaged as they are
+        self.assertEqual(CoreStripper(os.path.join(self._dir, 'again'), symbolsDir).Strip(strippedPath), strippedPath)
+
+if __name__ == '__main__':
+    unittest.main()
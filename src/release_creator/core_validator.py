@@ -0,0 +1,216 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from elf_file import ElfFile
+from elf_file import ET_DYN
+from environment import Environment
+from utils import TempDirTestCase
+from utils import getFileIdentity
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import os
+import platform
+import struct
+import unittest
+
+CORE_CACHE    = 'cores.json'
+CACHE_VERSION = 1
+
+# Functions libretro-extract and the game client look up in every core
+RETRO_SYMBOLS = [
+    'retro_set_environment', 'retro_set_video_refresh', 'retro_set_audio_sample',
+    'retro_set_audio_sample_batch', 'retro_set_input_poll', 'retro_set_input_state',
+    'retro_init', 'retro_deinit', 'retro_api_version', 'retro_get_system_info',
+    'retro_get_system_av_info', 'retro_set_controller_port_device', 'retro_reset',
+    'retro_run', 'retro_serialize_size', 'retro_serialize', 'retro_unserialize',
+    'retro_cheat_reset', 'retro_cheat_set', 'retro_load_game', 'retro_load_game_special',
+    'retro_unload_game', 'retro_get_region', 'retro_get_memory_data', 'retro_get_memory_size',
+]
+
+# e_machine of cores built for this machine, by (platform.machine(), 64-bit)
+ELF_MACHINES = {
+    ('x86_64',  True):  62,  # EM_X86_64
+    ('x86_64',  False): 3,   # EM_386 (32-bit Python on a 64-bit kernel)
+    ('i386',    False): 3,
+    ('i686',    False): 3,
+    ('aarch64', True):  183, # EM_AARCH64
+    ('armv7l',  False): 40,  # EM_ARM
+    ('armv6l',  False): 40,
+}
+
+class CoreValidator:
+    """
+    Checks that the files in dist/<platform> are complete libretro cores
+    before they are packaged, without loading them: the ELF header must
+    describe a shared library for this machine, all retro_* functions must
+    be exported and the symbol and dynamic sections must be readable (a
+    truncated build output fails here). The libraries each core needs
+    (DT_NEEDED) and its build-id are recorded too.
+    
+    Results are cached by the file's path and stat identity, so checking a
+    core that didn't change doesn't open it. Only ELF cores (Linux) are
+    checked; other platforms' cores are always accepted.
+    """
+    
+    _instance = None
+    
+    @staticmethod
+    def GetInstance():
+        if not CoreValidator._instance:
+            CoreValidator._instance = CoreValidator(os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), CORE_CACHE))
+        return CoreValidator._instance
+    
+    @staticmethod
+    def GetExpectedMachine():
+        """
+        Get the e_machine of cores for this machine, or None if unknown.
+        """
+        is64 = Environment.GetPlatform() == Environment.LINUX64
+        return ELF_MACHINES.get((platform.machine(), is64))
+    
+    @staticmethod
+    def Inspect(path, machine=None):
+        """
+        Read a core and get a dict describing it: 'error' is None if the core
+        is valid, otherwise the reason it isn't.
+        """
+        result = {'error': None, 'build-id': None, 'needed': []}
+        
+        elfFile = ElfFile(path)
+        if not elfFile.IsValid():
+            result['error'] = 'not an ELF file'
+            return result
+        
+        result['build-id'] = elfFile.GetBuildId()
+        
+        if elfFile.GetType() != ET_DYN:
+            result['error'] = 'not a shared library'
+        elif Environment.GetPlatform() in [Environment.LINUX32, Environment.LINUX64] and \
+             elfFile.Is64Bit() != (Environment.GetPlatform() == Environment.LINUX64):
+            result['error'] = 'built for %d-bit' % (64 if elfFile.Is64Bit() else 32)
+        elif machine is not None and elfFile.GetMachine() != machine:
+            result['error'] = 'built for another architecture (e_machine %d)' % elfFile.GetMachine()
+        else:
+            try:
+                symbols = elfFile.GetExportedSymbols()
+                result['needed'] = elfFile.GetNeeded()
+            except (IOError, ValueError, struct.error):
+                result['error'] = 'truncated or corrupt'
+                return result
+            
+            missing = [symbol for symbol in RETRO_SYMBOLS if symbol not in symbols]
+            if missing:
+                result['error'] = 'missing %s' % ', '.join(missing[ : 3]) + (' and %d more' % (len(missing) - 3) if len(missing) > 3 else '')
+        
+        return result
+    
+    def __init__(self, path):
+        self._path    = path
+        self._entries = { } # path -> result of Inspect() plus 'identity'
+        self._dirty   = False
+        
+        data = loadJsonCache(self._path)
+        if data.get('version') == CACHE_VERSION:
+            self._entries.update(data.get('cores', { }))
+    
+    def Save(self):
+        if not self._dirty:
+            return
+        
+        saveJsonCache(self._path, {'version': CACHE_VERSION, 'cores': self._entries})
+        self._dirty = False
+    
+    def _GetEntry(self, path):
+        key = os.path.abspath(path)
+        identity = getFileIdentity(path)
+        
+        entry = self._entries.get(key)
+        if not entry or entry['identity'] != identity:
+            entry = CoreValidator.Inspect(path, CoreValidator.GetExpectedMachine())
+            entry['identity'] = identity
+            self._entries[key] = entry
+            self._dirty = True
+        
+        return entry
+    
+    def Validate(self, path):
+        """
+        Check the core at path. Returns None if it is valid, otherwise the
+        reason it isn't.
+        """
+        if Environment.GetPlatform() not in [Environment.LINUX32, Environment.LINUX64]:
+            return None
+        return self._GetEntry(path)['error']
+    
+    def GetNeeded(self, path):
+        return self._GetEntry(path)['needed']
+
+class TestCoreValidator(TempDirTestCase):
+    def test_core_validator(self):
+        from elf_file import _CreateTestElf
+        
+        if Environment.GetPlatform() not in [Environment.LINUX32, Environment.LINUX64]:
+            return
+        
+        is64 = Environment.GetPlatform() == Environment.LINUX64
+        machine = CoreValidator.GetExpectedMachine() or 62
+        
+        good = os.path.join(self._dir, 'good_libretro.so')
+        _CreateTestElf(good, b'\x01' * 20, RETRO_SYMBOLS + ['other'], ['libc.so.6'], machine, is64)
+        partial = os.path.join(self._dir, 'partial_libretro.so')
+        _CreateTestElf(partial, b'\x02' * 20, RETRO_SYMBOLS[ : -1], [], machine, is64)
+        wrongArch = os.path.join(self._dir, 'arch_libretro.so')
+        _CreateTestElf(wrongArch, b'\x03' * 20, RETRO_SYMBOLS, [], machine + 1, is64)
+        truncated = os.path.join(self._dir, 'truncated_libretro.so')
+        with open(good, 'rb') as f:
+            data = f.read()
+        with open(truncated, 'wb') as f:
+            f.write(data[ : -20])
+        text = os.path.join(self._dir, 'readme.txt')
+        with open(text, 'w') as f:
+            f.write('Not a core')
+        
+        cachePath = os.path.join(self._dir, CORE_CACHE)
+        validator = CoreValidator(cachePath)
+        self.assertEqual(validator.Validate(good), None)
+        self.assertEqual(validator.GetNeeded(good), ['libc.so.6'])
+        self.assertEqual(validator.Validate(partial), 'missing retro_get_memory_size')
+        self.assertTrue(validator.Validate(wrongArch).startswith('built for another architecture'))
+        self.assertEqual(validator.Validate(text), 'not an ELF file')
+        self.assertEqual(validator.Validate(truncated), 'truncated or corrupt')
+        validator.Save()
+        
+        # Cached results are used while the file is unchanged
+        inspect = CoreValidator.Inspect
+        CoreValidator.Inspect = staticmethod(lambda path, machine: self.fail('%s was read again' % path))
+        try:
+            validator = CoreValidator(cachePath)
+            self.assertEqual(validator.Validate(good), None)
+            self.assertEqual(validator.Validate(partial), 'missing retro_get_memory_size')
+        finally:
+            CoreValidator.Inspect = staticmethod(inspect)
+        
+        with open(good, 'wb') as f:
+            f.write(b'\0' * 100)
+        os.utime(good, (0, 0))
+        self.assertEqual(validator.Validate(good), 'not an ELF file')
+
+if __name__ == '__main__':
+    unittest.main()
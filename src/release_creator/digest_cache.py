@@ -0,0 +1,328 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from environment import Environment
+from utils import FileLock
+from utils import TempDirTestCase
+from utils import getFileIdentity
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import hashlib
+import json
+import os
+import time
+import unittest
+import zlib
+
+DIGEST_CACHE   = '.digest-cache.json'
+CACHE_VERSION  = 1
+MAX_ENTRIES    = 4096 # About 1 MiB, entries are all the same size
+USED_INTERVAL  = 24 * 60 * 60 # Seconds before a hit is worth saving
+CHUNK_SIZE     = 1024 * 1024
+
+MD5    = 'md5'
+SHA256 = 'sha256'
+CRC32  = 'crc32'
+
+class DigestCache:
+    """
+    Persistent cache of file digests (MD5, SHA-256 and the CRC-32 used by zip
+    files). A digest is keyed by the file's path and is only trusted while the
+    file's inode, size and modification time (in nanoseconds) are unchanged.
+    The cache holds at most maxEntries files; the least recently used are
+    evicted first. Every entry has the same fields, so the number of entries
+    bounds the size of the file.
+    
+    The cache is stored in the release directory of the current platform so
+    that it follows the archives it describes. Changes are kept in memory
+    until Save() is called, once per add-on and at the end of a run. A hit
+    only records when the entry was used if that is older than USED_INTERVAL,
+    so runs with nothing to do don't write the cache.
+    """
+    
+    _instance = None
+    
+    @staticmethod
+    def GetInstance():
+        """
+        Get the cache shared by everything in this process.
+        """
+        if not DigestCache._instance:
+            DigestCache._instance = DigestCache(os.path.join(Environment.GetReleaseDir(), DIGEST_CACHE))
+        return DigestCache._instance
+    
+    @staticmethod
+    def _ComputeDigests(path, names):
+        """
+        Compute the requested digests in a single pass over the file.
+        """
+        hashes = { }
+        for name in names:
+            if name == MD5:
+                hashes[name] = hashlib.md5()
+            elif name == SHA256:
+                hashes[name] = hashlib.sha256()
+        crc = 0
+        
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                for h in hashes.values():
+                    h.update(data)
+                if CRC32 in names:
+                    crc = zlib.crc32(data, crc)
+        
+        digests = dict((name, h.hexdigest()) for name, h in hashes.items())
+        if CRC32 in names:
+            digests[CRC32] = crc & 0xffffffff
+        return digests
+    
+    def __init__(self, path, maxEntries=MAX_ENTRIES):
+        self._path       = path
+        self._maxEntries = maxEntries
+        self._entries    = { }
+        self._deleted    = { } # key -> identity of the stale entry
+        self._dirty      = False
+        self._Load()
+    
+    def _Load(self):
+        data = loadJsonCache(self._path)
+        if data.get('version') == CACHE_VERSION:
+            self._entries.update(data.get('files', { }))
+    
+    def Save(self):
+        """
+        Write the cache to disk if it changed. Entries saved by other
+        processes since the cache was loaded are merged in (the most recently
+        used entry wins), except for the stale entries removed here. Workers
+        save concurrently, so the merge is done under a lock, and the file is
+        replaced atomically so a crash never leaves a partial cache behind.
+        """
+        if not self._dirty:
+            return
+        
+        with FileLock(self._path + '.lock'):
+            entries = self._entries
+            self._entries = { }
+            self._Load()
+            for key, identity in self._deleted.items():
+                if key in self._entries and self._entries[key]['identity'] == identity:
+                    del self._entries[key]
+            for key, entry in entries.items():
+                if key not in self._entries or self._entries[key]['used'] <= entry['used']:
+                    self._entries[key] = entry
+            
+            # Evict least recently used entries
+            if len(self._entries) > self._maxEntries:
+                keys = sorted(self._entries, key=lambda key: self._entries[key]['used'])
+                for key in keys[ : len(keys) - self._maxEntries]:
+                    del self._entries[key]
+            
+            saveJsonCache(self._path, {'version': CACHE_VERSION, 'files': self._entries})
+        
+        self._deleted = { }
+        self._dirty = False
+    
+    def Lookup(self, path, name):
+        """
+        Get a cached digest of path without reading the file. Returns None if
+        the digest isn't cached or the file has changed since it was.
+        """
+        key = os.path.abspath(path)
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        
+        if entry['identity'] != getFileIdentity(path):
+            # Stale, and not to be merged back from disk
+            self._deleted[key] = entry['identity']
+            del self._entries[key]
+            self._dirty = True
+            return None
+        
+        now = time.time()
+        if now - entry['used'] > USED_INTERVAL:
+            entry['used'] = now
+            self._dirty = True
+        return entry['digests'].get(name)
+    
+    def Store(self, path, digests):
+        """
+        Remember digests (a dict of digest name to value) for the current
+        contents of path.
+        """
+        identity = getFileIdentity(path)
+        if identity is None:
+            return
+        
+        key = os.path.abspath(path)
+        entry = self._entries.get(key)
+        if not entry or entry['identity'] != identity:
+            entry = {'identity': identity, 'digests': { }}
+            self._entries[key] = entry
+        
+        entry['digests'].update(digests)
+        entry['used'] = time.time()
+        self._dirty = True
+    
+    def GetDigests(self, path, names):
+        """
+        Get the digests in names (MD5, SHA256 and/or CRC32) for the file at
+        path. Missing digests are computed in a single pass over the file and
+        added to the cache. Returns a dict of digest name to value.
+        """
+        digests = { }
+        for name in names:
+            digest = self.Lookup(path, name)
+            if digest is not None:
+                digests[name] = digest
+        
+        missing = [name for name in names if name not in digests]
+        if missing:
+            identity = getFileIdentity(path)
+            computed = DigestCache._ComputeDigests(path, missing)
+            
+            # Don't cache digests of a file that changed while it was read
+            if identity == getFileIdentity(path):
+                self.Store(path, computed)
+            
+            digests.update(computed)
+        
+        return digests
+    
+    def GetDigest(self, path, name):
+        return self.GetDigests(path, [name])[name]
+
+class DigestCacheTestCase(TempDirTestCase):
+    """
+    Base class of tests that use DigestCache.GetInstance(). The shared cache
+    is replaced with an empty one in the temporary directory, so tests never
+    read or write the cache in the release directory.
+    """
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        DigestCache._instance = DigestCache(os.path.join(self._dir, DIGEST_CACHE))
+    
+    def tearDown(self):
+        DigestCache._instance = None
+        TempDirTestCase.tearDown(self)
+
+class TestDigestCache(DigestCacheTestCase):
+    def test_digest_cache(self):
+        path = os.path.join(self._dir, 'test.bin')
+        with open(path, 'wb') as f:
+            f.write(b'Hello world')
+        
+        cachePath = os.path.join(self._dir, DIGEST_CACHE)
+        digestCache = DigestCache(cachePath)
+        self.assertEqual(digestCache.Lookup(path, MD5), None)
+        self.assertEqual(digestCache.GetDigest(path, MD5), hashlib.md5(b'Hello world').hexdigest())
+        self.assertEqual(digestCache.GetDigest(path, CRC32), zlib.crc32(b'Hello world') & 0xffffffff)
+        digestCache.Save()
+        
+        # Digests are loaded from disk by the next instance
+        digestCache = DigestCache(cachePath)
+        self.assertEqual(digestCache.Lookup(path, MD5), hashlib.md5(b'Hello world').hexdigest())
+        self.assertEqual(digestCache.Lookup(path, SHA256), None)
+        
+        # Modifying the file invalidates its digests
+        with open(path, 'wb') as f:
+            f.write(b'Hello world!')
+        self.assertEqual(digestCache.Lookup(path, MD5), None)
+        self.assertEqual(digestCache.GetDigest(path, MD5), hashlib.md5(b'Hello world!').hexdigest())
+    
+    def test_eviction(self):
+        cachePath = os.path.join(self._dir, DIGEST_CACHE)
+        digestCache = DigestCache(cachePath, maxEntries=2)
+        paths = [os.path.join(self._dir, 'test%d.bin' % i) for i in range(3)]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(path.encode('utf-8'))
+            digestCache.GetDigest(path, CRC32)
+        digestCache.Save()
+        
+        digestCache = DigestCache(cachePath, maxEntries=2)
+        self.assertEqual(digestCache.Lookup(paths[0], CRC32), None)
+        self.assertNotEqual(digestCache.Lookup(paths[2], CRC32), None)
+    
+    def test_save(self):
+        path = os.path.join(self._dir, 'test.bin')
+        with open(path, 'wb') as f:
+            f.write(b'Hello world')
+        
+        # Nothing is written until the cache is saved
+        cachePath = os.path.join(self._dir, DIGEST_CACHE)
+        digestCache = DigestCache(cachePath)
+        digestCache.GetDigest(path, MD5)
+        self.assertFalse(os.path.exists(cachePath))
+        digestCache.Save()
+        self.assertTrue(os.path.exists(cachePath))
+        
+        # A recent hit doesn't rewrite the cache
+        os.utime(cachePath, (0, 0))
+        digestCache = DigestCache(cachePath)
+        self.assertNotEqual(digestCache.Lookup(path, MD5), None)
+        digestCache.Save()
+        self.assertEqual(os.stat(cachePath).st_mtime, 0)
+        
+        # An old hit marks the entry as used
+        with open(cachePath) as f:
+            data = json.load(f)
+        data['files'][os.path.abspath(path)]['used'] -= 2 * USED_INTERVAL
+        with open(cachePath, 'w') as f:
+            json.dump(data, f)
+        digestCache = DigestCache(cachePath)
+        digestCache.Lookup(path, MD5)
+        digestCache.Save()
+        with open(cachePath) as f:
+            self.assertGreater(json.load(f)['files'][os.path.abspath(path)]['used'], time.time() - USED_INTERVAL)
+    
+    def test_merge(self):
+        paths = [os.path.join(self._dir, 'test%d.bin' % i) for i in range(2)]
+        for path in paths:
+            with open(path, 'wb') as f:
+                f.write(b'Hello world')
+        
+        # Each process keeps the entries the other one saved
+        cachePath = os.path.join(self._dir, DIGEST_CACHE)
+        digestCaches = [DigestCache(cachePath), DigestCache(cachePath)]
+        for digestCache, path in zip(digestCaches, paths):
+            digestCache.GetDigest(path, MD5)
+        for digestCache in digestCaches:
+            digestCache.Save()
+        digestCache = DigestCache(cachePath)
+        for path in paths:
+            self.assertNotEqual(digestCache.Lookup(path, MD5), None)
+        
+        # A stale entry isn't merged back from disk
+        with open(paths[0], 'wb') as f:
+            f.write(b'Hello world!')
+        self.assertEqual(digestCache.Lookup(paths[0], MD5), None)
+        digestCache.Save()
+        with open(cachePath) as f:
+            self.assertFalse(os.path.abspath(paths[0]) in json.load(f)['files'])
+    
+    def test_instance(self):
+        self.assertEqual(DigestCache.GetInstance()._path, os.path.join(self._dir, DIGEST_CACHE))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,450 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from utils import TempDirTestCase
+
+import binascii
+import os
+import struct
+import unittest
+
+ELF_MAGIC       = b'\x7fELF'
+ELFCLASS32      = 1
+ELFCLASS64      = 2
+ELFDATA2LSB     = 1
+ELFDATA2MSB     = 2
+ET_DYN          = 3
+PT_NOTE         = 4
+SHT_DYNSYM      = 11
+SHT_DYNAMIC     = 6
+SHT_NOTE        = 7
+SHT_NOBITS      = 8
+SHF_ALLOC       = 0x2
+SHN_UNDEF       = 0
+STB_GLOBAL      = 1
+STB_WEAK        = 2
+DT_NULL         = 0
+DT_NEEDED       = 1
+NT_GNU_BUILD_ID = 3
+GNU_NOTE_NAME   = b'GNU\0'
+
+# Sections that aren't needed to load a library: debug info and the static
+# symbol table (the dynamic symbol table stays)
+STRIPPABLE_PREFIXES = ['.debug', '.zdebug', '.gnu.debuglto_', '.symtab', '.strtab', '.stab']
+
+class ElfFile:
+    """
+    Minimal reader for ELF shared libraries (the libretro cores built on
+    Linux). Only the headers and note segments are read, so inspecting even
+    the largest cores is cheap. The dynamic symbol table and the libraries
+    the file depends on are read on first use.
+    """
+    
+    def __init__(self, path):
+        self._path    = path
+        self._isValid = False
+        self._buildId = None
+        self._symbols = None
+        self._needed  = None
+        
+        try:
+            with open(path, 'rb') as f:
+                self._Load(f)
+        except (IOError, OSError, struct.error):
+            self._isValid = False
+    
+    def _Load(self, f):
+        ident = f.read(16)
+        if len(ident) < 16 or ident[ : 4] != ELF_MAGIC:
+            return
+        
+        elfClass = ord(ident[4 : 5])
+        elfData  = ord(ident[5 : 6])
+        if elfClass not in [ELFCLASS32, ELFCLASS64] or elfData not in [ELFDATA2LSB, ELFDATA2MSB]:
+            return
+        
+        self._is64   = (elfClass == ELFCLASS64)
+        self._endian = '<' if elfData == ELFDATA2LSB else '>'
+        
+        if self._is64:
+            header = struct.unpack(self._endian + 'HHIQQQIHHHHHH', f.read(48))
+        else:
+            header = struct.unpack(self._endian + 'HHIIIIIHHHHHH', f.read(36))
+        
+        self._class     = elfClass
+        self._type      = header[0]
+        self._machine   = header[1]
+        self._phoff     = header[4]
+        self._shoff     = header[5]
+        self._phentsize = header[8]
+        self._phnum     = header[9]
+        self._shentsize = header[10]
+        self._shnum     = header[11]
+        self._shstrndx  = header[12]
+        
+        self._isValid = True
+        
+        # Look for the build-id in the note segments, falling back to note
+        # sections if the file has no program headers
+        for offset, size, align in self._GetNoteRanges(f):
+            f.seek(offset)
+            self._buildId = self._FindBuildId(f.read(size), align)
+            if self._buildId:
+                break
+    
+    def _GetNoteRanges(self, f):
+        ranges = []
+        
+        for i in range(self._phnum):
+            f.seek(self._phoff + i * self._phentsize)
+            if self._is64:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = struct.unpack(self._endian + 'IIQQQQQQ', f.read(56))
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align = struct.unpack(self._endian + 'IIIIIIII', f.read(32))
+            if p_type == PT_NOTE:
+                ranges.append((p_offset, p_filesz, p_align))
+        
+        if not ranges:
+            for sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize in self._GetSections(f):
+                if sh_type == SHT_NOTE:
+                    ranges.append((sh_offset, sh_size, sh_addralign))
+        
+        return ranges
+    
+    def _GetSections(self, f):
+        """
+        Get the header fields of each section, in the order of the ELF
+        specification (name, type, flags, addr, offset, size, link, info,
+        alignment, entry size).
+        """
+        sections = []
+        for i in range(self._shnum):
+            f.seek(self._shoff + i * self._shentsize)
+            if self._is64:
+                sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize = struct.unpack(self._endian + 'IIQQQQIIQQ', f.read(64))
+            else:
+                sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize = struct.unpack(self._endian + 'IIIIIIIIII', f.read(40))
+            sections.append((sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, sh_info, sh_addralign, sh_entsize))
+        return sections
+    
+    @staticmethod
+    def _ReadSection(f, section):
+        f.seek(section[4])
+        data = f.read(section[5])
+        if len(data) != section[5]:
+            raise IOError('Section extends past the end of the file')
+        return data
+    
+    @staticmethod
+    def _GetString(strtab, offset):
+        return strtab[offset : strtab.index(b'\0', offset)].decode('utf-8', 'replace')
+    
+    def _GetSegmentsEnd(self, f):
+        """
+        Get the file offset where the data loaded by the program headers ends.
+        """
+        end = 0
+        for i in range(self._phnum):
+            f.seek(self._phoff + i * self._phentsize)
+            if self._is64:
+                p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align = struct.unpack(self._endian + 'IIQQQQQQ', f.read(56))
+            else:
+                p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align = struct.unpack(self._endian + 'IIIIIIII', f.read(32))
+            end = max(end, p_offset + p_filesz)
+        return end
+    
+    def _GetStrippable(self, f, sections):
+        """
+        Get the indices of the sections that WriteStripped() leaves out.
+        """
+        if self._shstrndx >= len(sections):
+            return set()
+        shstrtab = ElfFile._ReadSection(f, sections[self._shstrndx])
+        
+        strippable = set()
+        for i, section in enumerate(sections):
+            if i == 0 or i == self._shstrndx or section[2] & SHF_ALLOC or section[1] == SHT_NOBITS:
+                continue
+            name = ElfFile._GetString(shstrtab, section[0])
+            if any([name.startswith(prefix) for prefix in STRIPPABLE_PREFIXES]):
+                strippable.add(i)
+        
+        # Keep sections that a remaining section links to
+        for i, section in enumerate(sections):
+            if i not in strippable:
+                strippable.discard(section[6])
+        
+        return strippable
+    
+    def HasStrippableSections(self):
+        """
+        Check if the library contains debug info or a static symbol table.
+        """
+        with open(self._path, 'rb') as f:
+            return len(self._GetStrippable(f, self._GetSections(f))) > 0
+    
+    def WriteStripped(self, outPath):
+        """
+        Write a copy of the library without debug info and the static symbol
+        table. The loaded part of the file is copied unchanged; the sections
+        after it are written again without the stripped ones, which become
+        empty SHT_NOBITS sections so that no section index changes. Returns
+        False, without writing anything, if the file isn't laid out that way.
+        """
+        if not self._isValid:
+            return False
+        
+        with open(self._path, 'rb') as f:
+            sections   = self._GetSections(f)
+            strippable = self._GetStrippable(f, sections)
+            
+            # Sections that aren't loaded, in file order
+            trailing = sorted([i for i in range(1, len(sections)) if not sections[i][2] & SHF_ALLOC and sections[i][1] != SHT_NOBITS],
+                              key=lambda i: sections[i][4])
+            if not trailing:
+                return False
+            
+            dataEnd = sections[trailing[0]][4]
+            if self._GetSegmentsEnd(f) > dataEnd or self._shoff < dataEnd:
+                return False
+            for section in sections:
+                if section[2] & SHF_ALLOC and section[1] != SHT_NOBITS and section[4] + section[5] > dataEnd:
+                    return False
+            
+            f.seek(0)
+            chunks = [f.read(dataEnd)]
+            pos = dataEnd
+            headers = list(sections)
+            
+            for i in trailing:
+                section = sections[i]
+                if i in strippable:
+                    headers[i] = section[ : 1] + (SHT_NOBITS,) + section[2 : 4] + (pos, 0) + section[6 : ]
+                    continue
+                padding = (-pos) % max(section[8], 1)
+                chunks.append(b'\0' * padding)
+                chunks.append(ElfFile._ReadSection(f, section))
+                headers[i] = section[ : 4] + (pos + padding, section[5]) + section[6 : ]
+                pos += padding + section[5]
+        
+        # Section header table goes last
+        padding = (-pos) % (8 if self._is64 else 4)
+        chunks.append(b'\0' * padding)
+        shoff = pos + padding
+        if self._is64:
+            chunks.extend([struct.pack(self._endian + 'IIQQQQIIQQ', *header) for header in headers])
+            chunks[0] = chunks[0][ : 0x28] + struct.pack(self._endian + 'Q', shoff) + chunks[0][0x30 : ]
+        else:
+            chunks.extend([struct.pack(self._endian + 'IIIIIIIIII', *header) for header in headers])
+            chunks[0] = chunks[0][ : 0x20] + struct.pack(self._endian + 'I', shoff) + chunks[0][0x24 : ]
+        
+        with open(outPath, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        
+        return True
+    
+    def _LoadDynamic(self):
+        """
+        Read the names of the symbols the library defines and the libraries
+        it needs (DT_NEEDED) from the .dynsym and .dynamic sections.
+        """
+        self._symbols = set()
+        self._needed  = []
+        
+        with open(self._path, 'rb') as f:
+            sections = self._GetSections(f)
+            for section in sections:
+                sh_type, sh_link = section[1], section[6]
+                if sh_type not in [SHT_DYNSYM, SHT_DYNAMIC] or sh_link >= len(sections):
+                    continue
+                
+                data   = ElfFile._ReadSection(f, section)
+                strtab = ElfFile._ReadSection(f, sections[sh_link])
+                
+                if sh_type == SHT_DYNSYM:
+                    entsize = section[9] or (24 if self._is64 else 16)
+                    for pos in range(entsize, len(data) - entsize + 1, entsize): # Entry 0 is reserved
+                        if self._is64:
+                            st_name, st_info, st_other, st_shndx, st_value, st_size = struct.unpack(self._endian + 'IBBHQQ', data[pos : pos + 24])
+                        else:
+                            st_name, st_value, st_size, st_info, st_other, st_shndx = struct.unpack(self._endian + 'IIIBBH', data[pos : pos + 16])
+                        if st_shndx != SHN_UNDEF and (st_info >> 4) in [STB_GLOBAL, STB_WEAK]:
+                            self._symbols.add(ElfFile._GetString(strtab, st_name))
+                else:
+                    entry = 'qQ' if self._is64 else 'iI'
+                    entsize = struct.calcsize(self._endian + entry)
+                    for pos in range(0, len(data) - entsize + 1, entsize):
+                        d_tag, d_val = struct.unpack(self._endian + entry, data[pos : pos + entsize])
+                        if d_tag == DT_NULL:
+                            break
+                        if d_tag == DT_NEEDED:
+                            self._needed.append(ElfFile._GetString(strtab, d_val))
+    
+    def _FindBuildId(self, notes, align):
+        # Notes are 4-byte aligned unless the segment asks for 8
+        align = 8 if align == 8 else 4
+        pad = lambda n: (n + align - 1) & ~(align - 1)
+        
+        pos = 0
+        while pos + 12 <= len(notes):
+            namesz, descsz, noteType = struct.unpack(self._endian + 'III', notes[pos : pos + 12])
+            pos += 12
+            name = notes[pos : pos + namesz]
+            pos += pad(namesz)
+            desc = notes[pos : pos + descsz]
+            pos += pad(descsz)
+            
+            if noteType == NT_GNU_BUILD_ID and name == GNU_NOTE_NAME:
+                return binascii.hexlify(desc).decode('ascii')
+        
+        return None
+    
+    def IsValid(self):
+        return self._isValid
+    
+    def GetPath(self):
+        return self._path
+    
+    def GetBuildId(self):
+        """
+        Get the GNU build-id as a hex string, or None if the library wasn't
+        linked with --build-id.
+        """
+        return self._buildId
+    
+    def Is64Bit(self):
+        return self._class == ELFCLASS64
+    
+    def GetType(self):
+        return self._type
+    
+    def GetMachine(self):
+        """
+        Get the e_machine field, e.g. 62 for x86-64.
+        """
+        return self._machine
+    
+    def GetExportedSymbols(self):
+        """
+        Get the set of global and weak symbols the library defines. Raises
+        IOError if the file is truncated.
+        """
+        if self._symbols is None:
+            self._LoadDynamic()
+        return self._symbols
+    
+    def GetNeeded(self):
+        """
+        Get the names of the libraries the library depends on (DT_NEEDED).
+        Raises IOError if the file is truncated.
+        """
+        if self._needed is None:
+            self._LoadDynamic()
+        return self._needed
+
+def _CreateTestElf(path, buildId, symbols=None, needed=None, machine=62, is64=True):
+    """
+    Write a stub little-endian ELF shared library containing only a header,
+    one PT_NOTE program header and a GNU build-id note. If symbols or needed
+    are given, .dynstr, .dynsym and .dynamic sections are added exporting
+    the symbols and needing the libraries.
+    """
+    symbols = symbols or []
+    needed  = needed or []
+    
+    note = struct.pack('<III', 4, len(buildId), NT_GNU_BUILD_ID) + GNU_NOTE_NAME + buildId
+    ehsize, phentsize, shentsize = (64, 56, 64) if is64 else (52, 32, 40)
+    noteOffset = ehsize + phentsize
+    
+    # String table, then symbols (entry 0 is reserved) and dynamic entries
+    dynstr = b'\0'
+    offsets = { }
+    for name in symbols + needed:
+        offsets[name] = len(dynstr)
+        dynstr += name.encode('utf-8') + b'\0'
+    
+    if is64:
+        dynsym = struct.pack('<IBBHQQ', 0, 0, 0, 0, 0, 0)
+        dynsym += b''.join([struct.pack('<IBBHQQ', offsets[name], (STB_GLOBAL << 4) | 2, 0, 1, 0, 0) for name in symbols])
+        dynamic = b''.join([struct.pack('<qQ', DT_NEEDED, offsets[name]) for name in needed]) + struct.pack('<qQ', DT_NULL, 0)
+    else:
+        dynsym = struct.pack('<IIIBBH', 0, 0, 0, 0, 0, 0)
+        dynsym += b''.join([struct.pack('<IIIBBH', offsets[name], 0, 0, (STB_GLOBAL << 4) | 2, 0, 1) for name in symbols])
+        dynamic = b''.join([struct.pack('<iI', DT_NEEDED, offsets[name]) for name in needed]) + struct.pack('<iI', DT_NULL, 0)
+    
+    dynstrOffset  = noteOffset + len(note)
+    dynsymOffset  = dynstrOffset + len(dynstr)
+    dynamicOffset = dynsymOffset + len(dynsym)
+    shoff         = dynamicOffset + len(dynamic)
+    
+    sections = []
+    if symbols or needed:
+        # (type, offset, size, link, entry size)
+        sections = [(0, 0, 0, 0, 0),
+                    (3, dynstrOffset, len(dynstr), 0, 0), # SHT_STRTAB
+                    (SHT_DYNSYM, dynsymOffset, len(dynsym), 1, 24 if is64 else 16),
+                    (SHT_DYNAMIC, dynamicOffset, len(dynamic), 1, 16 if is64 else 8)]
+    
+    elfClass = ELFCLASS64 if is64 else ELFCLASS32
+    header = ELF_MAGIC + struct.pack('<BBBB8x', elfClass, ELFDATA2LSB, 1, 0)
+    if is64:
+        header += struct.pack('<HHIQQQIHHHHHH', ET_DYN, machine, 1, 0, ehsize, shoff, 0, ehsize, phentsize, 1, shentsize, len(sections), 0)
+        phdr = struct.pack('<IIQQQQQQ', PT_NOTE, 4, noteOffset, 0, 0, len(note), len(note), 4)
+        shdrs = b''.join([struct.pack('<IIQQQQIIQQ', 0, t, 0, 0, o, n, l, 0, 1, e) for t, o, n, l, e in sections])
+    else:
+        header += struct.pack('<HHIIIIIHHHHHH', ET_DYN, machine, 1, 0, ehsize, shoff, 0, ehsize, phentsize, 1, shentsize, len(sections), 0)
+        phdr = struct.pack('<IIIIIIII', PT_NOTE, noteOffset, 0, 0, len(note), len(note), 4, 4)
+        shdrs = b''.join([struct.pack('<IIIIIIIIII', 0, t, 0, 0, o, n, l, 0, 1, e) for t, o, n, l, e in sections])
+    
+    with open(path, 'wb') as f:
+        f.write(header + phdr + note + dynstr + dynsym + dynamic + shdrs)
+
+class TestElfFile(TempDirTestCase):
+    def test_build_id(self):
+        path = os.path.join(self._dir, 'test_libretro.so')
+        _CreateTestElf(path, b'\x01\x23\x45\x67\x89\xab\xcd\xef\x01\x23\x45\x67\x89\xab\xcd\xef\x01\x23\x45\x67')
+        
+        elfFile = ElfFile(path)
+        self.assertTrue(elfFile.IsValid())
+        self.assertEqual(elfFile.GetBuildId(), '0123456789abcdef0123456789abcdef01234567')
+        self.assertEqual(elfFile.GetExportedSymbols(), set())
+    
+    def test_dynamic(self):
+        for is64 in [True, False]:
+            path = os.path.join(self._dir, 'test_libretro.so')
+            _CreateTestElf(path, b'\x01' * 20, ['retro_init', 'retro_run'], ['libc.so.6', 'libm.so.6'], 3, is64)
+            
+            elfFile = ElfFile(path)
+            self.assertTrue(elfFile.IsValid())
+            self.assertEqual((elfFile.Is64Bit(), elfFile.GetType(), elfFile.GetMachine()), (is64, ET_DYN, 3))
+            self.assertEqual(elfFile.GetExportedSymbols(), set(['retro_init', 'retro_run']))
+            self.assertEqual(elfFile.GetNeeded(), ['libc.so.6', 'libm.so.6'])
+    
+    def test_not_elf(self):
+        path = os.path.join(self._dir, 'test_libretro.dll')
+        with open(path, 'wb') as f:
+            f.write(b'MZ' + b'\0' * 100)
+        
+        elfFile = ElfFile(path)
+        self.assertFalse(elfFile.IsValid())
+        self.assertEqual(elfFile.GetBuildId(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,9 @@ SRC_DIR              = 'src'
 RELEASE_CREATOR_DIR  = 'release_creator'
 RELEASE_DIR          = 'release'
 LIBRETRO_EXTRACT_DIR = 'libretro-extract'
+CACHE_DIR            = 'cache'
+SYMBOLS_DIR          = 'symbols'
+SHELL_EXECUTABLE     = 'sh.exe'
 
 class Environment:
     WIN     = 'win32'
@@ -109,6 +112,22 @@ class Environment:
         else:
             return os.path.join(Environment.GetRootDir(), RELEASE_DIR, Environment.GetPlatform())
     
+    @staticmethod
+    def GetCacheDir():
+        """
+        Data cached between runs is stored in /cache. Everything in this
+        folder can be regenerated, so it is safe to delete.
+        """
+        return os.path.join(Environment.GetRootDir(), CACHE_DIR)
+    
+    @staticmethod
+    def GetSymbolsDir():
+        """
+        Unstripped libretro cores are kept in /symbols/platform, so crashes in
+        stripped cores can be symbolicated. Not part of the release.
+        """
+        return os.path.join(Environment.GetRootDir(), SYMBOLS_DIR, Environment.GetPlatform())
+    
     @staticmethod
     def GetDllExtension():
         if Environment.GetPlatform() == Environment.WIN:
@@ -142,27 +161,44 @@ class Environment:
         if not os.path.exists(path):
             return ''
         
-        os.chdir(path)
-        
+        # The process is run in path, this process stays where it is
         if Environment.GetPlatform() == Environment.WIN:
-            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=path)
         else:
-            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=path)
             
         output, err = proc.communicate()
         return output.strip()
     
+    @staticmethod
+    def FindExecutable(name):
+        """
+        Get the path of the executable called name in a directory on the PATH,
+        or None if there is none.
+        """
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        return None
+    
+    @staticmethod
+    def GetScriptCommand(script):
+        """
+        Get the command that runs a shell script from the script's directory.
+        Windows has no shell of its own, so scripts are run with the sh found
+        on the PATH (e.g. the bin directory of Git for Windows).
+        """
+        if Environment.GetPlatform() == Environment.WIN:
+            return [Environment.FindExecutable(SHELL_EXECUTABLE) or SHELL_EXECUTABLE, '--login', os.path.basename(script)]
+        return [os.path.abspath(script)]
+    
     @staticmethod
     def RunScript(script):
         dir = os.path.dirname(script)
         if os.path.exists(dir):
             os.chdir(dir)
-            
-            if Environment.GetPlatform() == Environment.WIN:
-                scriptName = os.path.split(script)[1]
-                subprocess.call(['C:\\Program Files (x86)\\Git\\bin\\sh.exe', '--login', scriptName]) # TODO
-            else:
-                subprocess.call(os.path.abspath(script))
+            subprocess.call(Environment.GetScriptCommand(script))
 
 class TestEnvironment(unittest.TestCase):
     def setUp(self):
@@ -176,6 +212,10 @@ class TestEnvironment(unittest.TestCase):
                                                       Environment.OSX64,
                                                       Environment.ANDROID])
     
+    def test_find_executable(self):
+        self.assertNotEqual(Environment.FindExecutable('python.exe' if Environment.GetPlatform() == Environment.WIN else 'sh'), None)
+        self.assertEqual(Environment.FindExecutable('no-such-executable'), None)
+    
     def test_get_root_dir(self):
         self.assertNotEqual(Environment.GetRootDir(), '')
         self.assertTrue(os.path.exists(Environment.GetRootDir()))
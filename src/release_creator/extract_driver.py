@@ -0,0 +1,365 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import SHA256
+from elf_file import ElfFile
+from environment import Environment
+from environment import LIBRETRO_EXTRACT_DIR
+from libretro_info import LibretroInfo
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import hashlib
+import multiprocessing.pool
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+EXTRACT_CACHE     = 'extract.json'
+EXTRACT_EXE       = 'libretro-extract'
+EXTRACT_TIMEOUT   = 60                       # Seconds per core
+EXTRACT_MEMORY    = 2 * 1024 * 1024 * 1024   # Bytes of address space per core
+REQUIRED_VALUE    = 'supported_extensions'   # Printed once the core was queried
+
+STATUS_OK         = 'ok'
+STATUS_CRASHED    = 'crashed'
+STATUS_TIMEOUT    = 'timeout'
+STATUS_FAILED     = 'failed'
+
+# Started in place of libretro-extract on POSIX systems. preexec_fn isn't safe
+# in a threaded parent, so the child starts its own session, limits itself and
+# then becomes libretro-extract: sys.argv is [-c, memory limit, executable, core]
+LIMIT_WRAPPER = '''
+import os, sys
+os.setsid()
+try:
+    import resource
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if int(sys.argv[1]):
+        resource.setrlimit(resource.RLIMIT_AS, (int(sys.argv[1]), int(sys.argv[1])))
+except ImportError:
+    pass
+os.execv(sys.argv[2], sys.argv[2 : ])
+'''
+
+class ExtractResult:
+    """
+    Metadata that libretro-extract reported for a core, and how the process
+    ended. A core that crashed after reporting its metadata (e.g. in
+    retro_deinit()) still counts as a success.
+    """
+    def __init__(self, status, returncode, values):
+        self._status     = status
+        self._returncode = returncode
+        self._values     = values
+    
+    def GetStatus(self):
+        return self._status
+    
+    def GetReturnCode(self):
+        return self._returncode
+    
+    def GetValues(self):
+        return self._values
+    
+    def IsSuccess(self):
+        return REQUIRED_VALUE in self._values
+    
+    def ToJson(self):
+        return {'status': self._status, 'returncode': self._returncode, 'values': self._values}
+    
+    @staticmethod
+    def FromJson(data):
+        values = data['values']
+        if bytes is str:
+            # Return str like the rest of the info values on Python 2
+            values = dict((name.encode('utf-8'), value.encode('utf-8')) for name, value in values.items())
+        return ExtractResult(data['status'], data['returncode'], values)
+
+class ExtractDriver:
+    """
+    Runs libretro-extract on libretro cores, one core per process, jobs
+    processes at a time. Each process runs in its own empty working directory
+    (which the core gets as its system and save directory), in a new session
+    so that a timeout kills everything it started, and with its address space
+    limited to memoryLimit bytes.
+    
+    Loading a core runs its code, and some cores crash or hang. A crash is
+    recorded for that core instead of stopping the extraction of the others.
+    Results, including crashes, are cached by the core's build-id (or SHA-256
+    if it has none), so a core is only loaded again after it changed or
+    libretro-extract was rebuilt.
+    """
+    
+    @staticmethod
+    def GetDefaultExecutable():
+        """
+        libretro-extract is built with CMake in /libretro-extract or in
+        /libretro-extract/build.
+        """
+        extractDir = os.path.join(Environment.GetRootDir(), LIBRETRO_EXTRACT_DIR)
+        for path in [os.path.join(extractDir, 'build', EXTRACT_EXE), os.path.join(extractDir, EXTRACT_EXE)]:
+            if os.path.exists(path):
+                return path
+        return None
+    
+    @staticmethod
+    def GetCoreKey(path):
+        buildId = ElfFile(path).GetBuildId()
+        if buildId:
+            return 'build-id:' + buildId
+        return 'sha256:' + DigestCache.GetInstance().GetDigest(path, SHA256)
+    
+    def __init__(self, executable=None, jobs=1, timeout=EXTRACT_TIMEOUT, memoryLimit=EXTRACT_MEMORY, cachePath=None):
+        self._executable  = executable or ExtractDriver.GetDefaultExecutable()
+        self._jobs        = max(jobs, 1)
+        self._timeout     = timeout
+        self._memoryLimit = memoryLimit
+        self._cachePath   = cachePath or os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), EXTRACT_CACHE)
+        self._results     = { } # core key -> ExtractResult JSON
+        self._extractor   = self._GetExtractorDigest()
+        
+        data = loadJsonCache(self._cachePath)
+        if data.get('extractor') == self._extractor:
+            self._results.update(data.get('cores', { }))
+    
+    def _GetExtractorDigest(self):
+        """
+        Results are only valid for the libretro-extract that produced them.
+        """
+        if not self._executable or not os.path.exists(self._executable):
+            return None
+        with open(self._executable, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    
+    def IsValid(self):
+        return self._extractor is not None
+    
+    def Save(self):
+        saveJsonCache(self._cachePath, {'extractor': self._extractor, 'cores': self._results})
+    
+    def _GetCommand(self, path):
+        command = [self._executable, os.path.abspath(path)]
+        if os.name == 'posix':
+            return [sys.executable, '-c', LIMIT_WRAPPER, str(self._memoryLimit or 0)] + command
+        return command # Windows: no sessions or memory limit
+    
+    def _Run(self, path):
+        workDir = tempfile.mkdtemp()
+        timedOut = [ ]
+        try:
+            try:
+                proc = subprocess.Popen(self._GetCommand(path), cwd=workDir,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except OSError:
+                return ExtractResult(STATUS_FAILED, None, { })
+            
+            def Kill():
+                timedOut.append(True)
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except (OSError, AttributeError):
+                    proc.kill()
+            
+            timer = threading.Timer(self._timeout, Kill)
+            timer.start()
+            try:
+                output = proc.communicate()[0].decode('utf-8', 'replace')
+            finally:
+                timer.cancel()
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        
+        values = LibretroInfo.Parse([line.strip() for line in output.splitlines()])
+        if bytes is str:
+            values = dict((name.encode('utf-8'), value.encode('utf-8')) for name, value in values.items())
+        
+        if timedOut:
+            status = STATUS_TIMEOUT
+        elif proc.returncode < 0:
+            status = STATUS_CRASHED # Killed by a signal
+        elif proc.returncode > 0:
+            status = STATUS_FAILED
+        else:
+            status = STATUS_OK
+        
+        return ExtractResult(status, proc.returncode, values)
+    
+    def _Extract(self, item):
+        path, key = item
+        result = self._Run(path)
+        
+        name = os.path.basename(path)
+        if result.GetStatus() == STATUS_OK:
+            print('Extracted metadata from %s' % name)
+        elif result.IsSuccess():
+            print('Extracted metadata from %s (libretro-extract %s afterwards)' % (name, result.GetStatus()))
+        else:
+            print('Failed to extract metadata from %s: %s (%s)' % (name, result.GetStatus(), result.GetReturnCode()))
+        
+        return result
+    
+    def Extract(self, paths):
+        """
+        Get a dict of core path to ExtractResult. Cores that weren't loaded
+        before are loaded in separate processes.
+        """
+        if not self.IsValid():
+            print('libretro-extract is not built, not extracting core metadata')
+            return { }
+        
+        keys = dict((path, ExtractDriver.GetCoreKey(path)) for path in paths)
+        
+        results = { }
+        missing = [ ]
+        for path in paths:
+            if keys[path] in self._results:
+                results[path] = ExtractResult.FromJson(self._results[keys[path]])
+            else:
+                missing.append((path, keys[path]))
+        
+        print('Extracting metadata from %d of %d cores' % (len(missing), len(paths)))
+        
+        if self._jobs > 1 and missing:
+            pool = multiprocessing.pool.ThreadPool(self._jobs)
+            try:
+                extracted = pool.map(self._Extract, missing, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            extracted = [self._Extract(item) for item in missing]
+        
+        for (path, key), result in zip(missing, extracted):
+            results[path] = result
+            self._results[key] = result.ToJson()
+        
+        if missing:
+            self.Save()
+        
+        return results
+    
+    @staticmethod
+    def CompareInfo(result, info):
+        """
+        Get the names of the values that a core reported differently from its
+        info file. Extensions are compared as sets, ignoring case.
+        """
+        mismatches = [ ]
+        for name, value in result.GetValues().items():
+            expected = info.GetValue(name, None)
+            if expected is None:
+                continue
+            if name == REQUIRED_VALUE:
+                if set(value.lower().split('|')) != set(expected.lower().split('|')):
+                    mismatches.append(name)
+            elif value != expected:
+                mismatches.append(name)
+        return sorted(mismatches)
+    
+    @staticmethod
+    def Check(results, infoIndex):
+        """
+        Report the cores that couldn't be loaded, including crashes cached by
+        earlier runs, and the cores that disagree with their info files.
+        Returns the paths of those cores.
+        """
+        problems = [ ]
+        for path in sorted(results):
+            result = results[path]
+            name = os.path.basename(path)
+            if not result.IsSuccess():
+                print('Core %s could not be loaded: %s (%s)' % (name, result.GetStatus(), result.GetReturnCode()))
+                problems.append(path)
+                continue
+            
+            info = infoIndex.GetInfo(os.path.splitext(name)[0])
+            mismatches = ExtractDriver.CompareInfo(result, info) if info.IsValid() else [ ]
+            if mismatches:
+                print('Info file %s disagrees with core %s: %s' % (os.path.basename(info.GetPath()), name, ', '.join(mismatches)))
+                problems.append(path)
+        return problems
+
+class TestExtractDriver(DigestCacheTestCase):
+    def test_extract_driver(self):
+        if os.name != 'posix':
+            return
+        
+        # Stand-in for libretro-extract, behaving according to the core's name
+        executable = os.path.join(self._dir, EXTRACT_EXE)
+        with open(executable, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "libretroCore: $(basename $1)"\n'
+                    'case "$1" in\n'
+                    '  *crash*) kill -SEGV $$ ;;\n'
+                    '  *hang*)  sleep 30 ;;\n'
+                    'esac\n'
+                    'echo \'supported_extensions = "nes|fds"\'\n'
+                    'case "$1" in\n'
+                    '  *deinit*) kill -SEGV $$ ;;\n'
+                    'esac\n'
+                    'echo \'need_fullpath = "false"\'\n')
+        os.chmod(executable, 0o755)
+        
+        paths = [ ]
+        for name in ['good', 'crash', 'hang', 'deinit']:
+            paths.append(os.path.join(self._dir, name + '_libretro.so'))
+            with open(paths[-1], 'w') as f:
+                f.write(name)
+        
+        cachePath = os.path.join(self._dir, EXTRACT_CACHE)
+        driver = ExtractDriver(executable, 4, timeout=1, cachePath=cachePath)
+        results = driver.Extract(paths)
+        self.assertEqual([results[path].GetStatus() for path in paths], [STATUS_OK, STATUS_CRASHED, STATUS_TIMEOUT, STATUS_CRASHED])
+        self.assertEqual([results[path].IsSuccess() for path in paths], [True, False, False, True])
+        self.assertEqual(results[paths[0]].GetValues(), {'supported_extensions': 'nes|fds', 'need_fullpath': 'false'})
+        
+        # Crashed cores and info files the cores disagree with are reported
+        from libretro_info import LibretroInfoIndex
+        infoDir = os.path.join(self._dir, 'info')
+        os.mkdir(infoDir)
+        with open(os.path.join(infoDir, 'good_libretro.info'), 'w') as f:
+            f.write('supported_extensions = "nes|fds"\nneed_fullpath = "true"\n')
+        with open(os.path.join(infoDir, 'deinit_libretro.info'), 'w') as f:
+            f.write('supported_extensions = "FDS|nes"\n')
+        problems = ExtractDriver.Check(results, LibretroInfoIndex(infoDir))
+        self.assertEqual(problems, sorted(paths[0 : 3]))
+        self.assertEqual(ExtractDriver.CompareInfo(results[paths[0]], LibretroInfoIndex(infoDir).GetInfo('good_libretro')), ['need_fullpath'])
+        
+        # Cached results, including crashes, are used without running libretro-extract
+        os.chmod(executable, 0o644)
+        results = ExtractDriver(executable, cachePath=cachePath).Extract(paths)
+        self.assertEqual([results[path].GetStatus() for path in paths], [STATUS_OK, STATUS_CRASHED, STATUS_TIMEOUT, STATUS_CRASHED])
+        
+        # A changed core is loaded again
+        with open(paths[1], 'w') as f:
+            f.write('good')
+        os.chmod(executable, 0o755)
+        results = ExtractDriver(executable, cachePath=cachePath).Extract(paths)
+        self.assertEqual(results[paths[1]].GetStatus(), STATUS_OK)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,366 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from git_repository import GitRepository
+from git_repository import GIT_DIRNAME
+from utils import TempDirTestCase
+from utils import getSourcedScripts
+
+import multiprocessing.pool
+import os
+import re
+import shutil
+import subprocess
+import time
+import unittest
+
+PROJECT_PREFIX   = 'libretro-'
+DEFAULT_VARS     = {'REPO_BASE': 'git://github.com'}
+BARE_EXTENSION   = '.git'
+
+# Projects are fetched by lines like: fetch_git "$REPO_BASE/libretro/bsnes-libretro.git" "libretro-bsnes" "libretro/bSNES"
+FETCH_CALL = re.compile(r'^\s*fetch_\w+\s+["\']?([^"\'\s]+)["\']?\s+["\']?(' + PROJECT_PREFIX + r'[^"\'\s]+)["\']?', re.MULTILINE)
+VARIABLE   = re.compile(r'\$\{?(\w+)\}?')
+ASSIGNMENT = re.compile(r'^\s*(?:export\s+)?(\w+)=["\']?([^"\'\s]*)["\']?\s*$', re.MULTILINE)
+
+class FetchResult:
+    """
+    Outcome of cloning or updating a single project.
+    """
+    def __init__(self, dirname, success, oldHead, newHead, duration):
+        self._dirname  = dirname
+        self._success  = success
+        self._oldHead  = oldHead
+        self._newHead  = newHead
+        self._duration = duration
+    
+    def GetDirname(self):
+        return self._dirname
+    
+    def IsSuccess(self):
+        return self._success
+    
+    def GetOldHead(self):
+        """
+        HEAD before fetching, or None if the project was cloned.
+        """
+        return self._oldHead
+    
+    def GetNewHead(self):
+        return self._newHead
+    
+    def IsChanged(self):
+        """
+        True if HEAD moved, i.e. the project needs to be built again.
+        """
+        return self._success and self._oldHead != self._newHead
+    
+    def GetDuration(self):
+        return self._duration
+
+class FetchDriver:
+    """
+    Clones and updates libretro-super projects, several at a time.
+    
+    Projects are found in the fetch script (libretro-fetch.sh) and in the
+    libretro-* directories already cloned (using their origin remote). New
+    projects can be cloned shallow (depth) or without blobs (filterBlobs,
+    blobs are fetched on demand). If referenceDir contains a bare repository
+    named after the project (libretro-bsnes.git), it is passed to git clone
+    --reference so that only missing objects are downloaded.
+    """
+    
+    @staticmethod
+    def _Expand(value, variables):
+        return VARIABLE.sub(lambda match: variables.get(match.group(1), match.group(0)), value)
+    
+    @staticmethod
+    def GetSources(repoDir, scriptPaths):
+        """
+        Get a dict of project directory name to remote URL. Projects are
+        listed in scriptPaths and the scripts they source. Variables used in
+        URLs (like $REPO_BASE) are taken from the environment or assignments
+        in those scripts.
+        """
+        paths = []
+        for scriptPath in scriptPaths:
+            paths.extend([path for path in getSourcedScripts(scriptPath) if path not in paths])
+        
+        variables = dict(DEFAULT_VARS)
+        scripts = []
+        for path in paths:
+            with open(path) as f:
+                scripts.append(f.read())
+            variables.update(dict(ASSIGNMENT.findall(scripts[-1])))
+        variables.update(os.environ)
+        
+        sources = { }
+        
+        # Projects cloned before, even if the script no longer lists them
+        if os.path.isdir(repoDir):
+            for dirname in os.listdir(repoDir):
+                if dirname.startswith(PROJECT_PREFIX) and os.path.exists(os.path.join(repoDir, dirname, GIT_DIRNAME)):
+                    url = GitRepository(os.path.join(repoDir, dirname)).GetRemoteUrl()
+                    if url:
+                        sources[dirname] = url
+        
+        for script in scripts:
+            for url, dirname in FETCH_CALL.findall(script):
+                sources[dirname] = FetchDriver._Expand(url, variables)
+        
+        return sources
+    
+    def __init__(self, repoDir, jobs=1, depth=None, filterBlobs=False, referenceDir=None, logDir=None):
+        self._repoDir      = repoDir
+        self._jobs         = max(jobs, 1)
+        self._depth        = depth
+        self._filterBlobs  = filterBlobs
+        self._referenceDir = referenceDir
+        self._logDir       = logDir
+    
+    def _GetRemote(self, url):
+        """
+        git ignores --depth and --filter for local paths, unless given as a
+        file:// URL.
+        """
+        if (self._depth or self._filterBlobs) and os.path.isdir(url):
+            return 'file://' + os.path.abspath(url)
+        return url
+    
+    def GetCloneCommand(self, url, path):
+        args = ['git', 'clone']
+        if self._depth:
+            args.append('--depth=%d' % self._depth)
+        if self._filterBlobs:
+            args.append('--filter=blob:none')
+        if self._referenceDir:
+            reference = os.path.join(self._referenceDir, os.path.basename(path) + BARE_EXTENSION)
+            if os.path.isdir(reference):
+                args.extend(['--reference', reference])
+        args.extend([self._GetRemote(url), path])
+        return args
+    
+    def GetUpdateCommand(self):
+        args = ['git', 'pull', '--ff-only']
+        if self._depth:
+            args.append('--depth=%d' % self._depth)
+        return args
+    
+    def _GetRemoteHead(self, source):
+        """
+        Get the commit that a fetch of the project would check out: the tip of
+        the remote branch with the same name as the local branch, or the
+        remote's HEAD. Returns None if the remote can't be reached.
+        """
+        dirname, url = source
+        branch = GitRepository(os.path.join(self._repoDir, dirname)).GetBranch()
+        refs = ['HEAD'] + (['refs/heads/' + branch] if branch else [])
+        
+        env = dict(os.environ)
+        env['GIT_TERMINAL_PROMPT'] = '0' # Fail instead of asking for credentials
+        try:
+            proc = subprocess.Popen(['git', 'ls-remote', url] + refs, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = proc.communicate()[0].decode('ascii', 'replace')
+        except OSError:
+            return None # git isn't installed
+        if proc.returncode != 0:
+            return None
+        
+        heads = dict(reversed(line.split('\t', 1)) for line in output.splitlines() if '\t' in line)
+        for ref in reversed(refs):
+            if ref in heads:
+                return heads[ref]
+        return None
+    
+    def GetStaleSources(self, sources, projects):
+        """
+        Check which projects have new commits upstream, without fetching
+        them. The remotes are queried with git ls-remote, jobs at a time, and
+        compared with the HEADs of projects (LibretroProject objects). Returns
+        the subset of sources that needs to be fetched: projects that have
+        moved upstream, haven't been cloned yet or whose remote couldn't be
+        queried (so that the fetch reports the error).
+        """
+        localHeads = dict((PROJECT_PREFIX + project.GetName(), project.GetCommitHash()) for project in projects)
+        
+        items = sorted([item for item in sources.items() if item[0] in localHeads])
+        if self._jobs > 1 and items:
+            pool = multiprocessing.pool.ThreadPool(self._jobs)
+            try:
+                remoteHeads = pool.map(self._GetRemoteHead, items, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            remoteHeads = [self._GetRemoteHead(item) for item in items]
+        
+        stale = dict((dirname, url) for dirname, url in sources.items() if dirname not in localHeads)
+        for (dirname, url), remoteHead in zip(items, remoteHeads):
+            if remoteHead != localHeads[dirname]:
+                stale[dirname] = url
+        
+        print('%d of %d projects changed upstream' % (len(stale), len(sources)))
+        
+        return stale
+    
+    def _Fetch(self, source):
+        dirname, url = source
+        path = os.path.join(self._repoDir, dirname)
+        startTime = time.time()
+        
+        if os.path.exists(os.path.join(path, GIT_DIRNAME)):
+            oldHead = GitRepository(path).GetHead()
+            args, cwd = self.GetUpdateCommand(), path
+        else:
+            oldHead = None
+            args, cwd = self.GetCloneCommand(url, path), self._repoDir
+        
+        log = open(os.path.join(self._logDir, 'fetch-%s.log' % dirname), 'w') if self._logDir else None
+        try:
+            proc = subprocess.Popen(args, cwd=cwd, stdout=log or subprocess.PIPE, stderr=subprocess.STDOUT)
+            proc.communicate()
+            success = (proc.returncode == 0)
+        except OSError:
+            success = False # git isn't installed
+        finally:
+            if log:
+                log.close()
+        
+        newHead = GitRepository(path).GetHead() if success else oldHead
+        result = FetchResult(dirname, success, oldHead, newHead, time.time() - startTime)
+        
+        if not success:
+            print('Failed to fetch project %s from %s' % (dirname, url))
+        elif oldHead is None:
+            print('Cloned project %s at %s' % (dirname, newHead[ : 7]))
+        elif result.IsChanged():
+            print('Updated project %s from %s to %s' % (dirname, oldHead[ : 7], newHead[ : 7]))
+        else:
+            print('Project %s is up to date' % dirname)
+        
+        return result
+    
+    def Fetch(self, sources):
+        """
+        Clone or update projects, at most jobs at a time. sources is a dict of
+        project directory name to remote URL. Returns a FetchResult for each
+        project, sorted by directory name.
+        """
+        if self._logDir and not os.path.exists(self._logDir):
+            os.makedirs(self._logDir)
+        
+        items = sorted(sources.items())
+        if self._jobs > 1:
+            pool = multiprocessing.pool.ThreadPool(self._jobs)
+            try:
+                results = pool.map(self._Fetch, items, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._Fetch(item) for item in items]
+        
+        changed = len([result for result in results if result.IsChanged()])
+        failed = len([result for result in results if not result.IsSuccess()])
+        print('Fetched %d projects: %d changed, %d failed' % (len(results), changed, failed))
+        
+        return results
+
+class TestFetchDriver(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self._remoteDir = os.path.join(self._dir, 'remotes')
+        self._repoDir = os.path.join(self._dir, 'libretro-super')
+        os.mkdir(self._remoteDir)
+        os.mkdir(self._repoDir)
+    
+    def _Git(self, cwd, args):
+        env = dict(os.environ)
+        env.update({'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+                    'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com'})
+        proc = subprocess.Popen(['git'] + args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.communicate()[0].decode('ascii').strip()
+    
+    def _Commit(self, name, text):
+        """
+        Add a commit to the bare repository remotes/name.git.
+        """
+        remote = os.path.join(self._remoteDir, name + BARE_EXTENSION)
+        if not os.path.exists(remote):
+            self._Git(self._dir, ['init', '-q', '--bare', remote])
+        work = os.path.join(self._dir, 'work-' + name)
+        if not os.path.exists(work):
+            self._Git(self._dir, ['clone', '-q', remote, work])
+        with open(os.path.join(work, 'file'), 'w') as f:
+            f.write(text)
+        self._Git(work, ['add', 'file'])
+        self._Git(work, ['commit', '-q', '-m', text])
+        self._Git(work, ['push', '-q', 'origin', 'HEAD:master'])
+        self._Git(remote, ['symbolic-ref', 'HEAD', 'refs/heads/master'])
+        return self._Git(work, ['rev-parse', 'HEAD'])
+    
+    def test_fetch_driver(self):
+        from libretro_project import LibretroProject
+        
+        self._Commit('bnes', 'bnes 1')
+        self._Commit('fceumm', 'fceumm 1')
+        
+        # Projects are also listed in sourced scripts
+        scriptPath = os.path.join(self._repoDir, 'libretro-fetch.sh')
+        with open(scriptPath, 'w') as f:
+            f.write('REPO_BASE="%s"\n' % self._remoteDir +
+                    'fetch_git "$REPO_BASE/bnes.git" "libretro-bnes" "libretro/bnes"\n' +
+                    '. "$BASE_DIR/libretro-fetch-rules.sh"\n')
+        with open(os.path.join(self._repoDir, 'libretro-fetch-rules.sh'), 'w') as f:
+            f.write('fetch_git "${REPO_BASE}/fceumm.git" "libretro-fceumm" "libretro/fceumm"\n')
+        
+        sources = FetchDriver.GetSources(self._repoDir, [scriptPath])
+        self.assertEqual(sources, {'libretro-bnes': os.path.join(self._remoteDir, 'bnes.git'),
+                                   'libretro-fceumm': os.path.join(self._remoteDir, 'fceumm.git')})
+        
+        # Clone (shallow)
+        results = FetchDriver(self._repoDir, 2, depth=1).Fetch(sources)
+        self.assertEqual([(r.GetDirname(), r.IsSuccess(), r.IsChanged()) for r in results],
+                         [('libretro-bnes', True, True), ('libretro-fceumm', True, True)])
+        self.assertTrue(os.path.exists(os.path.join(self._repoDir, 'libretro-bnes', GIT_DIRNAME, 'shallow')))
+        
+        # Update: only bnes moved
+        head = self._Commit('bnes', 'bnes 2')
+        projects = [LibretroProject(os.path.join(self._repoDir, dirname)) for dirname in ['libretro-bnes', 'libretro-fceumm']]
+        driver = FetchDriver(self._repoDir, 2)
+        self.assertEqual(sorted(driver.GetStaleSources(sources, projects)), ['libretro-bnes'])
+        self.assertEqual(sorted(driver.GetStaleSources(sources, projects[ : 1])), ['libretro-bnes', 'libretro-fceumm'])
+        self.assertEqual(sorted(driver.GetStaleSources({'libretro-fceumm': os.path.join(self._dir, 'missing.git')}, projects)), ['libretro-fceumm'])
+        
+        results = driver.Fetch(FetchDriver.GetSources(self._repoDir, []))
+        self.assertEqual([(r.GetDirname(), r.IsChanged()) for r in results],
+                         [('libretro-bnes', True), ('libretro-fceumm', False)])
+        self.assertEqual(results[0].GetNewHead(), head)
+        
+        # Clone using a local mirror
+        os.rename(os.path.join(self._remoteDir, 'fceumm.git'), os.path.join(self._remoteDir, 'libretro-fceumm.git'))
+        shutil.rmtree(os.path.join(self._repoDir, 'libretro-fceumm'))
+        driver = FetchDriver(self._repoDir, referenceDir=self._remoteDir)
+        self.assertTrue('--reference' in driver.GetCloneCommand('git://example.com/fceumm.git', os.path.join(self._repoDir, 'libretro-fceumm')))
+        results = driver.Fetch({'libretro-fceumm': os.path.join(self._remoteDir, 'libretro-fceumm.git')})
+        self.assertTrue(results[0].IsSuccess())
+        self.assertTrue(os.path.exists(os.path.join(self._repoDir, 'libretro-fceumm', GIT_DIRNAME, 'objects', 'info', 'alternates')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,446 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from utils import TempDirTestCase
+
+import binascii
+import os
+import re
+import struct
+import subprocess
+import unittest
+import zlib
+
+GIT_DIRNAME     = '.git'
+GITDIR_PREFIX   = 'gitdir:'
+SYMREF_PREFIX   = 'ref:'
+HEADS_PREFIX    = 'refs/heads/'
+PACK_IDX_MAGIC  = b'\377tOc'
+MAX_SYMREF_DEPTH = 5
+
+# Pack entry types (types 6 and 7 are deltas)
+OBJ_COMMIT = 1
+OBJ_TREE   = 2
+OBJ_BLOB   = 3
+OBJ_TAG    = 4
+OBJ_TYPES  = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob', OBJ_TAG: 'tag'}
+
+SHA1_HEX = re.compile('^[0-9a-f]{40}$')
+
+class GitRepository:
+    """
+    Reads refs and commits straight from a repository's .git directory, so
+    inspecting a repository doesn't require running git. HEAD, loose refs and
+    packed-refs are resolved directly. Objects are read from loose objects or,
+    if they aren't deltified, from the packfiles. Anything else (deltified
+    objects, alternates, SHA-256 repositories) is looked up by a single
+    `git cat-file --batch` process, started on first use and kept running
+    until Close().
+    """
+    
+    @staticmethod
+    def _FindGitDir(path):
+        """
+        Find the git directory the way git does: look for .git in path and its
+        parents. .git may also be a file pointing to the git directory
+        (submodules and worktrees). Returns None if path isn't in a repository.
+        """
+        path = os.path.abspath(path)
+        while True:
+            gitPath = os.path.join(path, GIT_DIRNAME)
+            if os.path.isdir(gitPath):
+                return gitPath
+            if os.path.isfile(gitPath):
+                with open(gitPath) as f:
+                    line = f.readline().strip()
+                if line.startswith(GITDIR_PREFIX):
+                    return os.path.normpath(os.path.join(path, line[len(GITDIR_PREFIX) : ].strip()))
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+    
+    def __init__(self, path):
+        self._path       = path
+        self._gitDir     = GitRepository._FindGitDir(path) if os.path.exists(path) else None
+        self._commonDir  = self._gitDir
+        self._packedRefs = None
+        self._packs      = None
+        self._catFile    = None
+        
+        # Refs and objects of a worktree are kept in the main repository
+        if self._gitDir:
+            try:
+                with open(os.path.join(self._gitDir, 'commondir')) as f:
+                    self._commonDir = os.path.normpath(os.path.join(self._gitDir, f.read().strip()))
+            except IOError:
+                pass
+    
+    def IsValid(self):
+        return self._gitDir is not None
+    
+    def GetGitDir(self):
+        return self._gitDir
+    
+    def Close(self):
+        """
+        Stop the `git cat-file` process, if one was started.
+        """
+        if self._catFile:
+            self._catFile.stdin.close()
+            self._catFile.wait()
+            self._catFile = None
+    
+    def _ReadRefFile(self, name):
+        # Per-worktree refs (HEAD) live in the git directory, the rest in the common directory
+        for directory in [self._gitDir, self._commonDir]:
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    return f.read().strip()
+            except IOError:
+                pass
+        return None
+    
+    def _GetPackedRefs(self):
+        if self._packedRefs is None:
+            self._packedRefs = { }
+            try:
+                with open(os.path.join(self._commonDir, 'packed-refs')) as f:
+                    for line in f:
+                        # Skip the header and peeled tags (^<hash>)
+                        if line.startswith('#') or line.startswith('^'):
+                            continue
+                        parts = line.split()
+                        if len(parts) == 2:
+                            self._packedRefs[parts[1]] = parts[0]
+            except IOError:
+                pass
+        return self._packedRefs
+    
+    def _ReadSymbolicRef(self, name):
+        """
+        Get the ref that name points to, or None if name isn't a symbolic ref.
+        """
+        value = self._ReadRefFile(name)
+        if value and value.startswith(SYMREF_PREFIX):
+            return value[len(SYMREF_PREFIX) : ].strip()
+        return None
+    
+    def ResolveRef(self, name):
+        """
+        Get the object name (hex hash) that a ref like HEAD or refs/heads/master
+        points to, following symbolic refs. Returns None if the ref doesn't
+        exist (e.g. HEAD of a repository without commits).
+        """
+        if not self.IsValid():
+            return None
+        
+        for _ in range(MAX_SYMREF_DEPTH):
+            value = self._ReadRefFile(name)
+            if value is None:
+                return self._GetPackedRefs().get(name)
+            if not value.startswith(SYMREF_PREFIX):
+                return value
+            name = value[len(SYMREF_PREFIX) : ].strip()
+        
+        return None
+    
+    def GetHead(self):
+        return self.ResolveRef('HEAD')
+    
+    def GetBranch(self):
+        """
+        Get the name of the checked out branch, or 'HEAD' if HEAD is detached
+        (the same as `git rev-parse --abbrev-ref HEAD`).
+        """
+        if not self.IsValid():
+            return None
+        ref = self._ReadSymbolicRef('HEAD')
+        if ref is None:
+            return 'HEAD' if self.GetHead() else None
+        if ref.startswith(HEADS_PREFIX):
+            return ref[len(HEADS_PREFIX) : ]
+        return ref
+    
+    def GetRemoteUrl(self, remote='origin'):
+        """
+        Get the URL of a remote from the repository's config, or None if the
+        remote isn't configured.
+        """
+        if not self.IsValid():
+            return None
+        
+        section = '[remote "%s"]' % remote
+        inSection = False
+        try:
+            with open(os.path.join(self._commonDir, 'config')) as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('['):
+                        inSection = (line == section)
+                    elif inSection and '=' in line:
+                        key, _, value = line.partition('=')
+                        if key.strip() == 'url':
+                            return value.strip()
+        except IOError:
+            pass
+        return None
+    
+    def _ReadLooseObject(self, sha):
+        try:
+            with open(os.path.join(self._commonDir, 'objects', sha[ : 2], sha[2 : ]), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (IOError, zlib.error):
+            return None
+        
+        header, _, content = data.partition(b'\0')
+        objType = header.split(b' ')[0].decode('ascii')
+        return objType, content
+    
+    def _GetPacks(self):
+        """
+        Get the (index path, pack path) of every packfile.
+        """
+        if self._packs is None:
+            self._packs = []
+            packDir = os.path.join(self._commonDir, 'objects', 'pack')
+            if os.path.isdir(packDir):
+                for filename in sorted(os.listdir(packDir)):
+                    if filename.endswith('.idx'):
+                        packPath = os.path.join(packDir, filename[ : -len('.idx')] + '.pack')
+                        if os.path.exists(packPath):
+                            self._packs.append((os.path.join(packDir, filename), packPath))
+        return self._packs
+    
+    @staticmethod
+    def _FindPackOffset(idxPath, binSha):
+        """
+        Binary search a version 2 pack index for binSha. Returns the object's
+        offset in the packfile, or None if it isn't in this pack.
+        """
+        with open(idxPath, 'rb') as f:
+            if f.read(4) != PACK_IDX_MAGIC or struct.unpack('>I', f.read(4))[0] != 2:
+                return None # Version 1 indexes are left to git
+            
+            # Fan-out table: fanout[i] is the number of objects whose first byte is <= i
+            first = ord(binSha[ : 1])
+            f.seek(8 + 4 * (first - 1) if first else 8)
+            if first:
+                lo, hi = struct.unpack('>II', f.read(8))
+            else:
+                lo, hi = 0, struct.unpack('>I', f.read(4))[0]
+            f.seek(8 + 4 * 255)
+            count = struct.unpack('>I', f.read(4))[0]
+            
+            namesOffset = 8 + 4 * 256
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(namesOffset + 20 * mid)
+                name = f.read(20)
+                if name < binSha:
+                    lo = mid + 1
+                elif name > binSha:
+                    hi = mid
+                else:
+                    # Skip the names and CRCs to reach the 4-byte offset table
+                    offsetsOffset = namesOffset + 24 * count
+                    f.seek(offsetsOffset + 4 * mid)
+                    offset = struct.unpack('>I', f.read(4))[0]
+                    if offset & 0x80000000:
+                        # Large offset: index into the 8-byte offset table
+                        f.seek(offsetsOffset + 4 * count + 8 * (offset & 0x7fffffff))
+                        offset = struct.unpack('>Q', f.read(8))[0]
+                    return offset
+        
+        return None
+    
+    @staticmethod
+    def _ReadPackEntry(packPath, offset):
+        """
+        Read the object at offset in a packfile. Returns None if the object is
+        stored as a delta.
+        """
+        with open(packPath, 'rb') as f:
+            f.seek(offset)
+            
+            # Variable length header: 3-bit type and the inflated size
+            c = ord(f.read(1))
+            objType = (c >> 4) & 7
+            size    = c & 15
+            shift   = 4
+            while c & 0x80:
+                c = ord(f.read(1))
+                size |= (c & 0x7f) << shift
+                shift += 7
+            
+            if objType not in OBJ_TYPES:
+                return None
+            
+            decompressor = zlib.decompressobj()
+            content = []
+            length = 0
+            while length < size:
+                data = f.read(4096)
+                if not data:
+                    break
+                content.append(decompressor.decompress(data))
+                length += len(content[-1])
+                if decompressor.unused_data:
+                    break
+            
+            content = b''.join(content)
+            if len(content) != size:
+                return None
+            return OBJ_TYPES[objType], content
+    
+    def _ReadPackedObject(self, sha):
+        binSha = binascii.unhexlify(sha)
+        for idxPath, packPath in self._GetPacks():
+            try:
+                offset = GitRepository._FindPackOffset(idxPath, binSha)
+                if offset is not None:
+                    return GitRepository._ReadPackEntry(packPath, offset)
+            except (IOError, struct.error, zlib.error):
+                continue # The object may be in another pack
+        return None
+    
+    def _ReadObjectBatch(self, sha):
+        """
+        Look up an object with `git cat-file --batch`.
+        """
+        if not self._catFile:
+            try:
+                self._catFile = subprocess.Popen(['git', '--git-dir=' + self._gitDir, 'cat-file', '--batch'],
+                                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError:
+                return None # git isn't installed
+        
+        self._catFile.stdin.write(sha.encode('ascii') + b'\n')
+        self._catFile.stdin.flush()
+        
+        # Output is "<sha> <type> <size>\n<contents>\n" or "<sha> missing\n"
+        header = self._catFile.stdout.readline().split()
+        if len(header) != 3:
+            return None
+        content = self._catFile.stdout.read(int(header[2]))
+        self._catFile.stdout.read(1)
+        return header[1].decode('ascii'), content
+    
+    def ReadObject(self, sha):
+        """
+        Read an object. Returns a tuple of the object's type ('commit', 'tree',
+        'blob' or 'tag') and its contents, or None if the object doesn't exist.
+        """
+        if not self.IsValid() or not sha:
+            return None
+        
+        if SHA1_HEX.match(sha):
+            obj = self._ReadLooseObject(sha) or self._ReadPackedObject(sha)
+            if obj:
+                return obj
+        
+        return self._ReadObjectBatch(sha)
+    
+    def GetCommitTime(self, sha):
+        """
+        Get the committer timestamp of a commit (the same as `git log -1
+        --format=%ct`), or None if the commit can't be read.
+        """
+        obj = self.ReadObject(sha)
+        if not obj or obj[0] != 'commit':
+            return None
+        
+        for line in obj[1].split(b'\n'):
+            if not line:
+                break # End of headers
+            if line.startswith(b'committer '):
+                # committer Name <email> 1400000000 +0100
+                try:
+                    return int(line.rsplit(b' ', 2)[1])
+                except (IndexError, ValueError):
+                    return None
+        
+        return None
+
+class TestGitRepository(TempDirTestCase):
+    def _Git(self, args):
+        env = dict(os.environ)
+        env.update({'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+                    'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com',
+                    'GIT_COMMITTER_DATE': '1400000000 +0100', 'GIT_AUTHOR_DATE': '1400000000 +0100'})
+        proc = subprocess.Popen(['git'] + args, cwd=self._dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return proc.communicate()[0].decode('ascii').strip()
+    
+    def test_git_repository(self):
+        self._Git(['init', '-q'])
+        self.assertEqual(GitRepository(self._dir).GetHead(), None)
+        
+        with open(os.path.join(self._dir, 'file'), 'w') as f:
+            f.write('file')
+        self._Git(['add', 'file'])
+        self._Git(['commit', '-q', '-m', 'Commit'])
+        self._Git(['checkout', '-q', '-b', 'test'])
+        head = self._Git(['rev-parse', 'HEAD'])
+        os.mkdir(os.path.join(self._dir, 'subdir'))
+        
+        # Loose refs and objects
+        repo = GitRepository(os.path.join(self._dir, 'subdir'))
+        self.assertTrue(repo.IsValid())
+        self.assertEqual(repo.GetHead(), head)
+        self.assertEqual(repo.GetBranch(), 'test')
+        self.assertEqual(repo.GetCommitTime(head), 1400000000)
+        self.assertEqual(repo.GetRemoteUrl(), None)
+        self._Git(['remote', 'add', 'origin', 'git://github.com/libretro/libretro-super.git'])
+        self.assertEqual(repo.GetRemoteUrl(), 'git://github.com/libretro/libretro-super.git')
+        
+        # Packed refs and objects
+        self._Git(['gc', '-q'])
+        self.assertFalse(os.path.exists(os.path.join(self._dir, GIT_DIRNAME, 'refs', 'heads', 'test')))
+        repo = GitRepository(self._dir)
+        self.assertEqual(repo.GetHead(), head)
+        self.assertEqual(repo.GetCommitTime(head), 1400000000)
+        self.assertEqual(repo._catFile, None)
+        
+        # A corrupt pack doesn't hide the objects in the other packs
+        packDir = os.path.join(self._dir, GIT_DIRNAME, 'objects', 'pack')
+        with open(os.path.join(packDir, 'pack-0.idx'), 'wb') as f:
+            f.write(b'\xfftOc')
+        with open(os.path.join(packDir, 'pack-0.pack'), 'wb') as f:
+            f.write(b'PACK')
+        repo = GitRepository(self._dir)
+        self.assertEqual(repo._GetPacks()[0][0], os.path.join(packDir, 'pack-0.idx'))
+        self.assertEqual(repo._ReadPackedObject(head)[0], 'commit')
+        
+        # Objects git has to find
+        self.assertEqual(repo._ReadObjectBatch(head)[0], 'commit')
+        self.assertEqual(repo._ReadObjectBatch('0' * 40), None)
+        repo.Close()
+        
+        # Detached HEAD
+        self._Git(['checkout', '-q', head])
+        self.assertEqual(GitRepository(self._dir).GetBranch(), 'HEAD')
+    
+    def test_not_a_repository(self):
+        repo = GitRepository(os.path.join(self._dir, 'missing'))
+        self.assertFalse(repo.IsValid())
+        self.assertEqual(repo.GetHead(), None)
+        self.assertEqual(repo.GetCommitTime('0' * 40), None)
+
+if __name__ == '__main__':
+    unittest.main()
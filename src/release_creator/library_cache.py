@@ -0,0 +1,141 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import CRC32
+from elf_file import ElfFile
+from environment import Environment
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import os
+import unittest
+
+LIBRARY_CACHE = 'libraries.json'
+
+class LibraryCache:
+    """
+    Remembers the size and CRC-32 of libretro libraries so that a library can
+    be compared against the copy in a release archive without reading it. The
+    digest of a library that hasn't been touched is found in the DigestCache.
+    A rebuilt library is identified by its GNU build-id, so rebuilding a core
+    from the same sources doesn't require reading it either. The contents are
+    only read if neither is known.
+    """
+    
+    _instance = None
+    
+    @staticmethod
+    def GetInstance():
+        """
+        Get the cache shared by all release archives in this process.
+        """
+        if not LibraryCache._instance:
+            LibraryCache._instance = LibraryCache(os.path.join(Environment.GetCacheDir(), LIBRARY_CACHE))
+        return LibraryCache._instance
+    
+    def __init__(self, path):
+        self._path     = path
+        self._buildIds = { } # build-id -> [size, crc]
+        self._Load()
+    
+    def _Load(self):
+        self._buildIds.update(loadJsonCache(self._path).get('build-ids', { }))
+    
+    def Save(self):
+        """
+        Write the cache to disk. Entries added by other processes since the
+        cache was loaded are kept, and the file is replaced atomically so
+        concurrent runs never see a partial cache.
+        """
+        buildIds       = self._buildIds
+        self._buildIds = { }
+        self._Load()
+        self._buildIds.update(buildIds)
+        
+        saveJsonCache(self._path, {'build-ids': self._buildIds})
+    
+    def GetDigest(self, libraryPath):
+        """
+        Get the size and CRC-32 of the library at libraryPath.
+        """
+        size        = os.path.getsize(libraryPath)
+        digestCache = DigestCache.GetInstance()
+        
+        crc = digestCache.Lookup(libraryPath, CRC32)
+        if crc is not None:
+            return size, crc
+        
+        buildId = ElfFile(libraryPath).GetBuildId()
+        
+        # Stripping keeps the build-id but changes the size, so check both
+        entry = self._buildIds.get(buildId)
+        if entry and entry[0] == size:
+            crc = entry[1]
+            digestCache.Store(libraryPath, {CRC32: crc})
+        else:
+            crc = digestCache.GetDigest(libraryPath, CRC32)
+        
+        if buildId and self._buildIds.get(buildId) != [size, crc]:
+            self._buildIds[buildId] = [size, crc]
+            self.Save()
+        
+        return size, crc
+    
+    def IsSameLibrary(self, libraryPath, zinfo):
+        """
+        Check if the library at libraryPath has the same contents as the
+        archive entry described by zinfo.
+        """
+        if zinfo is None or not os.path.exists(libraryPath):
+            return False
+        if os.path.getsize(libraryPath) != zinfo.file_size:
+            return False
+        
+        size, crc = self.GetDigest(libraryPath)
+        return size == zinfo.file_size and crc == zinfo.CRC
+
+class TestLibraryCache(DigestCacheTestCase):
+    def test_library_cache(self):
+        import zipfile
+        
+        libraryPath = os.path.join(self._dir, 'test_libretro.so')
+        with open(libraryPath, 'wb') as f:
+            f.write(os.urandom(10000))
+        
+        zipPath = os.path.join(self._dir, 'test.zip')
+        myzip = zipfile.ZipFile(zipPath, 'w')
+        myzip.write(libraryPath, 'test_libretro.so')
+        myzip.close()
+        zinfo = zipfile.ZipFile(zipPath, 'r').getinfo('test_libretro.so')
+        
+        cachePath = os.path.join(self._dir, LIBRARY_CACHE)
+        self.assertTrue(LibraryCache(cachePath).IsSameLibrary(libraryPath, zinfo))
+        
+        # Digest is loaded from disk by the next instance
+        self.assertEqual(LibraryCache(cachePath).GetDigest(libraryPath), (zinfo.file_size, zinfo.CRC))
+        
+        with open(libraryPath, 'wb') as f:
+            f.write(os.urandom(10000))
+        os.utime(libraryPath, (0, 0))
+        self.assertFalse(LibraryCache(cachePath).IsSameLibrary(libraryPath, zinfo))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,19 +18,21 @@
 # *
 
 from addon_xml import AddonXml
-from libretro_info import LibretroInfo
 
 import os
 import unittest
 
 LIBRETRO_SUFFIX = '_libretro'
-INFO_SUFFIX     = LIBRETRO_SUFFIX + LibretroInfo.GetInfoExtension()
 GAMECLIENT_ID   = 'gameclient.%s'
 
-class LibretroDll:
+class LibretroDll(object):
     """
-    Class representing a libretro DLL.
+    Class representing a libretro DLL. The info file and project are looked up
+    on first use.
     """
+    
+    __slots__ = ['_path', '_name', '_libretroSuper', '_info', '_project']
+    
     def __init__(self, path, libretroSuper):
         self._path = path
         
@@ -38,16 +40,31 @@ class LibretroDll:
         filename = os.path.split(path)[1]
         self._name = filename.split(LIBRETRO_SUFFIX)[0]
         
-        self._info = LibretroInfo(os.path.join(libretroSuper.GetInfoDir(), self._name + INFO_SUFFIX))
-        
-        self._project = libretroSuper.GetProject(self._name)
+        self._libretroSuper = libretroSuper # Until info and project are resolved
+        self._info          = None
+        self._project       = None
+    
+    def __getstate__(self):
+        # Worker processes get the resolved DLL, not all of libretro-super
+        self._Resolve()
+        return self._path, self._name, self._info, self._project
+    
+    def __setstate__(self, state):
+        self._path, self._name, self._info, self._project = state
+        self._libretroSuper = None
+    
+    def _Resolve(self):
+        if self._libretroSuper:
+            self._info = self._libretroSuper.GetInfoIndex().GetInfo(self._name + LIBRETRO_SUFFIX)
+            self._project = self._libretroSuper.GetProject(self._name)
+            self._libretroSuper = None
     
     def IsValid(self):
         if not self._name:
             return False
-        if not self._info or not self._info.IsValid():
+        if not self.GetInfo() or not self.GetInfo().IsValid():
             return False
-        if not self._project or not self._project.IsValid():
+        if not self.GetProject() or not self.GetProject().IsValid():
             return False
         return True
     
@@ -57,13 +74,22 @@ class LibretroDll:
     def GetPath(self):
         return self._path
     
+    def SetPath(self, path):
+        """
+        Package the library at path instead, e.g. a stripped copy. The file
+        name must stay the same.
+        """
+        self._path = path
+    
     def GetID(self):
         return GAMECLIENT_ID % self._name.replace('_', '.')
     
     def GetInfo(self):
+        self._Resolve()
         return self._info
     
     def GetProject(self):
+        self._Resolve()
         return self._project
 
 class TestLibretroDll(unittest.TestCase):
@@ -80,6 +106,12 @@ class TestLibretroDll(unittest.TestCase):
         for dll in dlls:
             # GetDlls() only returns valid DLLs, but we can check anyway
             self.assertTrue(dll.IsValid())
+            
+            # Worker processes get a resolved copy
+            import pickle
+            copy = pickle.loads(pickle.dumps(dll, 2))
+            self.assertEqual(copy.GetInfo().GetValues(), dll.GetInfo().GetValues())
+            self.assertEqual(copy.GetProject().GetCommitHash(), dll.GetProject().GetCommitHash())
 
 if __name__ == '__main__':
     unittest.main()
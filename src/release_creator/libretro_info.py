@@ -17,17 +17,30 @@
 # *  http://www.gnu.org/copyleft/gpl.html
 # *
 
+from utils import TempDirTestCase
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import os
 import unittest
 
 INFO_EXTENSION = '.info'
+INFO_INDEX     = 'info.json'
+INDEX_VERSION  = 1
 
-class LibretroInfo:
+class LibretroInfo(object):
     """
     Info files are files that contain key-value pairs defining properties of
     binaries generated by the libretro-super build scripts. After libretro-super
     is cloned, they reside in /libretro-super/dist/info. 
+    
+    Every key in the file is kept, including those without an accessor (see
+    GetValue()). Info files are normally loaded all at once by
+    LibretroInfoIndex.
     """
     
+    __slots__ = ['_path', '_values']
+    
     @staticmethod
     def GetInfoExtension():
         """
@@ -43,26 +56,14 @@ class LibretroInfo:
         """
         return value in ['true', 'yes', '1']
     
-    def __init__(self, path):
+    @staticmethod
+    def Parse(lines):
         """
-        Parse a libretro .info file into a python struct. path specifies the file
-        path to the info file, including the filename
+        Parse the lines of an info file into a dict of key-value pairs.
         """
-        self._path = path
-        self._LoadDefaults()
+        values = { }
         
-        # Load file
-        lines = []
-        try:
-            with open(path) as f:
-                lines = f.read().splitlines(False) # Don't keep line endings
-        except:
-            return # IsValid() will return false 
-        
-        # Parse file
-        lineCount = 0
         for line in lines:
-            bool 
             # Extract name and value
             if not line or line[0] == '#': # ignore comments and empty lines
                 continue
@@ -80,57 +81,52 @@ class LibretroInfo:
             if value[-1] == '"' or value[-1] == "'":
                 value = value[:-1]
             
-            self._Set(name, value)
-            
-            lineCount += 1
+            values[name] = value
         
-        # Valid if we found at least 1 valid line
-        self._isValid = (lineCount > 0)
-    
-    def _LoadDefaults(self):
-        self._isValid        = False
-        self._displayName    = ''
-        self._displayVersion = ''
-        self._description    = ''
-        self._authors        = ''
-        self._extensions     = ''
-        self._coreName       = ''
-        self._manufacturer   = ''
-        self._systemName     = ''
-        self._license        = ''
-        self._perissions     = ''
-        self._needFullpath   = False
-        self._supportsNoGame = False
-        self._blockExtract   = False
+        return values
+    
+    def __init__(self, path, values=None):
+        """
+        Parse a libretro .info file into a python struct. path specifies the file
+        path to the info file, including the filename. If values is given, it
+        holds the key-value pairs already parsed from the file.
+        """
+        self._path = path
+        
+        if values is None:
+            # Load file
+            values = { }
+            try:
+                with open(path) as f:
+                    values = LibretroInfo.Parse(f.read().splitlines(False)) # Don't keep line endings
+            except:
+                pass # IsValid() will return false 
+        
+        self._values = values
     
     def IsValid(self):
-        return self._isValid
-    
-    def _Set(self, name, value):
-        if   name == 'display_name':         self._displayName = value
-        elif name == 'display_version':      self._displayVersion = value
-        elif name == 'description':          self._description = value
-        elif name == 'authors':              self._authors = value
-        elif name == 'supported_extensions': self._extensions = value
-        elif name == 'corename':             self._coreName = value
-        elif name == 'manufacturer':         self._manufacturer = value
-        elif name == 'systemname':           self._systemName = value
-        elif name == 'license':              self._license = value
-        elif name == 'permissions':          self._perissions = value
-        elif name == 'need_fullpath':        self._needFullpath = LibretroInfo._IsTrue(value)
-        elif name == 'supports_no_game':     self._supportsNoGame = LibretroInfo._IsTrue(value)
-        elif name == 'block_extract':        self._blockExtract = LibretroInfo._IsTrue(value)
-    
-    def GetDisplayName(self):     return self._displayName
-    def GetDisplayVersion(self):  return self._displayVersion
-    def GetDescription(self):     return self._description
-    def GetAuthors(self):         return self._authors
-    def GetExtensions(self):      return self._extensions
-    def GetCoreName(self):        return self._coreName
-    def GetManufacturer(self):    return self._manufacturer
-    def GetSystemName(self):      return self._systemName
-    def GetLicense(self):         return self._license
-    def GetPermissions(self):     return self._perissions
+        # Valid if we found at least 1 valid line
+        return len(self._values) > 0
+    
+    def GetPath(self):
+        return self._path
+    
+    def GetValue(self, name, default=''):
+        return self._values.get(name, default)
+    
+    def GetValues(self):
+        return self._values
+    
+    def GetDisplayName(self):     return self.GetValue('display_name')
+    def GetDisplayVersion(self):  return self.GetValue('display_version')
+    def GetDescription(self):     return self.GetValue('description')
+    def GetAuthors(self):         return self.GetValue('authors')
+    def GetExtensions(self):      return self.GetValue('supported_extensions')
+    def GetCoreName(self):        return self.GetValue('corename')
+    def GetManufacturer(self):    return self.GetValue('manufacturer')
+    def GetSystemName(self):      return self.GetValue('systemname')
+    def GetLicense(self):         return self.GetValue('license')
+    def GetPermissions(self):     return self.GetValue('permissions')
     """
     Libretro cores can't resolve the various protocols used by XBMC's VFS (like
     zip://... and special://...). The libretro API allows cores to load files
@@ -139,9 +135,86 @@ class LibretroInfo:
     doesn't support loading via memory (and requires an absolute path), then the
     VFS can't be used.
     """
-    def SupportsVfs(self):        return 'true' if not self._needFullpath else 'false'
-    def SupportsNoGame(self):     return 'true' if self._supportsNoGame else 'false'
-    def ShouldBlockExtract(self): return 'true' if self._blockExtract else 'false'
+    def SupportsVfs(self):        return 'true' if not LibretroInfo._IsTrue(self.GetValue('need_fullpath')) else 'false'
+    def SupportsNoGame(self):     return 'true' if LibretroInfo._IsTrue(self.GetValue('supports_no_game')) else 'false'
+    def ShouldBlockExtract(self): return 'true' if LibretroInfo._IsTrue(self.GetValue('block_extract')) else 'false'
+
+class LibretroInfoIndex:
+    """
+    All info files in the info directory, parsed in one pass. The index is
+    cached in /cache and reused until a file in the info directory is added,
+    removed or modified.
+    """
+    
+    @staticmethod
+    def _GetIdentity(infoDir, filenames):
+        """
+        The modification time of the directory changes when files are added or
+        removed, the newest file's when a file is edited in place. Only stats
+        files, nothing is read.
+        """
+        mtimes = [os.stat(infoDir).st_mtime]
+        mtimes.extend([os.stat(os.path.join(infoDir, filename)).st_mtime for filename in filenames])
+        return [len(filenames), mtimes[0], max(mtimes)]
+    
+    def __init__(self, infoDir, cachePath=None):
+        self._infoDir   = infoDir
+        self._cachePath = cachePath
+        self._infos     = { }
+        
+        try:
+            filenames = sorted([f for f in os.listdir(infoDir) if f.endswith(INFO_EXTENSION)])
+        except OSError:
+            return # No info files
+        identity = LibretroInfoIndex._GetIdentity(infoDir, filenames)
+        
+        cores = self._LoadCache(identity)
+        if cores is None:
+            cores = { }
+            for filename in filenames:
+                try:
+                    with open(os.path.join(infoDir, filename)) as f:
+                        cores[filename[ : -len(INFO_EXTENSION)]] = LibretroInfo.Parse(f.read().splitlines(False))
+                except IOError:
+                    pass
+            self._SaveCache(identity, cores)
+        
+        for name, values in cores.items():
+            self._infos[name] = LibretroInfo(os.path.join(infoDir, name + INFO_EXTENSION), values)
+    
+    def _LoadCache(self, identity):
+        if not self._cachePath:
+            return None
+        
+        # A missing, corrupt or stale index is rebuilt
+        data = loadJsonCache(self._cachePath)
+        if data.get('version') != INDEX_VERSION or data.get('dir') != self._infoDir or data.get('identity') != identity:
+            return None
+        
+        cores = data.get('cores', { })
+        if bytes is str:
+            # Python 2 reads info files as byte strings, keep them that way
+            encode = lambda values: dict((k.encode('utf-8'), v.encode('utf-8')) for k, v in values.items())
+            cores = dict((name.encode('utf-8'), encode(values)) for name, values in cores.items())
+        return cores
+    
+    def _SaveCache(self, identity, cores):
+        if not self._cachePath:
+            return
+        
+        saveJsonCache(self._cachePath, {'version': INDEX_VERSION, 'dir': self._infoDir, 'identity': identity, 'cores': cores})
+    
+    def GetInfo(self, name):
+        """
+        Get the info of the core whose info file is name + '.info'. If there is
+        no such file, the returned info is invalid.
+        """
+        if name in self._infos:
+            return self._infos[name]
+        return LibretroInfo(os.path.join(self._infoDir, name + INFO_EXTENSION), { })
+    
+    def GetNames(self):
+        return sorted(self._infos.keys())
 
 class TestLibretroInfo(unittest.TestCase):
     def setUp(self):
@@ -163,5 +236,33 @@ class TestLibretroInfo(unittest.TestCase):
             
             print('Loaded info for %s (%s)' % (info.GetDisplayName(), info.GetDisplayVersion()))
 
+class TestLibretroInfoIndex(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self._infoDir = os.path.join(self._dir, 'info')
+        os.mkdir(self._infoDir)
+    
+    def test_libretro_info_index(self):
+        with open(os.path.join(self._infoDir, 'test_libretro.info'), 'w') as f:
+            f.write('# Comment\ndisplay_name = "Test"\nneed_fullpath = "true"\nfirmware_count = 1\n')
+        
+        cachePath = os.path.join(self._dir, INFO_INDEX)
+        for i in range(2): # Parsed, then loaded from the cache
+            info = LibretroInfoIndex(self._infoDir, cachePath).GetInfo('test_libretro')
+            self.assertTrue(info.IsValid())
+            self.assertEqual(info.GetDisplayName(), 'Test')
+            self.assertEqual(info.SupportsVfs(), 'false')
+            self.assertEqual(info.GetValue('firmware_count'), '1')
+            self.assertTrue(isinstance(info.GetDisplayName(), str))
+            self.assertTrue(os.path.exists(cachePath))
+        
+        self.assertFalse(LibretroInfoIndex(self._infoDir, cachePath).GetInfo('missing_libretro').IsValid())
+        
+        # Adding a file invalidates the cache
+        with open(os.path.join(self._infoDir, 'test2_libretro.info'), 'w') as f:
+            f.write('display_name = "Test 2"\n')
+        os.utime(self._infoDir, (0, 0))
+        self.assertEqual(LibretroInfoIndex(self._infoDir, cachePath).GetNames(), ['test2_libretro', 'test_libretro'])
+
 if __name__ == '__main__':
     unittest.main()
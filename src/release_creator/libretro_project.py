@@ -17,7 +17,7 @@
 # *  http://www.gnu.org/copyleft/gpl.html
 # *
 
-from environment import Environment
+from git_repository import GitRepository
 
 import os
 import time
@@ -25,7 +25,9 @@ import unittest
 
 PROJECT_NAME_PREFIX = 'libretro-'
 
-class LibretroProject:
+class LibretroProject(object):
+    __slots__ = ['_projectDir', '_name', '_versionHash', '_date']
+    
     @staticmethod
     def GetProjectNamePrefix():
         """
@@ -42,34 +44,30 @@ class LibretroProject:
         if filename.startswith(PROJECT_NAME_PREFIX):
             self._name = filename[len(PROJECT_NAME_PREFIX) : ]
         
-        self._versionHash = self._ComputeVersionHash()
-        self._date = self._ComputeDate()
+        # Read the repository directly instead of running git for each property
+        repository = GitRepository(self._projectDir)
+        self._versionHash = self._ComputeVersionHash(repository)
+        repository.Close()
+        
+        # Only add-ons that are packaged need the date, see GetDate()
+        self._date = None
     
-    def _ComputeVersionHash(self):
+    def _ComputeVersionHash(self, repository):
         """
         Get the SHA-1 hash of the HEAD commit.
         """
-        gitHash = None
-        if os.path.exists(self._projectDir):
-            gitHash = Environment.CheckOutput(self._projectDir, ['git', 'rev-parse', 'HEAD'])
-            
-            # If git rev-parse returned an error message, expect it to contain spaces
-            if ' ' in gitHash:
-                gitHash = None
-        return gitHash
+        return repository.GetHead()
     
-    def _ComputeDate(self):
+    def _ComputeDate(self, repository):
         """
         Get the date of the HEAD commit. YYYY-M-D
         """
         gitDate = None
         
-        if os.path.exists(self._projectDir):
-            commitTime = Environment.CheckOutput(self._projectDir,
-                                                 ['git', 'log', '-1', '--format=%ct'])
-            if ' ' not in commitTime:
-                date = time.gmtime(int(commitTime))
-                gitDate = '%s-%s-%s' % (date.tm_year, date.tm_mon, date.tm_mday)
+        commitTime = repository.GetCommitTime(self._versionHash)
+        if commitTime is not None:
+            date = time.gmtime(commitTime)
+            gitDate = '%s-%s-%s' % (date.tm_year, date.tm_mon, date.tm_mday)
         
         return gitDate
     
@@ -86,7 +84,20 @@ class LibretroProject:
     def GetVersionHash(self):
         return self._versionHash[ : 7]
     
+    def GetCommitHash(self):
+        """
+        Get the full hash of the HEAD commit.
+        """
+        return self._versionHash
+    
     def GetDate(self):
+        """
+        Get the date of the HEAD commit. The commit is read on first use.
+        """
+        if self._date is None and self._versionHash:
+            repository = GitRepository(self._projectDir)
+            self._date = self._ComputeDate(repository)
+            repository.Close()
         return self._date
 
 class TestLibretroProject(unittest.TestCase):
@@ -17,10 +17,21 @@
 # *  http://www.gnu.org/copyleft/gpl.html
 # *
 
+from artifact_cache import ArtifactCache
+from build_driver import BuildDriver
+from build_driver import BUILD_LOG_DIR
+from build_history import BuildHistory
+from build_history import BUILD_HISTORY
+from core_validator import CoreValidator
 from environment import Environment
+from fetch_driver import FetchDriver
+from git_repository import GitRepository
 from libretro_dll import LibretroDll
+from libretro_info import LibretroInfoIndex
+from libretro_info import INFO_INDEX
 from libretro_project import LibretroProject
-from utils import getClosestMatch
+from project_resolver import ProjectResolver
+from project_resolver import RESOLVER_CACHE
 
 import os
 import subprocess
@@ -32,6 +43,7 @@ FETCH_CMD              = 'libretro-fetch.sh'
 BUILD_UNIX_CMD         = 'libretro-build.sh'
 BUILD_OSX_CMD          = 'libretro-build.sh'
 BUILD_WIN_CMD          = 'libretro-build-win.sh' 
+CONFIG_CMD             = 'libretro-config.sh'
 
 class LibretroSuper:
     PLATFORM_WIN  = 'win'
@@ -96,17 +108,7 @@ class LibretroSuper:
         self._branch = self._ComputeBranch()
     
     def _ComputeBranch(self):
-        branch = None
-        
-        if os.path.exists(LibretroSuper.GetRepoDir()):
-            branch = Environment.CheckOutput(LibretroSuper.GetRepoDir(),
-                                             ['git', 'rev-parse', '--abbrev-ref', 'HEAD'])
-            
-            # If git rev-parse returned an error message, expect it to contain spaces
-            if ' ' in branch:
-                branch = None
-        
-        return branch
+        return GitRepository(LibretroSuper.GetRepoDir()).GetBranch()
     
     def IsValid(self):
         """
@@ -119,11 +121,16 @@ class LibretroSuper:
     def GetBranch(self):
         return self._branch
     
-    def CloneIfNotValid(self):
+    def CloneIfNotValid(self, depth=None, filterBlobs=False):
+        """
+        Clone libretro-super if it hasn't been cloned yet. See FetchDriver for
+        depth and filterBlobs.
+        """
         if not self.IsValid():
             if os.path.exists(LibretroSuper.GetRepoDir()):
                 return False # TODO: Path exists but isn't a git repository?
-            subprocess.call(['git', 'clone', LIBRETRO_SUPER_GIT, LibretroSuper.GetRepoDir()])
+            driver = FetchDriver(os.path.dirname(LibretroSuper.GetRepoDir()), depth=depth, filterBlobs=filterBlobs)
+            subprocess.call(driver.GetCloneCommand(LIBRETRO_SUPER_GIT, LibretroSuper.GetRepoDir()))
             self._InitalizeVariables()
         return self.IsValid()
     
@@ -157,27 +164,42 @@ class LibretroSuper:
             
             if project.IsValid():
                 self._projects.append(project)
-                print('Found project %s at %s (%s)' % (project.GetName(), project.GetVersionHash()[ : 7], project.GetDate()))
+                print('Found project %s at %s' % (project.GetName(), project.GetVersionHash()[ : 7]))
         
         print('Found %d projects' % len(self._projects))
         
         return self._projects
     
+    def GetInfoIndex(self):
+        """
+        Info files of all libretro cores, loaded once and cached between runs.
+        """
+        try:
+            return self._infoIndex
+        except AttributeError:
+            self._infoIndex = LibretroInfoIndex(LibretroSuper.GetInfoDir(),
+                                                os.path.join(Environment.GetCacheDir(), INFO_INDEX))
+            return self._infoIndex
+    
+    def GetResolver(self):
+        """
+        Get the resolver that matches DLLs to projects, built once for all
+        DLLs. Call this before starting threads that look up projects.
+        """
+        try:
+            return self._resolver
+        except AttributeError:
+            self._resolver = ProjectResolver([project.GetName() for project in self.GetProjects()],
+                                             cachePath=os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), RESOLVER_CACHE))
+            return self._resolver
+    
     def GetProject(self, name):
         """
         Use fuzzy string matching to resolve the filename of a compiled libretro
         core to the project that generated it.
         """
         projects = self.GetProjects()
-        
-        # Find the closest match
-        projectName = getClosestMatch(name, [project.GetName() for project in projects])
-        
-        # In case of an extra suffix (like bsnes_performance), split on '_' and remove last token
-        if not projectName:
-            name2 = name.rpartition('_')[0]
-            if name2:
-                projectName = getClosestMatch(name2, [project.GetName() for project in projects])
+        projectName = self.GetResolver().Resolve(name)
         
         if not projectName:
             return None
@@ -193,43 +215,158 @@ class LibretroSuper:
         """
         Get a list of all the binaries that successfully compiled.
         """
-        dlls = []
-        
+        return list(self.IterDlls())
+    
+    def IterDlls(self):
+        """
+        Yield the binaries that successfully compiled one at a time, so that a
+        caller streaming them doesn't hold all of them at once.
+        """
         if not self.IsValid():
-            return dlls
+            return
+        
+        # Reject broken build outputs before matching them to projects
+        validator = CoreValidator.GetInstance()
         
         for dllName in os.listdir(LibretroSuper.GetDllDir()):
             dllPath = os.path.join(LibretroSuper.GetDllDir(), dllName)
+            error = validator.Validate(dllPath)
+            if error:
+                print('Skipping %s: %s' % (dllName, error))
+                continue
             dll = LibretroDll(dllPath, self)
             if dll.IsValid():
-                dlls.append(dll)
                 print('Loaded dll %s (%s) from project %s' % (dll.GetID(), dll.GetInfo().GetDisplayVersion(), dll.GetProject().GetName()))
+                yield dll
             else:
                 print('Failed to loaded dll %s: can\'t find libretro-super project!' % (dll.GetID()))
         
-        return dlls
+        validator.Save()
+        try:
+            self._resolver.Save()
+        except AttributeError:
+            pass # No DLLs
     
-    def Fetch(self):
+    def Fetch(self, jobs=1, depth=None, filterBlobs=False, referenceDir=None):
         """
-        Fetch all libretro cores using FETCH_CMD
+        Fetch all libretro cores listed in FETCH_CMD and the scripts it
+        sources, jobs projects at a time.
+        Only projects with new commits upstream are fetched.
+        New projects can be cloned shallow (depth) or without blobs
+        (filterBlobs), and can borrow objects from bare repositories in
+        referenceDir (see FetchDriver). If no projects are found in the
+        script, FETCH_CMD is run instead.
         """
-        if self.IsValid():
+        if not self.IsValid():
+            return False
+        
+        scripts = [os.path.join(LibretroSuper.GetRepoDir(), script) for script in [CONFIG_CMD, FETCH_CMD]]
+        sources = FetchDriver.GetSources(LibretroSuper.GetRepoDir(), scripts)
+        
+        if not sources:
             LibretroSuper.RunScript(FETCH_CMD)
-            return True
-        return False
+        else:
+            driver = FetchDriver(LibretroSuper.GetRepoDir(), jobs, depth, filterBlobs, referenceDir,
+                                 os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), BUILD_LOG_DIR))
+            
+            # Asking the remotes for their HEAD is much cheaper than pulling every project
+            sources = driver.GetStaleSources(sources, self.GetProjects())
+            self._fetchResults = driver.Fetch(sources)
+        
+        # Projects have new commits
+        try:
+            del self._projects
+        except AttributeError:
+            pass
+        
+        return True
     
-    def Build(self):
+    def GetFetchResults(self):
         """
-        Build all libretro cores for the current platform
+        Results of the per-project fetches run by Fetch().
+        """
+        try:
+            return self._fetchResults
+        except AttributeError:
+            return []
+    
+    def GetMovedProjects(self):
+        """
+        Get the projects whose HEAD was moved by Fetch(). Their cores in
+        dist/<platform> were built from an older commit.
+        """
+        moved = set([result.GetDirname() for result in self.GetFetchResults() if result.IsChanged()])
+        return [project for project in self.GetProjects() if LibretroProject.GetProjectNamePrefix() + project.GetName() in moved]
+    
+    @staticmethod
+    def GetBuildScript():
+        if   LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_WIN:  return BUILD_WIN_CMD
+        elif LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_UNIX: return BUILD_UNIX_CMD
+        elif LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_OSX:  return BUILD_OSX_CMD
+    
+    def Build(self, buildJobs=1, makeJobs=None, projects=None, artifactCache=None):
+        """
+        Build all libretro cores for the current platform. Each project is
+        built as a separate job, buildJobs at a time, with at most makeJobs
+        make jobs running in total (default: number of CPUs). The projects that
+        took longest to build last time are started first. Projects the
+        build script has no build function for are skipped. If it has none at
+        all, the whole script is run instead.
+        
+        If projects is given, only those projects are built. If artifactCache
+        is given, cores built before with the same commit and toolchain are
+        copied from the cache instead of being built.
         """
         if not self.IsValid():
             return False
         
-        if   LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_WIN:  LibretroSuper.RunScript(BUILD_WIN_CMD)
-        elif LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_UNIX: LibretroSuper.RunScript(BUILD_UNIX_CMD)
-        elif LibretroSuper.GetPlatform() == LibretroSuper.PLATFORM_OSX:  LibretroSuper.RunScript(BUILD_OSX_CMD)
+        if projects is None:
+            projects = self.GetProjects()
+        elif not projects:
+            return True # Nothing to build
+        
+        driver = BuildDriver(self, LibretroSuper.GetBuildScript(), buildJobs, makeJobs)
+        buildable, unbuildable = driver.GetBuildableProjects(projects)
+        
+        if not buildable:
+            # Script can't build cores individually, build them all at once
+            LibretroSuper.RunScript(LibretroSuper.GetBuildScript())
+            return True
+        
+        for project in unbuildable:
+            print('Skipping project %s: %s has no build function for it' % (project.GetName(), LibretroSuper.GetBuildScript()))
+        
+        keys = { }
+        if artifactCache:
+            toolchain = ArtifactCache.GetToolchainIdentity(os.path.join(LibretroSuper.GetRepoDir(), LibretroSuper.GetBuildScript()))
+            for project in buildable:
+                keys[project.GetName()] = ArtifactCache.GetKey(project.GetName(), project.GetCommitHash(), toolchain)
+            
+            cached = [project for project in buildable if artifactCache.Restore(keys[project.GetName()], LibretroSuper.GetDllDir())]
+            for project in cached:
+                print('Restored project %s from the artifact cache' % project.GetName())
+            buildable = [project for project in buildable if project not in cached]
+        
+        # Projects are started longest build first, as recorded by the history
+        history = BuildHistory(os.path.join(Environment.GetCacheDir(), Environment.GetPlatform(), BUILD_HISTORY))
+        self._buildResults = driver.Build(buildable, history)
+        
+        if artifactCache:
+            for result in self._buildResults:
+                if result.IsSuccess():
+                    artifactCache.Store(keys[result.GetProjectName()], result.GetDlls())
+            artifactCache.Save()
         
         return True
+    
+    def GetBuildResults(self):
+        """
+        Results of the per-project builds run by Build().
+        """
+        try:
+            return self._buildResults
+        except AttributeError:
+            return []
 
 class TestLibretroSuper(unittest.TestCase):
     def setUp(self):
@@ -17,44 +17,93 @@
 # *  http://www.gnu.org/copyleft/gpl.html
 # *
 
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import MD5
+from digest_cache import SHA256
 from environment import Environment
 
+import hashlib
 import os
 import unittest
 
-try:
-    import md5
-except ImportError:
-    import hashlib
+MD5_EXTENSION    = '.md5'
+SHA256_EXTENSION = '.sha256'
 
-MD5_EXTENSION = '.md5'
+class DigestWriter:
+    """
+    Write-only file object that passes everything written to it on to another
+    file while computing its MD5 and SHA-256. Wrapping the output of a zip
+    file in a DigestWriter hashes the archive as it is written, so it never
+    has to be read back. DigestWriter can't seek, so the writer must produce
+    the file front to back.
+    """
+    def __init__(self, f):
+        self._f      = f
+        self._pos    = 0
+        self._md5    = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+    
+    def write(self, data):
+        self._f.write(data)
+        self._md5.update(data)
+        self._sha256.update(data)
+        self._pos += len(data)
+    
+    def tell(self):
+        return self._pos
+    
+    def flush(self):
+        self._f.flush()
+    
+    def close(self):
+        self._f.close()
+    
+    def GetMD5(self):
+        return self._md5.hexdigest()
+    
+    def GetSHA256(self):
+        return self._sha256.hexdigest()
 
 class MD5File:
     @staticmethod
     def GetExtension():
         return MD5_EXTENSION
     
-    def __init__(self, path):
+    @staticmethod
+    def GetSHA256Extension():
+        return SHA256_EXTENSION
+    
+    def __init__(self, path, digestWriter=None):
         """
         Creates an MD5 object for the specified path of a file. The filename
-        for the generated MD5 stamp is the filename + '.md5'
+        for the generated MD5 stamp is the filename + '.md5', and a SHA-256
+        stamp is generated alongside as filename + '.sha256'. If the file was
+        written through a DigestWriter, pass it as digestWriter to use the
+        digests it computed instead of reading the file again.
         """
         self._filename = path + MD5_EXTENSION
-        self._LoadMD5(path)
+        self._sha256Filename = path + SHA256_EXTENSION
+        if digestWriter:
+            self._md5    = digestWriter.GetMD5()
+            self._sha256 = digestWriter.GetSHA256()
+            DigestCache.GetInstance().Store(path, {MD5: self._md5, SHA256: self._sha256})
+        else:
+            self._LoadMD5(path)
     
     def _LoadMD5(self, path):
-        self._md5 = None
+        """
+        Look up both digests in the digest cache. If the file has changed,
+        they are computed in a single pass that reads the file in chunks, so
+        large archives aren't loaded into memory.
+        """
+        self._md5    = None
+        self._sha256 = None
         
-        data = None
         if os.path.exists(path):
-            with open(path, 'rb') as f:
-                data = f.read()
-        
-        if data is not None:
-            try:
-                self._md5 = hashlib.md5(data).hexdigest()
-            except NameError:
-                self._md5 = md5.new(data).hexdigest()
+            digests = DigestCache.GetInstance().GetDigests(path, [MD5, SHA256])
+            self._md5    = digests[MD5]
+            self._sha256 = digests[SHA256]
     
     def IsValid(self):
         return self._md5 is not None
@@ -65,6 +114,18 @@ class MD5File:
         """
         return self._filename
     
+    def GetSHA256Path(self):
+        """
+        Get the path of the .sha256 file, including the .sha256 extension.
+        """
+        return self._sha256Filename
+    
+    def GetMD5(self):
+        return self._md5
+    
+    def GetSHA256(self):
+        return self._sha256
+    
     def Save(self):
         if not self.IsValid():
             return False
@@ -72,17 +133,24 @@ class MD5File:
         with open(self._filename, 'w') as f:
             f.write(self._md5)
         
+        with open(self._sha256Filename, 'w') as f:
+            f.write(self._sha256)
+        
         return True
 
-class TestMD5File(unittest.TestCase):
+class TestMD5File(DigestCacheTestCase):
     def setUp(self):
-        pass
+        DigestCacheTestCase.setUp(self)
+        self._md5Path = None
+        self._sha256Path = None
     
     def tearDown(self):
-        try:
-            os.remove(self._md5Path)
-        except:
-            pass
+        for path in [self._md5Path, self._sha256Path]:
+            try:
+                os.remove(path)
+            except:
+                pass
+        DigestCacheTestCase.tearDown(self)
     
     def test_md5_file(self):
         from addon_xml import AddonXml
@@ -93,8 +161,9 @@ class TestMD5File(unittest.TestCase):
         self.assertTrue(md5File.IsValid())
         self.assertTrue(md5File.Save())
         
-        # Save md5 path so we can remove it in tearDown()
+        # Save md5 and sha256 paths so we can remove them in tearDown()
         self._md5Path = md5File.GetPath()
+        self._sha256Path = md5File.GetSHA256Path()
         
         md5_1 = None
         with open(testfile + MD5_EXTENSION, 'r') as f:
@@ -106,6 +175,30 @@ class TestMD5File(unittest.TestCase):
         self.assertTrue(' ' in md5_2) # md5sum output includes filename
         md5_2 = md5_2.split(' ')[0] # Extract first word
         self.assertEqual(md5_1, md5_2)
+        
+        # Compare against output of sha256sum
+        with open(testfile + SHA256_EXTENSION, 'r') as f:
+            sha256_1 = f.read()
+        sha256_2 = Environment.CheckOutput('.', ['sha256sum', testfile]).split(' ')[0]
+        self.assertEqual(sha256_1, sha256_2)
+    
+    def test_digest_writer(self):
+        import tempfile
+        
+        path = tempfile.mktemp()
+        self._md5Path = path + MD5_EXTENSION
+        self._sha256Path = path + SHA256_EXTENSION
+        
+        digestWriter = DigestWriter(open(path, 'wb'))
+        digestWriter.write(b'Hello ')
+        digestWriter.write(b'world')
+        self.assertEqual(digestWriter.tell(), 11)
+        digestWriter.close()
+        
+        md5File = MD5File(path, digestWriter)
+        self.assertEqual(md5File.GetMD5(), MD5File(path).GetMD5())
+        self.assertEqual(md5File.GetSHA256(), MD5File(path).GetSHA256())
+        os.remove(path)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,186 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from environment import Environment
+from utils import getClosestMatch
+from utils import TempDirTestCase
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import json
+import os
+import unittest
+
+DLL_TO_PROJECT   = 'dll_to_project.json'
+RESOLVER_CACHE   = 'projects.json'
+MATCH_CUTOFF     = 0.6 # Same as difflib.get_close_matches()
+
+class ProjectResolver:
+    """
+    Resolves the name of a compiled libretro core (e.g. bsnes_performance) to
+    the libretro-super project that built it (e.g. bsnes).
+    
+    Problematic matches are hard-coded in /src/dll_to_project.json. Other
+    names are resolved with fuzzy string matching (see getClosestMatch()).
+    Only projects that can possibly match are compared: an index of the
+    characters in each project name gives the same upper bound on the match
+    ratio as difflib's quick_ratio(), so projects below the cutoff are skipped
+    without running SequenceMatcher.
+    
+    Resolved names are cached between runs. The cache is discarded when the
+    set of projects or the hard-coded mapping changes.
+    """
+    
+    @staticmethod
+    def LoadOverrides(path=None):
+        """
+        Load the hard-coded DLL-to-project mapping.
+        """
+        if path is None:
+            path = os.path.join(Environment.GetSrcDir(), DLL_TO_PROJECT)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return { }
+    
+    def __init__(self, projectNames, overrides=None, cachePath=None):
+        self._projectNames = sorted(set(projectNames))
+        self._overrides    = overrides if overrides is not None else ProjectResolver.LoadOverrides()
+        self._cachePath    = cachePath
+        self._resolved     = { }
+        
+        # Index: character -> list of (project index, number of occurrences)
+        self._index = { }
+        for i, projectName in enumerate(self._projectNames):
+            for c, count in ProjectResolver._CountChars(projectName).items():
+                self._index.setdefault(c, []).append((i, count))
+        
+        if self._cachePath:
+            self._LoadCache()
+    
+    @staticmethod
+    def _CountChars(name):
+        counts = { }
+        for c in name:
+            counts[c] = counts.get(c, 0) + 1
+        return counts
+    
+    def _LoadCache(self):
+        # A missing, corrupt or stale cache starts out empty
+        data = loadJsonCache(self._cachePath)
+        if data.get('projects') == self._projectNames and data.get('overrides') == self._overrides:
+            self._resolved = data.get('resolved', { })
+    
+    def Save(self):
+        """
+        Write resolved names to the cache, replacing it atomically.
+        """
+        if not self._cachePath:
+            return
+        
+        saveJsonCache(self._cachePath, {'projects': self._projectNames, 'overrides': self._overrides, 'resolved': self._resolved})
+    
+    def GetCandidates(self, name):
+        """
+        Get the project names that could match name, i.e. whose
+        quick_ratio() with name reaches MATCH_CUTOFF.
+        """
+        common = { }
+        for c, count in ProjectResolver._CountChars(name).items():
+            for i, projectCount in self._index.get(c, []):
+                common[i] = common.get(i, 0) + min(count, projectCount)
+        
+        candidates = []
+        for i in sorted(common):
+            projectName = self._projectNames[i]
+            if 2.0 * common[i] / (len(name) + len(projectName)) >= MATCH_CUTOFF:
+                candidates.append(projectName)
+        return candidates
+    
+    def _Match(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+        return getClosestMatch(name, self.GetCandidates(name))
+    
+    def Resolve(self, name):
+        """
+        Get the name of the project that built the core called name, or None
+        if no project matches.
+        """
+        if name in self._resolved:
+            return self._resolved[name]
+        
+        projectName = self._Match(name)
+        
+        # In case of an extra suffix (like bsnes_performance), split on '_' and remove last token
+        if not projectName:
+            name2 = name.rpartition('_')[0]
+            if name2:
+                projectName = self._Match(name2)
+        
+        self._resolved[name] = projectName
+        return projectName
+
+class TestProjectResolver(TempDirTestCase):
+    def test_resolve(self):
+        projects  = ['bsnes', 's9x', 's9x-next', 'nx', '3dengine', 'fceumm', 'gambatte']
+        overrides = {'nxengine': 'nx', 'snes9x': 's9x'}
+        resolver  = ProjectResolver(projects, overrides)
+        
+        self.assertEqual(resolver.Resolve('bsnes'), 'bsnes')
+        self.assertEqual(resolver.Resolve('bsnes_performance'), 'bsnes')
+        self.assertEqual(resolver.Resolve('snes9x_next'), 's9x-next')
+        self.assertEqual(resolver.Resolve('nxengine'), 'nx')
+        self.assertEqual(resolver.Resolve('snes9x'), 's9x')
+        self.assertEqual(resolver.Resolve('mupen64plus'), None)
+        
+        # Candidates are exactly the projects that pass difflib's quick_ratio()
+        import difflib
+        for name in ['bsnes', 'snes9x_next', 'gambatte_libretro', 'mame']:
+            expected = [project for project in sorted(projects)
+                        if difflib.SequenceMatcher(None, project, name).quick_ratio() >= MATCH_CUTOFF]
+            self.assertEqual(resolver.GetCandidates(name), expected)
+    
+    def test_overrides(self):
+        # Fuzzy matching alone gets these wrong, so dll_to_project.json has them
+        overrides = ProjectResolver.LoadOverrides()
+        resolver = ProjectResolver(['bsnes', 's9x', 's9x-next', 'nx', '3dengine'], overrides)
+        self.assertEqual(resolver.Resolve('nxengine'), 'nx')
+        self.assertEqual(resolver.Resolve('snes9x'), 's9x')
+        self.assertEqual(resolver.Resolve('snes9x_next'), 's9x-next')
+    
+    def test_cache(self):
+        cachePath = os.path.join(self._dir, RESOLVER_CACHE)
+        resolver = ProjectResolver(['bsnes', 'gambatte'], { }, cachePath)
+        self.assertEqual(resolver.Resolve('gambatte'), 'gambatte')
+        resolver.Save()
+        
+        # Cached names are trusted while the projects are unchanged
+        resolver = ProjectResolver(['gambatte', 'bsnes'], { }, cachePath)
+        resolver._resolved['gambatte'] = 'bsnes'
+        resolver.Save()
+        self.assertEqual(ProjectResolver(['bsnes', 'gambatte'], { }, cachePath).Resolve('gambatte'), 'bsnes')
+        
+        # Adding a project invalidates the cache
+        self.assertEqual(ProjectResolver(['bsnes', 'gambatte', 'fceumm'], { }, cachePath).Resolve('gambatte'), 'gambatte')
+        self.assertEqual(ProjectResolver(['bsnes', 'gambatte'], {'gambatte': 'fceumm'}, cachePath).Resolve('gambatte'), 'fceumm')
+
+if __name__ == '__main__':
+    unittest.main()
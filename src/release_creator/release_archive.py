@@ -20,23 +20,33 @@
 from addon_version import AddonVersion
 from addon_xml import AddonXml
 from changelog import ChangeLog
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import CRC32
 from environment import Environment
 from environment import RESOURCES_DIR
 from environment import LANGUAGES_DIR
 from environment import ENGLISH_DIR
+from library_cache import LibraryCache
 from md5_file import MD5File
+from release_catalog import ReleaseCatalog
 from settings_xml import SettingsXml
 from strings_po import StringsPo
+from zip_writer import CompressionPolicy
+from zip_writer import ZipWriter
 
 import os
 import shutil
 import unittest
 import zipfile
+import zlib
 
 ARCHIVE_EXTENSION      = '.zip'
 VERSIONED_ARCHIVE_NAME = '%s-%s' + ARCHIVE_EXTENSION # e.g. gameclient.bnes-1.0.0.zip
 
-class ReleaseArchive:
+class ReleaseArchive(object):
+    __slots__ = ['_id', '_policy']
+    
     @staticmethod
     def GetExtension():
         """
@@ -64,17 +74,30 @@ class ReleaseArchive:
         
         return id, AddonVersion(version)
     
-    def __init__(self, id):
-        self._id = id
+    def __init__(self, id, policy=None):
+        self._id     = id
+        self._policy = policy or CompressionPolicy()
     
     def _GetMaxVersion(self, fallback):
         """
         Get the highest version from the release archives in the release
         directory. Versions less than fallback are ignored. If the directory
         contains no release archives > fallback, fallback is returned.
+        
+        The release catalog is asked instead of listing the directory, unless
+        the directory changed since it was catalogued (e.g. archives released
+        by another builder were pulled). It is catalogued again when the
+        add-on is recorded at the end of the run.
         """
         maxVersion = fallback
         
+        catalog = ReleaseCatalog.GetInstance()
+        if catalog.IsFolderCurrent(self._id):
+            catalogVersion = catalog.GetMaxVersion(self._id)
+            if catalogVersion and maxVersion.Compare(catalogVersion) < 0:
+                maxVersion = catalogVersion
+            return maxVersion
+        
         if os.path.exists(Environment.GetReleaseDir(self._id)):
             for filename in os.listdir(Environment.GetReleaseDir(self._id)):
                 if not filename.endswith(ReleaseArchive.GetExtension()):
@@ -86,7 +109,12 @@ class ReleaseArchive:
         
         return maxVersion
     
-    def Update(self, addonXml, changeLog, dll, settingsXml, stringsPo):
+    def Update(self, addonXml, changeLog, dll, settingsXml, stringsPo, previousZipPath=None):
+        """
+        Create or update the release archive. If previousZipPath is given, it
+        is the archive being replaced, and entries that haven't changed are
+        copied from it instead of being compressed again.
+        """
         # First check for existing archives
         maxAddonVersion = self._GetMaxVersion(addonXml.GetVersion())
         
@@ -98,8 +126,9 @@ class ReleaseArchive:
         if zipfile.is_zipfile(zipPath):
             addonXml.SetVersion(maxAddonVersion)
             
-            addonXmlText    = addonXml.GetAddonXml().strip()
-            changeLogText   = changeLog.GetText().strip()
+            # Render the text entries exactly as _WriteZipFile() would write them
+            addonXmlText    = addonXml.GetAddonXml()
+            changeLogText   = changeLog.GetText()
             settingsXmlText = settingsXml.ReadXml().strip()
             stringsPoText   = stringsPo.ReadPo().strip()
             
@@ -107,26 +136,32 @@ class ReleaseArchive:
             # Check if existing archive differs from updated archive
             different = False
             
-            zipAddonXmlText, zipChangeLogText, zipSettingsXmlText, zipStringsPoText, zipHasIcon, zipHasFanart, zipHasLibrary = self._GetZipInfo(zipPath)
+            myzip = zipfile.ZipFile(zipPath, 'r')
             
-            if addonXmlText != zipAddonXmlText:
-                different = True
+            zipAddonXml, zipChangeLog, zipSettingsXml, zipStringsPo, zipIcon, zipFanart, zipLibrary = self._GetZipInfo(myzip)
             
-            if changeLogText != zipChangeLogText:
+            # Archives are reproducible, so the same entries mean the same archive
+            manifestDigest = ZipWriter.ReadManifestDigest(myzip)
+            if manifestDigest is not None:
+                entries = self._GetEntries(addonXmlText, changeLogText, settingsXmlText, stringsPoText, dll.GetPath(), addonXml.GetIconPath(), addonXml.GetFanartPath())
+                different = (manifestDigest != self._GetManifestDigest(entries))
+            elif not self._IsSameText(myzip, zipAddonXml, addonXmlText):
                 different = True
-            
-            if settingsXmlText != zipSettingsXmlText:
+            elif not self._IsSameText(myzip, zipChangeLog, changeLogText):
                 different = True
-            
-            if stringsPoText != zipStringsPoText:
+            elif not self._IsSameText(myzip, zipSettingsXml, settingsXmlText):
                 different = True
-            
-            if (addonXml.GetIconPath() != None) != zipHasIcon:
+            elif not self._IsSameText(myzip, zipStringsPo, stringsPoText):
                 different = True
-            
-            if (addonXml.GetFanartPath() != None) != zipHasFanart:
+            elif (addonXml.GetIconPath() != None) != (zipIcon != None):
+                different = True
+            elif (addonXml.GetFanartPath() != None) != (zipFanart != None):
+                different = True
+            elif not self._IsSameLibrary(dll.GetPath(), zipLibrary):
                 different = True
             
+            myzip.close()
+            
             if not different:
                 print('Archive %s is up to date' % zipName)
                 return True # All done here
@@ -135,18 +170,16 @@ class ReleaseArchive:
             
             # Archive differs, so bump the version and call Update() again
             addonXml.SetVersion(maxAddonVersion.Bump())
-            if not self.Update(addonXml, changeLog, dll, settingsXml, stringsPo):
+            if not self.Update(addonXml, changeLog, dll, settingsXml, stringsPo, zipPath):
                 return False
             
             # Archive has been updated to new version. Remove the old archive.
-            Environment.CheckOutput(zipDir, ['git', 'rm', zipName])
-            Environment.CheckOutput(zipDir, ['git', 'rm', zipName + MD5File.GetExtension()])
-            
-            # If git rm failed, remove the file using Python calls
-            if os.path.exists(zipPath):
-                os.remove(zipPath)
-            if os.path.exists(zipPath + MD5File.GetExtension()):
-                os.remove(zipPath + MD5File.GetExtension())
+            for extension in ['', MD5File.GetExtension(), MD5File.GetSHA256Extension()]:
+                Environment.CheckOutput(zipDir, ['git', 'rm', zipName + extension])
+                
+                # If git rm failed, remove the file using Python calls
+                if os.path.exists(zipPath + extension):
+                    os.remove(zipPath + extension)
         else:
             # Archive doesn't already exist. Create now
             assert(addonXml.GetVersion().ToString() == maxAddonVersion.ToString())
@@ -158,15 +191,17 @@ class ReleaseArchive:
             
             print('Writing archive %s' % zipName)
             
-            if self._WriteZipFile(zipPath, addonXmlText, changeLogText, settingsXmlText, stringsPoText, dll.GetPath(), addonXml.GetIconPath(), addonXml.GetFanartPath()):
-                md5File = MD5File(zipPath)
+            digestWriter = self._WriteZipFile(zipPath, addonXmlText, changeLogText, settingsXmlText, stringsPoText, dll.GetPath(), addonXml.GetIconPath(), addonXml.GetFanartPath(), previousZipPath)
+            if digestWriter:
+                # The archive was hashed while it was written
+                md5File = MD5File(zipPath, digestWriter)
                 if not md5File.Save():
                     # MD5 file failed, remove archive
-                    try:
-                        os.remove(self._path)
-                        os.remove(self._path + MD5File.GetExtension())
-                    except:
-                        pass
+                    for path in [zipPath, md5File.GetPath(), md5File.GetSHA256Path()]:
+                        try:
+                            os.remove(path)
+                        except:
+                            pass
                     return False
                 
                 # Create changelog-version.txt
@@ -180,61 +215,160 @@ class ReleaseArchive:
         
         return True
     
-    def _GetZipInfo(self, path):
-        addonXmlText    = ''
-        changeLogText   = ''
-        settingsXmlText = ''
-        stringsPoText   = ''
-        hasIcon         = False
-        hasFanart       = False
-        hasLibrary      = False
+    def _GetZipInfo(self, myzip):
+        """
+        Look up the entries of an open release archive in its central
+        directory. Returns a ZipInfo for each entry, or None if the archive
+        doesn't contain the entry. Nothing is decompressed.
+        """
+        addonXmlInfo    = None
+        changeLogInfo   = None
+        settingsXmlInfo = None
+        stringsPoInfo   = None
+        iconInfo        = None
+        fanartInfo      = None
+        libraryInfo     = None
         
-        if zipfile.is_zipfile(path):
-            myzip = zipfile.ZipFile(path, 'r')
+        for zinfo in myzip.infolist():
+            # Strip leading folder (assuming it is named addonId)
+            filename = zinfo.filename[len(self._id) + 1 : ]
             
-            for filepath in myzip.namelist():
-                # Strip leading folder (assuming it is named addonId)
-                filename = filepath[len(self._id) + 1 : ]
-                
-                if filename == AddonXml.GetFileName():
-                    addonXmlText  = myzip.read(filepath).strip()
-                elif filename == ChangeLog.GetFileName():
-                    changeLogText = myzip.read(filepath).strip()
-                elif filename.endswith(SettingsXml.GetFileName()):
-                    settingsXmlText = myzip.read(filepath).strip()
-                elif filename.endswith(StringsPo.GetFileName()):
-                    stringsPoText = myzip.read(filepath).strip()
-                elif filename == AddonXml.GetIconFileName():
-                    hasIcon = True
-                elif filename == AddonXml.GetFanartFileName():
-                    hasFanart = True
-                elif filename.endswith(Environment.GetDllExtension()):
-                    hasLibrary = True
+            if filename == AddonXml.GetFileName():
+                addonXmlInfo = zinfo
+            elif filename == ChangeLog.GetFileName():
+                changeLogInfo = zinfo
+            elif filename.endswith(SettingsXml.GetFileName()):
+                settingsXmlInfo = zinfo
+            elif filename.endswith(StringsPo.GetFileName()):
+                stringsPoInfo = zinfo
+            elif filename == AddonXml.GetIconFileName():
+                iconInfo = zinfo
+            elif filename == AddonXml.GetFanartFileName():
+                fanartInfo = zinfo
+            elif filename.endswith(Environment.GetDllExtension()):
+                libraryInfo = zinfo
         
-        return addonXmlText, changeLogText, settingsXmlText, stringsPoText, hasIcon, hasFanart, hasLibrary
+        return addonXmlInfo, changeLogInfo, settingsXmlInfo, stringsPoInfo, iconInfo, fanartInfo, libraryInfo
     
-    def _WriteZipFile(self, zipPath, addonXmlText, changeLogText, settingsXmlText, stringsPoText, dllPath, iconPath, fanartPath):
-        # Shove everything into the zip file
-        myzip = zipfile.ZipFile(zipPath, 'w', zipfile.ZIP_DEFLATED)
+    def _IsSameText(self, myzip, zinfo, text):
+        """
+        Check if the archive entry described by zinfo contains text. The CRC
+        and size from the central directory are compared first; the entry is
+        only decompressed if they disagree, in which case the texts are
+        compared ignoring leading and trailing whitespace. A missing entry is
+        the same as an empty text.
+        """
+        data = text if isinstance(text, bytes) else text.encode('utf-8')
+        if zinfo is None:
+            return not data.strip()
         
-        myzip.writestr(os.path.join(self._id, AddonXml.GetFileName()), addonXmlText)
-        #myzip.writestr(os.path.join(self._id, ChangeLog.GetFileName()), changeLogText) # TODO: Uncomment once changelogs are implemented
+        if zinfo.file_size == len(data) and zinfo.CRC == (zlib.crc32(data) & 0xffffffff):
+            return True
+        
+        return myzip.read(zinfo.filename).strip() == data.strip()
+    
+    def _IsSameLibrary(self, dllPath, zinfo):
+        """
+        Check if the archive entry described by zinfo is the library at
+        dllPath. A rebuilt library must produce a new release even if none of
+        the metadata changed.
+        """
+        if zinfo is None or zinfo.filename != os.path.join(self._id, os.path.split(dllPath)[1]):
+            return False
+        
+        return LibraryCache.GetInstance().IsSameLibrary(dllPath, zinfo)
+    
+    def _GetEntries(self, addonXmlText, changeLogText, settingsXmlText, stringsPoText, dllPath, iconPath, fanartPath):
+        """
+        Get the entries of the release archive as (arcname, text, path,
+        isLibrary) tuples. An entry has either text or the path of a file.
+        """
+        entries = [(os.path.join(self._id, AddonXml.GetFileName()), addonXmlText, None, False)]
+        #entries.append((os.path.join(self._id, ChangeLog.GetFileName()), changeLogText, None, False)) # TODO: Uncomment once changelogs are implemented
         if settingsXmlText:
-            myzip.writestr(os.path.join(self._id, RESOURCES_DIR, SettingsXml.GetFileName()), settingsXmlText)
+            entries.append((os.path.join(self._id, RESOURCES_DIR, SettingsXml.GetFileName()), settingsXmlText, None, False))
         if stringsPoText:
-            myzip.writestr(os.path.join(self._id, RESOURCES_DIR, LANGUAGES_DIR, ENGLISH_DIR, StringsPo.GetFileName()), stringsPoText)
-        myzip.write(dllPath, os.path.join(self._id, os.path.split(dllPath)[1]))
+            entries.append((os.path.join(self._id, RESOURCES_DIR, LANGUAGES_DIR, ENGLISH_DIR, StringsPo.GetFileName()), stringsPoText, None, False))
+        entries.append((os.path.join(self._id, os.path.split(dllPath)[1]), None, dllPath, True))
         if iconPath:
-            myzip.write(iconPath, os.path.join(self._id, AddonXml.GetIconFileName()))
+            entries.append((os.path.join(self._id, AddonXml.GetIconFileName()), None, iconPath, False))
         if fanartPath:
-            myzip.write(iconPath, os.path.join(self._id, AddonXml.GetFanartFileName()))
+            entries.append((os.path.join(self._id, AddonXml.GetFanartFileName()), None, fanartPath, False))
+        return entries
+    
+    def _GetManifestDigest(self, entries):
+        """
+        Get the manifest digest that ZipWriter would store for entries. The
+        CRCs of files come from the library and digest caches, so unchanged
+        files aren't read.
+        """
+        manifest = []
+        for arcname, text, path, isLibrary in entries:
+            if text is not None:
+                data = text if isinstance(text, bytes) else text.encode('utf-8')
+                manifest.append((arcname, len(data), zlib.crc32(data) & 0xffffffff, ZipWriter.GetMode(False)))
+            else:
+                if not os.path.exists(path):
+                    return None
+                if isLibrary:
+                    size, crc = LibraryCache.GetInstance().GetDigest(path)
+                else:
+                    size, crc = os.path.getsize(path), DigestCache.GetInstance().GetDigest(path, CRC32)
+                manifest.append((arcname, size, crc, ZipWriter.GetMode((os.stat(path).st_mode & 0o111) != 0)))
+        return ZipWriter.GetManifestDigest(manifest)
+    
+    def _WriteZipFile(self, zipPath, addonXmlText, changeLogText, settingsXmlText, stringsPoText, dllPath, iconPath, fanartPath, previousZipPath=None):
+        """
+        Write the release archive. Returns the DigestWriter that hashed the
+        archive as it was written.
+        """
+        # Binary entries that are unchanged can be copied from the previous
+        # archive without recompressing them, if it was compressed the same way
+        previousZip = None
+        if previousZipPath and zipfile.is_zipfile(previousZipPath):
+            previousZip = zipfile.ZipFile(previousZipPath, 'r')
         
-        return True
-
-class TestReleaseArchive(unittest.TestCase):
-    def setUp(self):
-        pass
+        # Shove everything into the zip file
+        myzip = ZipWriter(zipPath, self._policy)
+        if previousZip and not myzip.CanCopyFrom(previousZip):
+            previousZip.close()
+            previousZip = None
+        
+        for arcname, text, path, isLibrary in self._GetEntries(addonXmlText, changeLogText, settingsXmlText, stringsPoText, dllPath, iconPath, fanartPath):
+            if text is not None:
+                myzip.WriteStr(arcname, text)
+            else:
+                self._WriteOrCopyFile(myzip, previousZip, path, arcname, isLibrary)
+        
+        myzip.Close()
+        if previousZip:
+            previousZip.close()
+        
+        return myzip.GetDigestWriter()
     
+    def _WriteOrCopyFile(self, myzip, previousZip, path, arcname, isLibrary=False):
+        """
+        Copy the compressed entry from previousZip if the file hasn't changed,
+        otherwise compress the file into the archive.
+        """
+        if previousZip:
+            try:
+                zinfo = previousZip.getinfo(arcname)
+            except KeyError:
+                zinfo = None
+            
+            if isLibrary:
+                isSame = self._IsSameLibrary(path, zinfo)
+            else:
+                isSame = ZipWriter.IsSameFile(path, zinfo)
+            
+            if isSame:
+                myzip.CopyEntry(previousZip, zinfo)
+                return
+        
+        myzip.WriteFile(path, arcname)
+
+class TestReleaseArchive(DigestCacheTestCase):
     def test_addon(self):
         from libretro_super import LibretroSuper
         from addon import Addon
@@ -251,6 +385,74 @@ class TestReleaseArchive(unittest.TestCase):
             addon = Addon(dll)
             self.assertTrue(addon.IsValid())
             self.assertTrue(addon.CreateRelease())
+    
+    def test_is_same_text(self):
+        import tempfile
+        
+        text = '<addon id="gameclient.test"/>'
+        
+        zipPath = tempfile.mktemp(ARCHIVE_EXTENSION)
+        myzip = zipfile.ZipFile(zipPath, 'w', zipfile.ZIP_DEFLATED)
+        myzip.writestr('gameclient.test/addon.xml', text + '\n')
+        myzip.close()
+        
+        myzip = zipfile.ZipFile(zipPath, 'r')
+        zinfo = myzip.getinfo('gameclient.test/addon.xml')
+        releaseArchive = ReleaseArchive('gameclient.test')
+        self.assertTrue(releaseArchive._IsSameText(myzip, zinfo, text + '\n'))
+        self.assertTrue(releaseArchive._IsSameText(myzip, zinfo, text)) # CRC differs, contents don't
+        self.assertFalse(releaseArchive._IsSameText(myzip, zinfo, text.replace('test', 'tset')))
+        self.assertTrue(releaseArchive._IsSameText(myzip, None, ''))
+        self.assertFalse(releaseArchive._IsSameText(myzip, None, text))
+        myzip.close()
+        
+        # Rendered text is unicode, the archive holds its UTF-8 encoding
+        text = u'<addon id="gameclient.test" provider-name="J\u00fcrgen"/>'
+        myzip = zipfile.ZipFile(zipPath, 'w', zipfile.ZIP_DEFLATED)
+        myzip.writestr('gameclient.test/addon.xml', text.encode('utf-8'))
+        myzip.close()
+        
+        myzip = zipfile.ZipFile(zipPath, 'r')
+        zinfo = myzip.getinfo('gameclient.test/addon.xml')
+        self.assertTrue(releaseArchive._IsSameText(myzip, zinfo, text))
+        self.assertFalse(releaseArchive._IsSameText(myzip, zinfo, text.replace(u'\u00fc', u'u')))
+        myzip.close()
+        os.remove(zipPath)
+    
+    def test_max_version(self):
+        from release_catalog import RELEASE_CATALOG
+        
+        releaseDir = Environment.GetReleaseDir('gameclient.test')
+        self.assertFalse(os.path.exists(releaseDir))
+        os.makedirs(releaseDir)
+        catalog = ReleaseCatalog(os.path.join(self._dir, RELEASE_CATALOG), Environment.GetReleaseDir())
+        ReleaseCatalog._instance = catalog
+        try:
+            for version in ['1.0.0', '1.0.2']:
+                open(ReleaseArchive.GetArchivePath('gameclient.test', AddonVersion(version)), 'w').close()
+            catalog.Refresh()
+            
+            # The catalog is asked instead of listing the folder
+            listdir = os.listdir
+            def ListDir(path):
+                self.assertNotEqual(os.path.abspath(path), os.path.abspath(releaseDir))
+                return listdir(path)
+            os.listdir = ListDir
+            try:
+                releaseArchive = ReleaseArchive('gameclient.test')
+                self.assertEqual(releaseArchive._GetMaxVersion(AddonVersion('1.0.1')).ToString(), '1.0.2')
+                self.assertEqual(releaseArchive._GetMaxVersion(AddonVersion('1.1.0')).ToString(), '1.1.0')
+            finally:
+                os.listdir = listdir
+            
+            # An archive released by another builder is found in the changed folder
+            open(ReleaseArchive.GetArchivePath('gameclient.test', AddonVersion('1.0.3')), 'w').close()
+            os.utime(releaseDir, (0, 0)) # In case the clock didn't tick
+            self.assertEqual(releaseArchive._GetMaxVersion(AddonVersion('1.0.1')).ToString(), '1.0.3')
+        finally:
+            ReleaseCatalog._instance = None
+            catalog.Close()
+            shutil.rmtree(releaseDir)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,394 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from addon_version import AddonVersion
+from digest_cache import DigestCacheTestCase
+from environment import Environment
+from md5_file import MD5File
+
+import hashlib
+import os
+import re
+import sqlite3
+import time
+import unittest
+import zipfile
+
+RELEASE_CATALOG  = '.release-catalog.sqlite'
+CATALOG_VERSION  = 2
+CATALOG_TIMEOUT  = 60 # Seconds to wait for another process's transaction
+ARCHIVE_PATTERN  = re.compile(r'^(.+)-(\d+\.\d+\.\d+)\.zip$')
+SOURCE_PATTERN   = re.compile(r'Last updated [^(\n]* \(([0-9a-f]+)\)')
+
+SCHEMA = [
+    # The primary key doubles as the index for version lookups
+    'CREATE TABLE IF NOT EXISTS archives ('
+    '  id            TEXT NOT NULL,'
+    '  major         INTEGER NOT NULL,'
+    '  minor         INTEGER NOT NULL,'
+    '  build         INTEGER NOT NULL,'
+    '  version       TEXT NOT NULL,'
+    '  source_commit TEXT,'
+    '  md5           TEXT,'
+    '  sha256        TEXT,'
+    '  size          INTEGER NOT NULL,'
+    '  mtime         REAL NOT NULL,'
+    '  released      REAL NOT NULL,'
+    '  updated       REAL NOT NULL,'
+    '  PRIMARY KEY (id, major, minor, build))',
+    'CREATE INDEX IF NOT EXISTS archives_by_commit ON archives (source_commit)',
+    # The mtime of each add-on's release folder when its archives were catalogued
+    'CREATE TABLE IF NOT EXISTS folders ('
+    '  id            TEXT NOT NULL PRIMARY KEY,'
+    '  mtime         REAL NOT NULL)',
+]
+
+COLUMNS = ['id', 'version', 'source_commit', 'md5', 'sha256', 'size', 'mtime', 'released', 'updated']
+
+class ReleaseCatalog:
+    """
+    SQLite catalog of the release archives in /release/<platform>: the ID,
+    version, source commit, digests, size and timestamps of every archive.
+    Version lookups use the table's index instead of listing and parsing the
+    release folders.
+    
+    The release run records each archive it released or found up to date, and
+    commits them in one transaction when it's done (see Commit()), so an
+    interrupted run leaves the catalog as it was. The catalog isn't in git, so
+    archives can also appear or disappear behind its back, e.g. when the tree
+    is pulled from another builder. The mtime of every add-on's folder is
+    catalogued with its archives: while it is unchanged, the rows describe
+    the folder (see IsFolderCurrent()). A folder that changed is catalogued
+    again when its add-on is recorded, or by Refresh().
+    
+    The catalog only describes the tree, so it can always be rebuilt from the
+    archives (see Rebuild(), or create_release.py --rebuild-catalog). A new
+    catalog is rebuilt when it is first opened.
+    """
+    
+    _instance = None
+    
+    @staticmethod
+    def GetInstance():
+        # Connections can't be shared with forked worker processes
+        if not ReleaseCatalog._instance or ReleaseCatalog._instance._pid != os.getpid():
+            ReleaseCatalog._instance = ReleaseCatalog(os.path.join(Environment.GetReleaseDir(), RELEASE_CATALOG))
+        return ReleaseCatalog._instance
+    
+    @staticmethod
+    def ParseArchiveName(filename):
+        """
+        Get the (ID, version string) of a release archive's file name, or None
+        if it isn't one.
+        """
+        match = ARCHIVE_PATTERN.match(filename)
+        if not match:
+            return None
+        return match.group(1), match.group(2)
+    
+    @staticmethod
+    def ReadSourceCommit(addonXmlText):
+        """
+        Get the abbreviated commit from the description in addon.xml, or None.
+        """
+        match = SOURCE_PATTERN.search(addonXmlText)
+        return match.group(1) if match else None
+    
+    @staticmethod
+    def _ReadDigest(path):
+        try:
+            with open(path) as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+    
+    @staticmethod
+    def _ReadDigests(archivePath):
+        """
+        Get the (MD5, SHA-256) of an archive from the .md5 and .sha256 files
+        next to it, or by reading it if they're missing.
+        """
+        md5    = ReleaseCatalog._ReadDigest(archivePath + MD5File.GetExtension())
+        sha256 = ReleaseCatalog._ReadDigest(archivePath + MD5File.GetSHA256Extension())
+        if not md5 or not sha256:
+            md5File = MD5File(archivePath)
+            md5, sha256 = md5File.GetMD5(), md5File.GetSHA256()
+        return md5, sha256
+    
+    def __init__(self, path, releaseDir=None):
+        self._path       = path
+        self._releaseDir = releaseDir or os.path.dirname(path)
+        self._pid        = os.getpid()
+        
+        if not os.path.exists(self._releaseDir):
+            os.makedirs(self._releaseDir)
+        
+        self._connection = sqlite3.connect(path, timeout=CATALOG_TIMEOUT)
+        
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            # New catalog, or one written by another version: start over
+            self._connection.execute('DROP TABLE IF EXISTS archives')
+            self._connection.execute('DROP TABLE IF EXISTS folders')
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+            self._connection.execute('PRAGMA user_version = %d' % CATALOG_VERSION)
+            self.Rebuild()
+            self.Commit()
+    
+    def Close(self):
+        self._connection.close()
+    
+    def Commit(self):
+        self._connection.commit()
+    
+    def Rollback(self):
+        self._connection.rollback()
+    
+    def _GetFolderMtime(self, addonId):
+        try:
+            return os.stat(os.path.join(self._releaseDir, addonId)).st_mtime
+        except OSError:
+            return None
+    
+    def IsFolderCurrent(self, addonId):
+        """
+        True if the release folder of addonId hasn't changed since its
+        archives were catalogued, so that the catalog can be trusted about it.
+        This costs a stat of the folder instead of listing it.
+        """
+        row = self._connection.execute('SELECT mtime FROM folders WHERE id = ?', (addonId, )).fetchone()
+        return row is not None and row[0] == self._GetFolderMtime(addonId)
+    
+    def GetMaxVersion(self, addonId):
+        """
+        Get the highest version of addonId in the catalog as an AddonVersion,
+        or None if it has no archives.
+        """
+        row = self._connection.execute('SELECT version FROM archives WHERE id = ? '
+                                       'ORDER BY major DESC, minor DESC, build DESC LIMIT 1', (addonId, )).fetchone()
+        return AddonVersion(str(row[0])) if row else None
+    
+    def GetArchive(self, addonId, addonVersion):
+        """
+        Get the row of an archive as a dict of COLUMNS, or None.
+        """
+        major, minor, build = addonVersion.ToParts()
+        row = self._connection.execute('SELECT %s FROM archives WHERE id = ? AND major = ? AND minor = ? AND build = ?' % ', '.join(COLUMNS),
+                                       (addonId, major, minor, build)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+    
+    def GetCurrent(self):
+        """
+        Get the row of the highest version of every add-on, ordered by ID.
+        """
+        current = []
+        for row in self._connection.execute('SELECT %s FROM archives ORDER BY id, major DESC, minor DESC, build DESC' % ', '.join(COLUMNS)):
+            if not current or current[-1]['id'] != row[0]:
+                current.append(dict(zip(COLUMNS, row)))
+        return current
+    
+    def Record(self, addonId, addonVersion, archivePath, sourceCommit=None):
+        """
+        Record the archive of addonVersion at archivePath. Its digests are read
+        from the .md5 and .sha256 files next to it. An archive whose size and
+        mtime are unchanged isn't read again; its source commit is only
+        replaced if sourceCommit is given. Nothing is committed until Commit().
+        """
+        stat = os.stat(archivePath)
+        row = self.GetArchive(addonId, addonVersion)
+        now = time.time()
+        
+        if row and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime:
+            if sourceCommit and sourceCommit != row['source_commit']:
+                major, minor, build = addonVersion.ToParts()
+                self._connection.execute('UPDATE archives SET source_commit = ?, updated = ? WHERE id = ? AND major = ? AND minor = ? AND build = ?',
+                                         (sourceCommit, now, addonId, major, minor, build))
+        else:
+            md5, sha256 = ReleaseCatalog._ReadDigests(archivePath)
+            self._Insert(addonId, addonVersion, sourceCommit or (row and row['source_commit']), md5, sha256,
+                         stat, row['released'] if row else now, now)
+        
+        # Older versions are removed from the tree when a new one is released,
+        # and others may have been pulled since the folder was catalogued
+        if not self.IsFolderCurrent(addonId):
+            self._RecordFolder(addonId)
+    
+    def _Insert(self, addonId, addonVersion, sourceCommit, md5, sha256, stat, released, updated):
+        major, minor, build = addonVersion.ToParts()
+        self._connection.execute('INSERT OR REPLACE INTO archives '
+                                 '(id, major, minor, build, version, source_commit, md5, sha256, size, mtime, released, updated) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (addonId, major, minor, build, addonVersion.ToString(), sourceCommit, md5, sha256,
+                                  stat.st_size, stat.st_mtime, released, updated))
+    
+    def _Delete(self, addonId, addonVersion):
+        major, minor, build = addonVersion.ToParts()
+        self._connection.execute('DELETE FROM archives WHERE id = ? AND major = ? AND minor = ? AND build = ?',
+                                 (addonId, major, minor, build))
+    
+    def _RecordFolder(self, addonId):
+        """
+        Catalog the archives in the release folder of addonId that aren't in
+        the catalog yet, and drop the rows of archives that are gone. Source
+        commits are read from each new archive's addon.xml, and the archive's
+        mtime stands in for its release time. Returns the number of archives
+        in the folder.
+        """
+        addonDir = os.path.join(self._releaseDir, addonId)
+        
+        # Taken before listing, so that a change while listing is seen next time
+        mtime = self._GetFolderMtime(addonId)
+        filenames = sorted(os.listdir(addonDir)) if mtime is not None else []
+        
+        versions = set()
+        for filename in filenames:
+            parsed = ReleaseCatalog.ParseArchiveName(filename)
+            if not parsed or parsed[0] != addonId:
+                continue
+            
+            addonVersion = AddonVersion(parsed[1])
+            versions.add(addonVersion.ToString())
+            if self.GetArchive(addonId, addonVersion):
+                continue
+            
+            archivePath = os.path.join(addonDir, filename)
+            sourceCommit = None
+            try:
+                myzip = zipfile.ZipFile(archivePath, 'r')
+                try:
+                    sourceCommit = ReleaseCatalog.ReadSourceCommit(myzip.read(addonId + '/addon.xml').decode('utf-8'))
+                finally:
+                    myzip.close()
+            except (IOError, KeyError, zipfile.BadZipfile):
+                pass # Catalogued without a source commit
+            
+            stat = os.stat(archivePath)
+            md5, sha256 = ReleaseCatalog._ReadDigests(archivePath)
+            self._Insert(addonId, addonVersion, sourceCommit, md5, sha256, stat, stat.st_mtime, time.time())
+        
+        for version, in self._connection.execute('SELECT version FROM archives WHERE id = ?', (addonId, )).fetchall():
+            if str(version) not in versions:
+                self._Delete(addonId, AddonVersion(str(version)))
+        
+        if mtime is None:
+            self._connection.execute('DELETE FROM folders WHERE id = ?', (addonId, ))
+        else:
+            self._connection.execute('INSERT OR REPLACE INTO folders (id, mtime) VALUES (?, ?)', (addonId, mtime))
+        
+        return len(versions)
+    
+    def Refresh(self):
+        """
+        Catalog the release folders that changed since they were catalogued.
+        Returns the number of folders that were listed. Nothing is committed
+        until Commit().
+        """
+        addonIds = set([addonId for addonId in os.listdir(self._releaseDir) if os.path.isdir(os.path.join(self._releaseDir, addonId))])
+        addonIds.update([row[0] for row in self._connection.execute('SELECT DISTINCT id FROM archives').fetchall()])
+        
+        changed = [addonId for addonId in sorted(addonIds) if not self.IsFolderCurrent(addonId)]
+        for addonId in changed:
+            self._RecordFolder(addonId)
+        return len(changed)
+    
+    def Rebuild(self):
+        """
+        Replace the catalog with the archives found in the release folders.
+        Returns the number of archives found. Nothing is committed until
+        Commit().
+        """
+        self._connection.execute('DELETE FROM archives')
+        self._connection.execute('DELETE FROM folders')
+        
+        count = 0
+        for addonId in sorted(os.listdir(self._releaseDir)):
+            if os.path.isdir(os.path.join(self._releaseDir, addonId)):
+                count += self._RecordFolder(addonId)
+        
+        return count
+
+class TestReleaseCatalog(DigestCacheTestCase):
+    def _CreateArchive(self, addonId, version, sourceCommit):
+        from zip_writer import ZipWriter
+        
+        addonDir = os.path.join(self._dir, addonId)
+        if not os.path.exists(addonDir):
+            os.makedirs(addonDir)
+        
+        path = os.path.join(addonDir, '%s-%s.zip' % (addonId, version))
+        writer = ZipWriter(path)
+        writer.WriteStr(addonId + '/addon.xml', '<description>Last updated 2014-1-1 (%s)</description>' % sourceCommit)
+        writer.Close()
+        MD5File(path, writer.GetDigestWriter()).Save()
+        return path
+    
+    def test_release_catalog(self):
+        self._CreateArchive('gameclient.bnes', '1.0.0', 'abcdef0')
+        self._CreateArchive('gameclient.bnes', '1.0.10', 'abcdef1')
+        self._CreateArchive('gameclient.bnes', '1.0.9', 'abcdef2')
+        fceumm = self._CreateArchive('gameclient.fceumm', '1.2.0', '1234567')
+        
+        # A new catalog is rebuilt from the tree
+        path = os.path.join(self._dir, RELEASE_CATALOG)
+        catalog = ReleaseCatalog(path)
+        self.assertEqual(catalog.GetMaxVersion('gameclient.bnes').ToString(), '1.0.10')
+        self.assertEqual(catalog.GetMaxVersion('gameclient.missing'), None)
+        self.assertEqual([(row['id'], row['version'], row['source_commit']) for row in catalog.GetCurrent()],
+                         [('gameclient.bnes', '1.0.10', 'abcdef1'), ('gameclient.fceumm', '1.2.0', '1234567')])
+        
+        row = catalog.GetArchive('gameclient.fceumm', AddonVersion('1.2.0'))
+        self.assertEqual(row['size'], os.path.getsize(fceumm))
+        with open(fceumm, 'rb') as f:
+            self.assertEqual(row['md5'], hashlib.md5(f.read()).hexdigest())
+        
+        # A new version replaces the old one, once committed
+        newFceumm = self._CreateArchive('gameclient.fceumm', '1.2.1', '7654321')
+        os.remove(fceumm)
+        catalog.Record('gameclient.fceumm', AddonVersion('1.2.1'), newFceumm, '7654321')
+        otherCatalog = ReleaseCatalog(path)
+        self.assertEqual(otherCatalog.GetMaxVersion('gameclient.fceumm').ToString(), '1.2.0')
+        otherCatalog.Close()
+        catalog.Commit()
+        catalog.Close()
+        
+        catalog = ReleaseCatalog(path)
+        self.assertEqual(catalog.GetMaxVersion('gameclient.fceumm').ToString(), '1.2.1')
+        self.assertEqual(catalog.GetArchive('gameclient.fceumm', AddonVersion('1.2.0')), None)
+        
+        # Archives pulled from another builder are caught by the folder's mtime
+        self.assertTrue(catalog.IsFolderCurrent('gameclient.bnes'))
+        self._CreateArchive('gameclient.bnes', '1.0.11', 'abcdef3')
+        os.utime(os.path.join(self._dir, 'gameclient.bnes'), (0, 0)) # In case the clock didn't tick
+        self.assertFalse(catalog.IsFolderCurrent('gameclient.bnes'))
+        self.assertEqual(catalog.Refresh(), 1)
+        self.assertTrue(catalog.IsFolderCurrent('gameclient.bnes'))
+        self.assertEqual(catalog.GetMaxVersion('gameclient.bnes').ToString(), '1.0.11')
+        self.assertEqual(catalog.GetArchive('gameclient.bnes', AddonVersion('1.0.11'))['source_commit'], 'abcdef3')
+        self.assertEqual(catalog.Refresh(), 0)
+        
+        # Rebuilding gives the same catalog
+        current = catalog.GetCurrent()
+        self.assertEqual(catalog.Rebuild(), 5)
+        self.assertEqual([(row['id'], row['version'], row['md5']) for row in catalog.GetCurrent()],
+                         [(row['id'], row['version'], row['md5']) for row in current])
+        catalog.Close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from addon_version import AddonVersion
+from digest_cache import DigestCache
+from digest_cache import SHA256
+from environment import Environment
+from release_archive import ReleaseArchive
+from utils import TempDirTestCase
+from utils import loadJsonCache
+from utils import saveJsonCache
+
+import hashlib
+import json
+import os
+import unittest
+import zipfile
+
+RELEASE_MANIFEST = 'manifest.json'
+
+class ReleasedAddon(object):
+    """
+    An add-on whose release archive is up to date. Stands in for Addon in
+    the add-on index without touching the archive, unless the index needs
+    the add-on's addon.xml.
+    
+    This is the only thing kept of each add-on during a release run, so it
+    stays small: an ID, a version, a path and at most the addon.xml text.
+    """
+    
+    __slots__ = ['_id', '_addonVersion', '_archivePath', '_addonXmlText']
+    
+    @staticmethod
+    def FromAddon(addon):
+        """
+        Get the index record of an add-on that was just released. Its
+        addon.xml is kept, as the index needs it for a new version.
+        """
+        archivePath = ReleaseArchive.GetArchivePath(addon.GetID(), addon.GetVersion())
+        return ReleasedAddon(addon.GetID(), addon.GetVersion(), archivePath, addon.GetAddonXmlText())
+    
+    def __init__(self, id, addonVersion, archivePath, addonXmlText=None):
+        self._id           = id
+        self._addonVersion = addonVersion
+        self._archivePath  = archivePath
+        self._addonXmlText = addonXmlText
+    
+    def GetID(self):
+        return self._id
+    
+    def GetVersion(self):
+        return self._addonVersion
+    
+    def GetArchivePath(self):
+        return self._archivePath
+    
+    def GetAddonXmlText(self):
+        if self._addonXmlText is not None:
+            return self._addonXmlText
+        myzip = zipfile.ZipFile(self._archivePath, 'r')
+        try:
+            return myzip.read(self._id + '/addon.xml')
+        finally:
+            myzip.close()
+    
+    def GetAddonXmlDigest(self):
+        """
+        Get the SHA-256 of the archive that holds the add-on's addon.xml. It
+        comes from the digest cache, so the archive isn't read again.
+        """
+        return DigestCache.GetInstance().GetDigest(self._archivePath, SHA256)
+
+class ReleaseManifest:
+    """
+    Records the project commit and info file that each released add-on was
+    built from. A core is only rebuilt and repackaged if either changed since
+    its last release (see create_release.py --incremental).
+    
+    The manifest is kept in the release directory, next to the archives it
+    describes.
+    """
+    
+    @staticmethod
+    def GetInfoDigest(info):
+        """
+        Digest of the info file's key-value pairs, computed without reading
+        the file again.
+        """
+        return hashlib.md5(json.dumps(info.GetValues(), sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def __init__(self, path=None):
+        self._path   = path or os.path.join(Environment.GetReleaseDir(), RELEASE_MANIFEST)
+        self._addons = { } # id -> {'project', 'commit', 'info', 'version'}
+        
+        # Missing or corrupt manifest: everything is rebuilt
+        self._addons.update(loadJsonCache(self._path).get('addons', { }))
+    
+    def Save(self):
+        saveJsonCache(self._path, {'addons': self._addons}, indent=4, sort_keys=True, separators=(',', ': '))
+    
+    @staticmethod
+    def GetEntry(addon):
+        """
+        Get the manifest entry of a released add-on, so that a worker process
+        can compute it and the parent only receives the entry.
+        """
+        dll = addon.GetDll()
+        return {
+            'project': dll.GetProject().GetName(),
+            'commit':  dll.GetProject().GetVersionHash(),
+            'info':    ReleaseManifest.GetInfoDigest(dll.GetInfo()),
+            'version': addon.GetVersion().ToString(),
+        }
+    
+    def Record(self, addon):
+        """
+        Remember the sources of a released add-on.
+        """
+        self.RecordEntry(addon.GetID(), ReleaseManifest.GetEntry(addon))
+    
+    def RecordEntry(self, id, entry):
+        self._addons[id] = entry
+    
+    def GetChangedProjects(self, projects):
+        """
+        Get the projects whose HEAD isn't the commit of any release.
+        """
+        released = set([(entry['project'], entry['commit']) for entry in self._addons.values()])
+        return [project for project in projects if (project.GetName(), project.GetVersionHash()) not in released]
+    
+    def GetReleasedAddon(self, dll):
+        """
+        If the release archive of dll is up to date, get a ReleasedAddon for
+        it. Returns None if the DLL needs to be packaged.
+        """
+        entry = self._addons.get(dll.GetID())
+        if not entry:
+            return None
+        if entry['project'] != dll.GetProject().GetName() or entry['commit'] != dll.GetProject().GetVersionHash():
+            return None
+        if entry['info'] != ReleaseManifest.GetInfoDigest(dll.GetInfo()):
+            return None
+        
+        addonVersion = AddonVersion(entry['version'])
+        archivePath = ReleaseArchive.GetArchivePath(dll.GetID(), addonVersion)
+        if not os.path.exists(archivePath):
+            return None
+        
+        return ReleasedAddon(dll.GetID(), addonVersion, archivePath)
+
+class TestReleaseManifest(TempDirTestCase):
+    def test_release_manifest(self):
+        from libretro_info import LibretroInfo
+        
+        class Project:
+            def __init__(self, name, versionHash):
+                self._name = name
+                self._versionHash = versionHash
+            def GetName(self): return self._name
+            def GetVersionHash(self): return self._versionHash
+        
+        class Dll:
+            def __init__(self, project, info):
+                self._project = project
+                self._info = info
+            def GetID(self): return 'gameclient.test'
+            def GetProject(self): return self._project
+            def GetInfo(self): return self._info
+        
+        class Addon:
+            def __init__(self, dll):
+                self._dll = dll
+            def GetID(self): return self._dll.GetID()
+            def GetDll(self): return self._dll
+            def GetVersion(self): return AddonVersion('1.0.1')
+        
+        info = LibretroInfo('test_libretro.info', {'display_version': 'v1.0'})
+        dll = Dll(Project('test', 'abcdef0'), info)
+        
+        path = os.path.join(self._dir, RELEASE_MANIFEST)
+        manifest = ReleaseManifest(path)
+        self.assertEqual(manifest.GetChangedProjects([dll.GetProject()]), [dll.GetProject()])
+        
+        manifest.Record(Addon(dll))
+        manifest.Save()
+        
+        manifest = ReleaseManifest(path)
+        self.assertEqual(manifest.GetChangedProjects([dll.GetProject()]), [])
+        self.assertEqual(manifest.GetChangedProjects([Project('test', '1234567')])[0].GetName(), 'test')
+        
+        # Info hasn't changed, but the archive is missing
+        self.assertEqual(manifest.GetReleasedAddon(dll), None)
+        
+        # A record of a new release doesn't need to read its archive
+        releasedAddon = ReleasedAddon('gameclient.test', AddonVersion('1.0.1'), os.path.join(self._dir, 'missing.zip'), '<addon/>')
+        self.assertEqual(releasedAddon.GetAddonXmlText(), '<addon/>')
+
+if __name__ == '__main__':
+    unittest.main()
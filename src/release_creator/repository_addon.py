@@ -19,16 +19,21 @@
 
 from addon_version import AddonVersion
 from addon_xml import AddonXml
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import SHA256
 from environment import Environment
 from md5_file import MD5File
 from release_archive import ReleaseArchive
+from zip_writer import ZipWriter
 
 import os
+import re
 import shutil
 import unittest
-import zipfile
 
 REPO_ADDON_ID               = 'repository.libretro-%s'
+ADDON_VERSION               = re.compile(r'<addon\b[^>]*\sversion="([^"]*)"')
 
 class RepositoryAddon:
     def __init__(self):
@@ -37,15 +42,46 @@ class RepositoryAddon:
     def GetID(self):
         return self._id
     
+    def GetVersion(self):
+        match = ADDON_VERSION.search(self.GetAddonXmlText())
+        return AddonVersion(match.group(1) if match else '1.0.0')
+    
+    def GetAddonXmlPath(self):
+        return os.path.join(Environment.GetAddonDir(self._id), AddonXml.GetFileName())
+    
     def GetAddonXmlText(self):
         addonXmlText = ''
         
-        addonXmlPath = os.path.join(Environment.GetAddonDir(self._id), AddonXml.GetFileName())
-        with open(addonXmlPath, 'r') as f:
+        with open(self.GetAddonXmlPath(), 'r') as f:
             addonXmlText = f.read().strip()
         
         return addonXmlText
     
+    def GetAddonXmlDigest(self):
+        return DigestCache.GetInstance().GetDigest(self.GetAddonXmlPath(), SHA256)
+    
+    def _RemoveOldArchives(self, version):
+        """
+        Remove the archives (and their digest files) of every version other
+        than version, like ReleaseArchive does when it bumps an add-on.
+        """
+        zipDir = Environment.GetReleaseDir(self._id)
+        for filename in os.listdir(zipDir):
+            if not filename.startswith(self._id + '-') or not filename.endswith(ReleaseArchive.GetExtension()):
+                continue
+            
+            # The ID contains a '-', so the version follows the ID's length
+            if filename[len(self._id) + 1 : -len(ReleaseArchive.GetExtension())] == version.ToString():
+                continue
+            
+            print('Removing superseded archive %s' % filename)
+            for extension in ['', MD5File.GetExtension(), MD5File.GetSHA256Extension()]:
+                Environment.CheckOutput(zipDir, ['git', 'rm', filename + extension])
+                
+                # If git rm failed, remove the file using Python calls
+                if os.path.exists(os.path.join(zipDir, filename + extension)):
+                    os.remove(os.path.join(zipDir, filename + extension))
+    
     def CreateRelease(self):
         """
         Create a release archive (and associated files like md5 and changelog)
@@ -53,9 +89,9 @@ class RepositoryAddon:
         """
         print('Creating release archive for %s' % self._id)
         
-        version = AddonVersion('1.0.0') # TODO: Read from addon.xml
+        version = self.GetVersion()
         
-        addonXmlPath = os.path.join(Environment.GetAddonDir(self._id), AddonXml.GetFileName())
+        addonXmlPath = self.GetAddonXmlPath()
         iconPngPath  = os.path.join(Environment.GetAddonDir(self._id), AddonXml.GetIconFileName())
         
         if not os.path.exists(Environment.GetReleaseDir(self._id)):
@@ -64,11 +100,12 @@ class RepositoryAddon:
         # Shove everything into the zip file
         zipPath = ReleaseArchive.GetArchivePath(self._id, version)
         if not os.path.exists(zipPath):
-            myzip = zipfile.ZipFile(zipPath, 'w', zipfile.ZIP_DEFLATED)
-            myzip.write(addonXmlPath, os.path.join(self._id, AddonXml.GetFileName()))
-            myzip.write(iconPngPath, os.path.join(self._id, AddonXml.GetIconFileName()))
+            myzip = ZipWriter(zipPath)
+            myzip.WriteFile(addonXmlPath, os.path.join(self._id, AddonXml.GetFileName()))
+            myzip.WriteFile(iconPngPath, os.path.join(self._id, AddonXml.GetIconFileName()))
+            myzip.Close()
             
-            md5File = MD5File(zipPath)
+            md5File = MD5File(zipPath, myzip.GetDigestWriter())
             if not md5File.Save():
                 print('Failed to create release archive for %s' % self._id)
                 try:
@@ -79,13 +116,16 @@ class RepositoryAddon:
         else:
             print('Archive %s is up to date' % os.path.split(zipPath)[1])
         
+        self._RemoveOldArchives(version)
+        
         if os.path.exists(iconPngPath):
             shutil.copy2(iconPngPath, os.path.join(Environment.GetReleaseDir(self._id), AddonXml.GetIconFileName()))
         
         return True
 
-class TestRepositoryAddon(unittest.TestCase):
+class TestRepositoryAddon(DigestCacheTestCase):
     def setUp(self):
+        DigestCacheTestCase.setUp(self)
         repositoryAddon = RepositoryAddon()
         archiveDir = Environment.GetReleaseDir(repositoryAddon.GetID())
         if os.path.exists(archiveDir):
@@ -96,8 +136,24 @@ class TestRepositoryAddon(unittest.TestCase):
     def test_repository_addon(self):
         repositoryAddon = RepositoryAddon()
         self.assertNotEqual(repositoryAddon.GetAddonXmlText(), '')
+        self.assertEqual(repositoryAddon.GetVersion().ToString(), '1.0.1')
+        self.assertTrue(repositoryAddon.CreateRelease())
         self.assertTrue(repositoryAddon.CreateRelease())
+    
+    def test_remove_old_archives(self):
+        repositoryAddon = RepositoryAddon()
+        archiveDir = Environment.GetReleaseDir(repositoryAddon.GetID())
+        os.makedirs(archiveDir)
+        
+        # A version that isn't in git, so only the file is removed
+        oldPath = ReleaseArchive.GetArchivePath(repositoryAddon.GetID(), AddonVersion('0.9.0'))
+        for extension in ['', MD5File.GetExtension(), MD5File.GetSHA256Extension()]:
+            open(oldPath + extension, 'w').close()
+        
         self.assertTrue(repositoryAddon.CreateRelease())
+        self.assertTrue(os.path.exists(ReleaseArchive.GetArchivePath(repositoryAddon.GetID(), repositoryAddon.GetVersion())))
+        for extension in ['', MD5File.GetExtension(), MD5File.GetSHA256Extension()]:
+            self.assertFalse(os.path.exists(oldPath + extension))
 
 if __name__ == '__main__':
     unittest.main()
@@ -24,7 +24,9 @@ import unittest
 
 SETTINGS_XML  = 'settings.xml'
 
-class SettingsXml:
+class SettingsXml(object):
+    __slots__ = ['_id', '_path']
+    
     @staticmethod
     def GetFileName():
         return SETTINGS_XML
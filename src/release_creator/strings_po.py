@@ -18,13 +18,16 @@
 # *
 
 from environment import Environment
+from template import Template
 
 import os
 import unittest
 
 STRINGS_PO  = 'strings.po'
 
-class StringsPo:
+class StringsPo(object):
+    __slots__ = ['_id', '_path', '_addonXml']
+    
     @staticmethod
     def GetFileName():
         return STRINGS_PO
@@ -42,8 +45,9 @@ class StringsPo:
         Read strings.po file
         """
         if self.IsValid():
-            with open(self._path) as f:
-                return '\n'.join([self._addonXml.ReplaceTokens(line.strip()) for line in f.read().splitlines()])
+            template = Template.Load(self._path, True)
+            if template:
+                return template.Render(self._addonXml.GetProperty)
         return ''
 
 class TestSettingsXml(unittest.TestCase):
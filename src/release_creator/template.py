@@ -0,0 +1,211 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+import re
+import unittest
+
+TOKEN_DELIMITER = '@'
+
+# Validate on XML identifiers (assuming ASCII characters)
+VALID_TOKEN = re.compile('^[A-Za-z:_][A-Za-z0-9:_.-]*$')
+
+class Template:
+    """
+    A text file containing tokens (like @tokenname@) that are replaced by
+    properties when the template is rendered. Templates are parsed once into
+    a list of literal and token slots per line, so rendering is a single
+    pass that only looks up each property.
+    
+    If a property's value contains a token, it is replaced as well (tokens
+    are recursive), e.g. a description containing @extensions@.
+    """
+    
+    _cache = { }
+    
+    @staticmethod
+    def Load(path, stripLines=False):
+        """
+        Load and compile the template at path. Templates are cached, so each
+        file is only read and parsed once per process. If stripLines is True,
+        leading and trailing whitespace is removed from every line. Returns
+        None if the file can't be read.
+        """
+        key = (path, stripLines)
+        if key not in Template._cache:
+            try:
+                with open(path) as f:
+                    lines = f.read().splitlines(False) # Don't keep line endings
+            except IOError:
+                return None
+            if stripLines:
+                lines = [line.strip() for line in lines]
+            Template._cache[key] = Template(lines)
+        return Template._cache[key]
+    
+    @staticmethod
+    def ReplaceTokens(line, getProperty):
+        """
+        Replace tokens in line with the value returned by getProperty(token).
+        Scanning resumes at the start of each replaced value, so tokens inside
+        values are replaced too.
+        """
+        # Skip characters at the beginning of line (increases for every processed token)
+        skip = 0
+        
+        while True:
+            index1 = line.find(TOKEN_DELIMITER, skip) + 1
+            if index1 == 0:
+                break
+            index2 = line.find(TOKEN_DELIMITER, index1)
+            if index2 < 0:
+                break
+            token = line[index1 : index2]
+            
+            # Make sure that discovered token is a valid XML identifier (no spaces, etc)
+            if VALID_TOKEN.match(token):
+                line = line[ : index1 - 1] + getProperty(token) + line[index2 + 1 : ]
+                skip = index1 - 1 # Rewind 1 character so that tokens can be recursive
+            else:
+                skip = index1
+        
+        return line
+    
+    @staticmethod
+    def _Compile(line):
+        """
+        Split a line into literal strings and token slots. A token slot is a
+        tuple (token, rest) where rest is the index in line following the
+        token, needed if the token's value contains another token.
+        """
+        segments = []
+        literal  = []
+        skip     = 0
+        
+        while True:
+            index1 = line.find(TOKEN_DELIMITER, skip) + 1
+            if index1 == 0:
+                break
+            index2 = line.find(TOKEN_DELIMITER, index1)
+            if index2 < 0:
+                break
+            token = line[index1 : index2]
+            
+            if VALID_TOKEN.match(token):
+                literal.append(line[skip : index1 - 1])
+                if ''.join(literal):
+                    segments.append(''.join(literal))
+                literal = []
+                segments.append((token, index2 + 1))
+                skip = index2 + 1
+            else:
+                literal.append(line[skip : index1])
+                skip = index1
+        
+        literal.append(line[skip : ])
+        if ''.join(literal):
+            segments.append(''.join(literal))
+        
+        return segments
+    
+    def __init__(self, lines):
+        self._lines    = lines
+        self._segments = [Template._Compile(line) for line in lines]
+    
+    def GetLines(self):
+        return self._lines
+    
+    def RenderLine(self, index, getProperty):
+        """
+        Render line number index of the template.
+        """
+        line     = self._lines[index]
+        rendered = []
+        
+        for segment in self._segments[index]:
+            if isinstance(segment, tuple):
+                token, rest = segment
+                value = getProperty(token)
+                if TOKEN_DELIMITER in value:
+                    # Value may contain tokens of its own (possibly completed
+                    # by the rest of the line), so finish the line the slow way
+                    rendered.append(Template.ReplaceTokens(value + line[rest : ], getProperty))
+                    break
+                rendered.append(value)
+            else:
+                rendered.append(segment)
+        
+        return ''.join(rendered)
+    
+    def Render(self, getProperty):
+        """
+        Render the template, calling getProperty(token) for the value of each
+        token. Each property is only looked up once per render.
+        """
+        properties = { }
+        def getCachedProperty(token):
+            if token not in properties:
+                properties[token] = getProperty(token)
+            return properties[token]
+        
+        return '\n'.join([self.RenderLine(i, getCachedProperty) for i in range(len(self._lines))])
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        pass
+    
+    def test_template(self):
+        properties = {
+            'id':          'gameclient.test',
+            'name':        'Test',
+            'description': 'Supported files: @extensions@',
+            'extensions':  'nes|zip',
+            'authors':     'me@example.com, you@example.com',
+            'partial':     '@exten',
+        }
+        getProperty = lambda token: properties.get(token, '')
+        
+        lines = [
+            '<addon id="@id@" name="@name@">',
+            '<description>@description@</description>',
+            'provider-name="@authors@"',
+            'email@address @ no token @',
+            '@partial@sions@',
+            '@@id@@',
+            'no tokens',
+            '',
+        ]
+        expected = [
+            '<addon id="gameclient.test" name="Test">',
+            '<description>Supported files: nes|zip</description>',
+            'provider-name="me@example.com, you@example.com"',
+            'email@address @ no token @',
+            'nes|zip',
+            '@gameclient.test@',
+            'no tokens',
+            '',
+        ]
+        
+        template = Template(lines)
+        for i in range(len(lines)):
+            self.assertEqual(template.RenderLine(i, getProperty), expected[i])
+            self.assertEqual(Template.ReplaceTokens(lines[i], getProperty), expected[i])
+        self.assertEqual(template.Render(getProperty), '\n'.join(expected))
+
+if __name__ == '__main__':
+    unittest.main()
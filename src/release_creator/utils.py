@@ -18,27 +18,37 @@
 # *
 
 import difflib
+import json
+import os
+import re
+import shutil
+import tempfile
 import unittest
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# Scripts include others with lines like ". ./libretro-config.sh" or
+# source "$BASE_DIR/libretro-build-common.sh"
+SOURCE_COMMAND = re.compile(r'^\s*(?:\.|source)\s+["\']?(?:\$\{?\w+\}?/|\$\([^)]*\)/|\./)?([^"\'\s;$]+)["\']?', re.MULTILINE)
+
 # I decided to use fuzzy-string matching to associate compiled libretro cores
 # with the project folder in /libretro-super that they came from. In hindsight,
 # this was a poor decision because false detections are too likely. For example,
 # 'nxengine' matches '3dengine' over 'nx'.
-
-# This array hard-codes DLL-to-project  mappings. Problematic matches can be
-# added here, giving a hybrid fuzzy vs. hardcoded matching algorithm. It is
-# evident that a much better system is in need. 
-DLL_TO_PROJECT = {
-    'nxengine': 'nx',
-    'snes9x':   's9x',
-}
+#
+# Problematic matches are hard-coded in /src/dll_to_project.json, giving a
+# hybrid fuzzy vs. hardcoded matching algorithm (see ProjectResolver).
 
 # Use fuzzy string matching to decide which libretro project the compiled DLL
-# came from. This should be renamed to reflect the special cases defined above.
+# came from.
 def getClosestMatch(needle, haystack):
-    if needle in DLL_TO_PROJECT:
-        return DLL_TO_PROJECT[needle]
-    
     matches = difflib.get_close_matches(needle, haystack)
     if not matches:
         return None
@@ -53,26 +63,172 @@ def getClosestMatch(needle, haystack):
             maximum = ratio
     return bestMatch
 
-class TestLibretroUtils(unittest.TestCase):
+def getSourcedScripts(scriptPath):
+    """
+    Get scriptPath followed by the shell scripts it sources, directly or from
+    a sourced script. Sourced paths are relative to the directory of
+    scriptPath, whatever variable they start with. Scripts that don't exist
+    are left out.
+    """
+    scripts = []
+    pending = [scriptPath]
+    while pending:
+        path = os.path.normpath(pending.pop(0))
+        if path in scripts:
+            continue
+        try:
+            with open(path) as f:
+                text = f.read()
+        except IOError:
+            continue
+        scripts.append(path)
+        for name in SOURCE_COMMAND.findall(text):
+            pending.append(os.path.join(os.path.dirname(scriptPath), name))
+    return scripts
+
+# The caches in /cache and /release are JSON files that any run may read while
+# another one writes them. These helpers load them forgivingly, replace them
+# atomically and tell whether the files they describe have changed.
+def loadJsonCache(path):
+    """
+    Load the JSON object stored at path. A missing or corrupt file loads as an
+    empty dict, so a cache that can't be read starts out empty.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return { }
+    return data if isinstance(data, dict) else { }
+
+def saveJsonCache(path, data, **kwargs):
+    """
+    Write data to path as JSON (kwargs are passed to json.dump()). The file is
+    replaced atomically, so a crash never leaves a partial file behind and
+    concurrent runs never read one.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    fd, tempPath = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, **kwargs)
+    os.rename(tempPath, path)
+
+def getFileIdentity(path):
+    """
+    Get the [inode, size, mtime in nanoseconds] identifying the current
+    contents of path, or None if path doesn't exist. Anything cached about a
+    file is only trusted while its identity is unchanged.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    mtimeNs = getattr(stat, 'st_mtime_ns', None)
+    if mtimeNs is None:
+        mtimeNs = int(round(stat.st_mtime * 1e9)) # Python 2
+    return [stat.st_ino, stat.st_size, mtimeNs]
+
+class FileLock(object):
+    """
+    Exclusive lock on the file at path, held for the duration of a with
+    statement. Processes that read, merge and replace the same cache take the
+    lock around it, so that none of them loses the others' changes.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+    
+    def __enter__(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        self._file = open(self._path, 'a')
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+    
+    def __exit__(self, *args):
+        if fcntl:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        elif msvcrt:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    Base class of tests that work in a temporary directory, self._dir.
+    """
     def setUp(self):
-        pass
+        self._dir = tempfile.mkdtemp()
     
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+class TestLibretroUtils(TempDirTestCase):
     def test_get_closest_match(self):
         needle = 'bsnes'
         haystack = ['bsnes', 's9x', 's9x-next']
         self.assertEqual(getClosestMatch(needle, haystack), haystack[0])
         
-        needle = 'snes9x'
-        haystack = ['bsnes', 's9x', 's9x-next']
-        self.assertEqual(getClosestMatch(needle, haystack), haystack[1])
-        
         needle = 'snes9x_next'
         haystack = ['bsnes', 's9x', 's9x-next']
         self.assertEqual(getClosestMatch(needle, haystack), haystack[2])
+    
+    def test_get_sourced_scripts(self):
+        scriptPath = os.path.join(self._dir, 'libretro-build.sh')
+        with open(scriptPath, 'w') as f:
+            f.write('. ./libretro-config.sh\n' +
+                    'source "$BASE_DIR/libretro-build-common.sh"\n' +
+                    '. "$(dirname "$0")/libretro-missing.sh"\n')
+        with open(os.path.join(self._dir, 'libretro-build-common.sh'), 'w') as f:
+            f.write('. "${BASE_DIR}/libretro-config.sh"\n')
+        with open(os.path.join(self._dir, 'libretro-config.sh'), 'w') as f:
+            f.write('. ./libretro-build.sh # Loops are followed once\n')
         
-        needle = 'nxengine'
-        haystack = ['nx', '3dengine']
-        self.assertEqual(getClosestMatch(needle, haystack), haystack[0])
+        self.assertEqual(getSourcedScripts(scriptPath), [os.path.join(self._dir, name) for name in
+                         ['libretro-build.sh', 'libretro-config.sh', 'libretro-build-common.sh']])
+        self.assertEqual(getSourcedScripts(os.path.join(self._dir, 'missing.sh')), [])
+    
+    def test_json_cache(self):
+        path = os.path.join(self._dir, 'cache', 'test.json')
+        self.assertEqual(loadJsonCache(path), { })
+        saveJsonCache(path, {'version': 1})
+        self.assertEqual(loadJsonCache(path), {'version': 1})
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['test.json'])
+        
+        # Corrupt caches start out empty
+        for text in ['{"version": 1', '[1]']:
+            with open(path, 'w') as f:
+                f.write(text)
+            self.assertEqual(loadJsonCache(path), { })
+    
+    def test_get_file_identity(self):
+        path = os.path.join(self._dir, 'test.bin')
+        self.assertEqual(getFileIdentity(path), None)
+        with open(path, 'wb') as f:
+            f.write(b'test')
+        identity = getFileIdentity(path)
+        self.assertEqual(identity[1], 4)
+        
+        os.utime(path, (0, 1))
+        self.assertNotEqual(getFileIdentity(path), identity)
+        self.assertEqual(getFileIdentity(path)[2], 1000000000)
+    
+    def test_file_lock(self):
+        path = os.path.join(self._dir, 'cache', 'test.lock')
+        with FileLock(path):
+            self.assertTrue(os.path.exists(path))
+        with FileLock(path):
+            pass # Released by the first lock
 
 if __name__ == '__main__':
     unittest.main()
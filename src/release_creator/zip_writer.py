@@ -0,0 +1,478 @@
+# *
+# *  Copyright (C) 2012-2014 Garrett Brown
+# *
+# *  This Program is free software; you can redistribute it and/or modify
+# *  it under the terms of the GNU General Public License as published by
+# *  the Free Software Foundation; either version 2, or (at your option)
+# *  any later version.
+# *
+# *  This Program is distributed in the hope that it will be useful,
+# *  but WITHOUT ANY WARRANTY; without even the implied warranty of
+# *  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# *  GNU General Public License for more details.
+# *
+# *  You should have received a copy of the GNU General Public License
+# *  along with XBMC; see the file COPYING.  If not, write to
+# *  the Free Software Foundation, 675 Mass Ave, Cambridge, MA 02139, USA.
+# *  http://www.gnu.org/copyleft/gpl.html
+# *
+
+from digest_cache import DigestCache
+from digest_cache import DigestCacheTestCase
+from digest_cache import CRC32
+from md5_file import DigestWriter
+
+import hashlib
+import json
+import multiprocessing.pool
+import os
+import struct
+import unittest
+import zipfile
+import zlib
+
+CHUNK_SIZE           = 1024 * 1024
+DATA_DESCRIPTOR      = '<4sLLL'
+DATA_DESCRIPTOR_SIG  = b'PK\x07\x08'
+FLAG_DATA_DESCRIPTOR = 0x08
+
+# Everything that affects the bytes of an archive besides the entries' contents
+FIXED_DATE_TIME      = (1980, 1, 1, 0, 0, 0) # Earliest date a zip file can hold
+FILE_MODE            = 0o100644
+EXECUTABLE_MODE      = 0o100755
+CREATE_SYSTEM        = 3                     # Unix, so the modes above apply
+COMPRESS_LEVEL       = 6
+COMPRESS_MEM_LEVEL   = 8
+MANIFEST_VERSION     = 1
+MANIFEST_PREFIX      = b'manifest-sha256:'
+POLICY_VERSION       = 1
+POLICY_PREFIX        = b'policy:'
+
+# Entries are deflated in independent blocks of this size, so that large
+# entries can be compressed by several threads. Block boundaries don't depend
+# on the number of threads.
+DEFLATE_BLOCK_SIZE   = CHUNK_SIZE
+
+# Compression level of each entry type, by file extension. Level 0 stores the
+# entry; already compressed images don't get any smaller.
+COMPRESS_LEVELS      = {'.png': 0, '.jpg': 0, '.jpeg': 0}
+
+class CompressionPolicy:
+    """
+    How the entries of an archive are compressed: the level of each entry type
+    (levels maps file extensions to levels 0-9, other entries use
+    COMPRESS_LEVEL) and the number of threads that deflate an entry's blocks.
+    The number of threads doesn't change the archive's bytes.
+    """
+    
+    @staticmethod
+    def ParseLevel(spec):
+        """
+        Parse a command line level of the form EXT=LEVEL, e.g. so=9. Returns
+        an (extension, level) tuple.
+        """
+        extension, _, level = spec.partition('=')
+        if not extension or not level.isdigit() or int(level) > 9:
+            raise ValueError('Invalid compression level %s, expected EXT=LEVEL with LEVEL 0-9' % spec)
+        return '.' + extension.lstrip('.').lower(), int(level)
+    
+    def __init__(self, levels=None, jobs=1):
+        self._levels = dict(COMPRESS_LEVELS)
+        self._levels.update(levels or { })
+        self._jobs   = max(jobs, 1)
+    
+    def GetLevel(self, arcname):
+        extension = os.path.splitext(arcname)[1].lower()
+        return self._levels.get(extension, COMPRESS_LEVEL)
+    
+    def GetJobs(self):
+        return self._jobs
+    
+    def GetId(self):
+        """
+        Identify everything that affects how an entry is encoded. Entries can
+        only be copied between archives with the same policy ID.
+        """
+        data = json.dumps([POLICY_VERSION, DEFLATE_BLOCK_SIZE, COMPRESS_MEM_LEVEL, COMPRESS_LEVEL, sorted(self._levels.items())])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[ : 16]
+
+class ZipWriter:
+    """
+    Writes release archives. This is a thin wrapper around zipfile.ZipFile that
+    can also copy an entry from an existing archive without decompressing and
+    recompressing it.
+    
+    Archives are reproducible: entries are written in order of their names
+    when the archive is closed, with a fixed date, a fixed mode (executable
+    or not) and pinned deflate parameters, and every entry is laid out the
+    same way whether it was compressed or copied. The same entries therefore
+    always produce the same bytes. The archive's comment holds a digest of
+    its manifest (each entry's name, size, CRC and mode), which
+    GetManifestDigest() computes without writing anything, and the ID of the
+    CompressionPolicy it was written with.
+    
+    Like pigz, an entry is deflated in independent blocks of
+    DEFLATE_BLOCK_SIZE bytes, and all but the last block end with a sync
+    flush. The blocks join into one standard deflate stream, and they can be
+    compressed by a pool of threads (zlib releases the GIL while it works).
+    Blocks don't share a dictionary, which costs a fraction of a percent of
+    compression but keeps the output identical on Python 2 and 3.
+    
+    The archive is written strictly front to back through a DigestWriter, so
+    its MD5 and SHA-256 are known as soon as it is closed. Entries are
+    followed by a data descriptor instead of seeking back to patch their
+    header.
+    """
+    
+    @staticmethod
+    def IsSameFile(path, zinfo):
+        """
+        Check if the file at path has the same contents as the archive entry
+        described by zinfo. File size is checked first so that the CRC is only
+        looked up (or computed) if the sizes match.
+        """
+        if zinfo is None or not os.path.exists(path):
+            return False
+        if os.path.getsize(path) != zinfo.file_size:
+            return False
+        return DigestCache.GetInstance().GetDigest(path, CRC32) == zinfo.CRC
+    
+    @staticmethod
+    def GetMode(isExecutable):
+        return EXECUTABLE_MODE if isExecutable else FILE_MODE
+    
+    @staticmethod
+    def GetManifestDigest(manifest):
+        """
+        Get the digest of a manifest, a list of (name, size, CRC, mode) tuples
+        in any order.
+        """
+        entries = sorted([[name, size, crc, mode] for name, size, crc, mode in manifest])
+        data = json.dumps([MANIFEST_VERSION, COMPRESS_LEVEL, entries])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def ReadManifestDigest(myzip):
+        """
+        Get the manifest digest stored in an open ZipFile, or None if the
+        archive wasn't written by a ZipWriter that stores one.
+        """
+        if not myzip.comment.startswith(MANIFEST_PREFIX):
+            return None
+        return myzip.comment[len(MANIFEST_PREFIX) : ].split(b' ')[0].decode('ascii')
+    
+    @staticmethod
+    def ReadPolicyId(myzip):
+        """
+        Get the ID of the CompressionPolicy an open ZipFile was written with,
+        or None if it isn't recorded.
+        """
+        for field in myzip.comment.split(b' '):
+            if field.startswith(POLICY_PREFIX):
+                return field[len(POLICY_PREFIX) : ].decode('ascii')
+        return None
+    
+    @staticmethod
+    def _ToBytes(data):
+        return data if isinstance(data, bytes) else data.encode('utf-8')
+    
+    @staticmethod
+    def _DeflateBlock(block):
+        data, level, isLast = block
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, COMPRESS_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if isLast else zlib.Z_SYNC_FLUSH)
+    
+    def __init__(self, path, policy=None):
+        self._digestWriter = DigestWriter(open(path, 'wb'))
+        self._zip = zipfile.ZipFile(self._digestWriter, 'w', zipfile.ZIP_DEFLATED)
+        self._policy = policy or CompressionPolicy()
+        self._pool = None
+        self._entries = { } # name -> function writing the entry
+        self._manifest = [ ]
+    
+    def GetDigestWriter(self):
+        """
+        Get the DigestWriter holding the archive's digests. The digests are
+        complete once Close() has been called.
+        """
+        return self._digestWriter
+    
+    def WriteStr(self, arcname, data):
+        data = ZipWriter._ToBytes(data)
+        chunks = [data[i : i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+        self._entries[arcname] = lambda: self._WriteEntry(arcname, chunks, False)
+    
+    def WriteFile(self, path, arcname):
+        """
+        Compress the file at path into the archive, streaming it in chunks.
+        """
+        def ReadChunks():
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+        isExecutable = (os.stat(path).st_mode & 0o111) != 0
+        self._entries[arcname] = lambda: self._WriteEntry(arcname, ReadChunks(), isExecutable)
+    
+    def CanCopyFrom(self, srcZip):
+        """
+        Check if entries of the open ZipFile srcZip were compressed the way
+        this archive compresses them, so that copying them keeps the archive
+        reproducible.
+        """
+        return ZipWriter.ReadPolicyId(srcZip) == self._policy.GetId()
+    
+    def CopyEntry(self, srcZip, zinfo):
+        """
+        Copy the entry described by zinfo from the open ZipFile srcZip. The
+        compressed bytes are copied as-is; only the headers are rewritten.
+        Only entries from an archive that CanCopyFrom() end up identical to a
+        freshly compressed entry.
+        """
+        self._entries[zinfo.filename] = lambda: self._CopyEntry(srcZip, zinfo)
+    
+    def _NewInfo(self, arcname, isExecutable, compressType):
+        zinfo = zipfile.ZipInfo(arcname, FIXED_DATE_TIME)
+        zinfo.create_system = CREATE_SYSTEM
+        zinfo.external_attr = ZipWriter.GetMode(isExecutable) << 16
+        zinfo.compress_type = compressType
+        zinfo.flag_bits     = FLAG_DATA_DESCRIPTOR
+        zinfo.CRC           = 0
+        zinfo.compress_size = 0
+        zinfo.file_size     = 0
+        return zinfo
+    
+    def _Deflate(self, chunks, level):
+        """
+        Deflate chunks of at most DEFLATE_BLOCK_SIZE bytes as independent
+        blocks, a few batches of blocks ahead of the writer. Yields the
+        compressed blocks in order.
+        """
+        jobs = self._policy.GetJobs()
+        batch = [ ]
+        previous = None
+        for data in chunks:
+            if previous is not None:
+                batch.append((previous, level, False))
+            previous = data
+            if len(batch) == 2 * jobs:
+                for block in self._DeflateBatch(batch):
+                    yield block
+                batch = [ ]
+        batch.append((previous or b'', level, True))
+        for block in self._DeflateBatch(batch):
+            yield block
+    
+    def _DeflateBatch(self, batch):
+        if self._policy.GetJobs() > 1 and len(batch) > 1:
+            if not self._pool:
+                self._pool = multiprocessing.pool.ThreadPool(self._policy.GetJobs())
+            return self._pool.map(ZipWriter._DeflateBlock, batch, 1)
+        return [ZipWriter._DeflateBlock(block) for block in batch]
+    
+    def _WriteEntry(self, arcname, chunks, isExecutable):
+        level = self._policy.GetLevel(arcname)
+        zinfo = self._NewInfo(arcname, isExecutable, zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED)
+        
+        fp = self._zip.fp
+        zinfo.header_offset = fp.tell()
+        fp.write(zinfo.FileHeader())
+        
+        def Measure(chunks):
+            for data in chunks:
+                zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+                zinfo.file_size += len(data)
+                yield data
+        
+        blocks = Measure(chunks)
+        if level:
+            blocks = self._Deflate(blocks, level)
+        for data in blocks:
+            zinfo.compress_size += len(data)
+            fp.write(data)
+        
+        zinfo.CRC &= 0xffffffff
+        fp.write(struct.pack(DATA_DESCRIPTOR, DATA_DESCRIPTOR_SIG, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        
+        self._AddInfo(zinfo)
+    
+    def _CopyEntry(self, srcZip, zinfo):
+        # Skip past the local file header to the start of the compressed data
+        srcZip.fp.seek(zinfo.header_offset)
+        fheader = struct.unpack(zipfile.structFileHeader, srcZip.fp.read(zipfile.sizeFileHeader))
+        srcZip.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        
+        # Same header and data descriptor as a freshly compressed entry
+        newInfo = self._NewInfo(zinfo.filename, (zinfo.external_attr >> 16) & 0o111 != 0, zinfo.compress_type)
+        
+        fp = self._zip.fp
+        newInfo.header_offset = fp.tell()
+        fp.write(newInfo.FileHeader())
+        
+        remaining = zinfo.compress_size
+        while remaining > 0:
+            data = srcZip.fp.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise zipfile.BadZipfile('Truncated entry %s' % zinfo.filename)
+            fp.write(data)
+            remaining -= len(data)
+        
+        newInfo.CRC           = zinfo.CRC
+        newInfo.compress_size = zinfo.compress_size
+        newInfo.file_size     = zinfo.file_size
+        fp.write(struct.pack(DATA_DESCRIPTOR, DATA_DESCRIPTOR_SIG, newInfo.CRC, newInfo.compress_size, newInfo.file_size))
+        
+        self._AddInfo(newInfo)
+    
+    def _AddInfo(self, zinfo):
+        """
+        Register an entry that was written directly to the archive's file so
+        that it is included in the central directory.
+        """
+        self._zip.filelist.append(zinfo)
+        self._zip.NameToInfo[zinfo.filename] = zinfo
+        self._manifest.append((zinfo.filename, zinfo.file_size, zinfo.CRC, zinfo.external_attr >> 16))
+        
+        # Python 3's ZipFile tracks where the central directory starts
+        if hasattr(self._zip, 'start_dir'):
+            self._zip.start_dir = self._zip.fp.tell()
+        if hasattr(self._zip, '_didModify'):
+            self._zip._didModify = True
+    
+    def GetManifest(self):
+        """
+        Get the (name, size, CRC, mode) of each entry written by Close().
+        """
+        return list(self._manifest)
+    
+    def Close(self):
+        try:
+            for arcname in sorted(self._entries):
+                self._entries[arcname]()
+        finally:
+            if self._pool:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+        
+        self._zip.comment = MANIFEST_PREFIX + ZipWriter.GetManifestDigest(self._manifest).encode('ascii') + \
+                            b' ' + POLICY_PREFIX + self._policy.GetId().encode('ascii')
+        self._zip.close()
+        self._digestWriter.close()
+
+class TestZipWriter(DigestCacheTestCase):
+    def test_copy_entry(self):
+        libraryPath = os.path.join(self._dir, 'test_libretro.so')
+        with open(libraryPath, 'wb') as f:
+            f.write(os.urandom(1000) + b'\0' * 100000)
+        
+        oldPath = os.path.join(self._dir, 'old.zip')
+        writer = ZipWriter(oldPath)
+        writer.WriteStr('test/addon.xml', '<addon version="1.0.0"/>')
+        writer.WriteFile(libraryPath, 'test/test_libretro.so')
+        writer.Close()
+        
+        oldZip = zipfile.ZipFile(oldPath, 'r')
+        zinfo = oldZip.getinfo('test/test_libretro.so')
+        self.assertTrue(ZipWriter.IsSameFile(libraryPath, zinfo))
+        
+        newPath = os.path.join(self._dir, 'new.zip')
+        writer = ZipWriter(newPath)
+        writer.WriteStr('test/addon.xml', '<addon version="1.0.1"/>')
+        writer.CopyEntry(oldZip, zinfo)
+        writer.Close()
+        oldZip.close()
+        
+        # The archive was hashed while it was written
+        from md5_file import MD5File
+        self.assertEqual(MD5File(newPath, writer.GetDigestWriter()).GetMD5(), MD5File(newPath).GetMD5())
+        
+        newZip = zipfile.ZipFile(newPath, 'r')
+        self.assertEqual(newZip.testzip(), None)
+        self.assertEqual(newZip.getinfo('test/test_libretro.so').compress_size, zinfo.compress_size)
+        with open(libraryPath, 'rb') as f:
+            self.assertEqual(newZip.read('test/test_libretro.so'), f.read())
+        newZip.close()
+    
+    def test_reproducible(self):
+        libraryPath = os.path.join(self._dir, 'test_libretro.so')
+        with open(libraryPath, 'wb') as f:
+            f.write(os.urandom(1000) + b'\0' * 100000)
+        os.chmod(libraryPath, 0o775)
+        
+        # Entries added in a different order, at a different time, and copied
+        # instead of compressed
+        paths = [os.path.join(self._dir, name) for name in ['a.zip', 'b.zip']]
+        writer = ZipWriter(paths[0])
+        writer.WriteStr('test/addon.xml', '<addon/>')
+        writer.WriteFile(libraryPath, 'test/test_libretro.so')
+        writer.Close()
+        
+        os.utime(libraryPath, (0, 0))
+        oldZip = zipfile.ZipFile(paths[0], 'r')
+        writer = ZipWriter(paths[1])
+        writer.CopyEntry(oldZip, oldZip.getinfo('test/test_libretro.so'))
+        writer.WriteStr('test/addon.xml', '<addon/>')
+        writer.Close()
+        oldZip.close()
+        
+        with open(paths[0], 'rb') as f:
+            data = f.read()
+        with open(paths[1], 'rb') as f:
+            self.assertEqual(f.read(), data)
+        
+        myzip = zipfile.ZipFile(paths[0], 'r')
+        self.assertEqual([zinfo.filename for zinfo in myzip.infolist()], ['test/addon.xml', 'test/test_libretro.so'])
+        self.assertEqual([zinfo.external_attr >> 16 for zinfo in myzip.infolist()], [FILE_MODE, EXECUTABLE_MODE])
+        self.assertEqual(myzip.infolist()[1].date_time, FIXED_DATE_TIME)
+        
+        # The manifest digest can be computed from the inputs alone
+        manifest = [('test/addon.xml', 8, zlib.crc32(b'<addon/>') & 0xffffffff, FILE_MODE),
+                    ('test/test_libretro.so', 101000, DigestCache.GetInstance().GetDigest(libraryPath, CRC32), EXECUTABLE_MODE)]
+        self.assertEqual(ZipWriter.ReadManifestDigest(myzip), ZipWriter.GetManifestDigest(manifest))
+        myzip.close()
+    
+    def test_parallel_deflate(self):
+        libraryPath = os.path.join(self._dir, 'test_libretro.so')
+        with open(libraryPath, 'wb') as f:
+            for i in range(7):
+                f.write(os.urandom(1000) + b'\0' * (DEFLATE_BLOCK_SIZE // 2))
+        iconPath = os.path.join(self._dir, 'icon.png')
+        with open(iconPath, 'wb') as f:
+            f.write(b'\0' * 10000)
+        
+        # The number of threads doesn't change the archive
+        paths = [ ]
+        for jobs in [1, 4]:
+            paths.append(os.path.join(self._dir, '%d.zip' % jobs))
+            writer = ZipWriter(paths[-1], CompressionPolicy({'.so': 9}, jobs))
+            writer.WriteFile(libraryPath, 'test/test_libretro.so')
+            writer.WriteFile(iconPath, 'test/icon.png')
+            writer.Close()
+        with open(paths[0], 'rb') as f:
+            data = f.read()
+        with open(paths[1], 'rb') as f:
+            self.assertEqual(f.read(), data)
+        
+        # Blocks join into a single deflate stream, images are stored
+        myzip = zipfile.ZipFile(paths[0], 'r')
+        self.assertEqual(myzip.testzip(), None)
+        with open(libraryPath, 'rb') as f:
+            self.assertEqual(myzip.read('test/test_libretro.so'), f.read())
+        self.assertEqual(myzip.getinfo('test/icon.png').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(myzip.getinfo('test/icon.png').compress_size, 10000)
+        
+        # Entries are only copied from archives compressed the same way
+        for policy, canCopy in [(CompressionPolicy({'.so': 9}, 2), True), (CompressionPolicy(), False)]:
+            writer = ZipWriter(os.path.join(self._dir, 'copy.zip'), policy)
+            self.assertEqual(writer.CanCopyFrom(myzip), canCopy)
+            writer.Close()
+        myzip.close()
+        
+        self.assertEqual(CompressionPolicy.ParseLevel('SO=9'), ('.so', 9))
+        self.assertRaises(ValueError, CompressionPolicy.ParseLevel, 'so=10')
+
+if __name__ == '__main__':
+    unittest.main()